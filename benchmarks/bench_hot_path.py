@@ -0,0 +1,187 @@
+"""
+行情热路径性能测试: quotation -> pipeline -> sink
+
+    python benchmarks/bench_hot_path.py --instruments 100,1000,5000 --output bench.jsonl
+
+每个合约规模在独立子进程中运行以便统计峰值内存, 结果按 json lines 输出, 每行一个 stage
+"""
+import json
+import resource
+import subprocess
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from queue import Queue
+from socketserver import ThreadingMixIn
+
+import easyctp
+from easyctp.facade import MongoStrategy
+from easyctp.influx import InfluxWriter, LineProtocolEncoder
+from easyctp.pipeline import ConvertDict, FilterInvalidItem, SaveInflux
+from easyctp.quotation import BufferedMarketData, MarketData
+from easyctp.replay import synthetic_ticks
+from easyctp.writer import BatchWriter
+
+
+class LineProtocolHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests += 1
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeInfluxServer(ThreadingMixIn, HTTPServer):
+    """
+    只接收 /write 请求并返回 204 的本地 influxdb 替身
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), LineProtocolHandler)
+        self.requests = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class MemoryCollection:
+    """
+    内存中的 mongodb collection 替身
+    """
+
+    def __init__(self):
+        self.documents = []
+
+    def insert_many(self, documents, ordered=True):
+        self.documents.extend(documents)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)] if values else 0
+
+
+def run_stage(name, func, units, ticks, instruments):
+    """
+    :param func: 每次处理一个 unit (单条 tick 或一批 tick)
+    :return: 吞吐量与单条 tick 延迟 (批处理时按批次大小平均) 统计
+    """
+    latencies = []
+    start = time.perf_counter()
+    for unit in units:
+        begin = time.perf_counter_ns()
+        func(unit)
+        elapsed = time.perf_counter_ns() - begin
+        size = len(unit) if isinstance(unit, list) else 1
+        latencies.append(elapsed / size)
+    total = time.perf_counter() - start
+    return {
+        'version': easyctp.__version__,
+        'stage': name,
+        'instruments': instruments,
+        'ticks': ticks,
+        'seconds': total,
+        'ticks_per_sec': ticks / total if total else 0,
+        'p50_us': percentile(latencies, 0.5) / 1000,
+        'p99_us': percentile(latencies, 0.99) / 1000,
+    }
+
+
+def run_sink(name, writer, batches, ticks, instruments):
+    start = time.perf_counter()
+    for batch in batches:
+        writer.put(batch)
+    writer.close()
+    total = time.perf_counter() - start
+    stats = writer.stats()
+    return {
+        'version': easyctp.__version__,
+        'stage': name,
+        'instruments': instruments,
+        'ticks': ticks,
+        'seconds': total,
+        'ticks_per_sec': stats['written'] / total if total else 0,
+        'p50_us': None,
+        'p99_us': None,
+        'flush_latency_avg': stats['flush_latency_avg'],
+        'flush_latency_max': stats['flush_latency_max'],
+        'failed': stats['failed'],
+    }
+
+
+def bench(instruments, snapshots, batch_size):
+    ticks = list(synthetic_ticks(instruments=instruments, snapshots=snapshots))
+    batches = [ticks[i:i + batch_size] for i in range(0, len(ticks), batch_size)]
+    count = len(ticks)
+    results = []
+
+    market_data = MarketData(Queue())
+    results.append(run_stage('market_data.put_tick', market_data.put_tick, ticks, count, instruments))
+    results.append(run_stage('market_data.get_batch', lambda _: market_data.get_batch(batch_size),
+                             batches, count, instruments))
+
+    buffered = BufferedMarketData(capacity=1 << 20)
+    results.append(run_stage('buffered_market_data.put_tick', buffered.put_tick, ticks, count, instruments))
+
+    filter_item = FilterInvalidItem(None, log_interval=3600)
+    results.append(run_stage('filter_invalid_item', filter_item._process_item, ticks, count, instruments))
+    filter_batch = FilterInvalidItem(None, log_interval=3600)
+    results.append(run_stage('filter_invalid_item.batch', filter_batch._process_batch, batches, count, instruments))
+
+    convert_dict = ConvertDict(None)
+    results.append(run_stage('convert_dict', convert_dict._process_item, ticks, count, instruments))
+
+    results.append(run_stage('save_influx.convert_to_point', SaveInflux.convert_to_point, ticks, count,
+                             instruments))
+    encoder = LineProtocolEncoder()
+    results.append(run_stage('line_protocol.encode_batch', encoder.encode_batch, batches, count, instruments))
+    results.append(run_stage('mongo_strategy.convert_to_documents', MongoStrategy.convert_to_documents, batches,
+                             count, instruments))
+
+    server = FakeInfluxServer()
+    influx = InfluxWriter(host='127.0.0.1', port=server.server_address[1], database='bench')
+    writer = BatchWriter(influx.write, encode=LineProtocolEncoder().encode_batch, batch_size=5000,
+                         batch_bytes=1 << 20, worker=2, name='influxdb')
+    results.append(run_sink('sink.influxdb', writer, batches, count, instruments))
+    server.shutdown()
+
+    collection = MemoryCollection()
+    writer = BatchWriter(lambda documents: collection.insert_many(documents, ordered=False),
+                         encode=MongoStrategy.convert_to_documents, batch_size=1000, name='mongodb')
+    results.append(run_sink('sink.mongodb', writer, batches, count, instruments))
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for result in results:
+        result['peak_rss_kb'] = peak_rss
+    return results
+
+
+if __name__ == '__main__':
+    opt = ArgumentParser()
+    opt.add_argument('--instruments', type=str, default='100,1000,5000', help='合约数量, 逗号分隔')
+    opt.add_argument('--snapshots', type=int, default=20, help='每个合约推送的快照次数')
+    opt.add_argument('--batch_size', type=int, default=500)
+    opt.add_argument('--output', type=str, help='结果输出文件, 默认输出到 stdout')
+    opt.add_argument('--single', action='store_true', help='只在当前进程运行一个规模, 供内部调用')
+    args = opt.parse_args()
+
+    if args.single:
+        for result in bench(int(args.instruments), args.snapshots, args.batch_size):
+            print(json.dumps(result))
+        sys.exit(0)
+
+    lines = []
+    for instruments in args.instruments.split(','):
+        output = subprocess.check_output([sys.executable, __file__, '--single', '--instruments', instruments,
+                                          '--snapshots', str(args.snapshots), '--batch_size', str(args.batch_size)])
+        lines.extend(output.decode().splitlines())
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+    else:
+        print('\n'.join(lines))
@@ -0,0 +1,257 @@
+import asyncio
+from collections import deque
+from copy import copy
+
+from ctp.futures import ApiStruct
+
+from easyctp.quotation import MarketDataApi
+from easyctp.log import log
+from easyctp.query import THROTTLED, CtpError
+from easyctp.trader import EasyTrader
+
+
+class AsyncResultMap:
+    """
+    ResultMap 的 asyncio 版本: 每个请求对应一个 future, ctp 回调线程通过 call_soon_threadsafe
+    把响应交给事件循环, 收到 bIsLast 后 future 完成, 等待期间不占用线程
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.pending = {}
+
+    def create(self, request_id):
+        future = self.loop.create_future()
+        self.pending[request_id] = (future, [])
+        return future
+
+    def discard(self, request_id):
+        self.pending.pop(request_id, None)
+
+    def put(self, request_id, *args):
+        # 回调参数指向 ctp 内部内存, 必须在回调线程中复制
+        *res, is_last = tuple(copy(x) for x in args)
+        self.loop.call_soon_threadsafe(self._put, request_id, res, is_last)
+
+    def fail(self, request_id, rsp_info):
+        exception = CtpError(rsp_info.ErrorID, rsp_info.ErrorMsg, request_id)
+        self.loop.call_soon_threadsafe(self._set_exception, request_id, exception)
+
+    def _put(self, request_id, res, is_last):
+        entry = self.pending.get(request_id)
+        if entry is None:
+            return
+        future, results = entry
+        results.append(res)
+        if is_last:
+            del self.pending[request_id]
+            if not future.done():
+                future.set_result(results)
+
+    def _set_exception(self, request_id, exception):
+        entry = self.pending.pop(request_id, None)
+        if entry is not None and not entry[0].done():
+            entry[0].set_exception(exception)
+
+
+class AsyncTrader(EasyTrader):
+    """
+    EasyTrader 的 asyncio 版本, login 和查询都是 awaitable, 按 request id 对应响应.
+    需要在事件循环中调用, 多个查询可以并发等待: 与 QueryScheduler 相同, 查询按顺序逐个发送,
+    上一个查询全部返回且距离上次发送超过 interval 后才发送下一个, 被流控 (返回 -2/-3) 时等待后重试
+    """
+
+    def __init__(self, loop=None, interval=1.0, retries=10, retry_delay=1.0):
+        """
+        :param interval: 两次查询之间的最小间隔秒数
+        :param retries: 被流控时的最大重试次数
+        :param retry_delay: 被流控后的等待秒数
+        """
+        super().__init__()
+        self.loop = loop
+        self.login_future = None
+        self.interval = interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.query_lock = None
+        self.last_sent = None
+        self.throttled = 0
+
+    @property
+    def scheduler(self):
+        raise TypeError('AsyncTrader 不使用 QueryScheduler, 请使用 await query(...)')
+
+    async def login(self, user, password, broker, front, timeout=30):
+        """
+        :param front: 交易服务器地址, 类似 tcp://127.0.0.1:8000
+        :param timeout: 登录超时秒数
+        """
+        self.loop = self.loop or asyncio.get_running_loop()
+        self.results_map = AsyncResultMap(self.loop)
+        self.login_future = self.loop.create_future()
+        self.connect(user, password, broker, front)
+        await asyncio.wait_for(self.login_future, timeout)
+
+    def OnRspUserLogin(self, pRspUserLogin, pRspInfo, nRequestID, bIsLast):
+        super().OnRspUserLogin(pRspUserLogin, pRspInfo, nRequestID, bIsLast)
+        error = None if pRspInfo.ErrorID == 0 else CtpError(pRspInfo.ErrorID, pRspInfo.ErrorMsg, nRequestID)
+        if self.login_future is not None:
+            self.loop.call_soon_threadsafe(_resolve, self.login_future, error)
+
+    async def query(self, method, request, timeout=10):
+        """
+        发送 ReqQry* 请求并等待全部响应
+        :param method: 请求方法名, 如 'ReqQryInstrument'
+        :param request: 请求结构体, 如 ApiStruct.QryInstrument()
+        :return: [[响应结构体, RspInfo], ...], 与 ResultMap.get 相同
+        """
+        if self.query_lock is None:
+            self.query_lock = asyncio.Lock()
+        # ctp 每个会话同一时刻只允许一个未完成的查询, 持有锁直到全部响应返回
+        async with self.query_lock:
+            request_id, future = await self._send(method, request)
+            try:
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError as e:
+                self.results_map.discard(request_id)
+                raise TimeoutError('{} request {} timeout'.format(method, request_id)) from e
+
+    async def _send(self, method, request):
+        loop = asyncio.get_running_loop()
+        for _ in range(self.retries + 1):
+            if self.last_sent is not None:
+                delay = self.last_sent + self.interval - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            request_id = next(self.request_id)
+            future = self.results_map.create(request_id)
+            ret = getattr(self, method)(request, request_id)
+            self.last_sent = loop.time()
+            if ret == 0:
+                return request_id, future
+            self.results_map.discard(request_id)
+            if ret not in THROTTLED:
+                raise CtpError(ret, '{} returned {}'.format(method, ret), request_id)
+            self.throttled += 1
+            log.warning('查询 {} 被流控 ({}), {} 秒后重试'.format(method, ret, self.retry_delay))
+            await asyncio.sleep(self.retry_delay)
+        raise CtpError(ret, '{} throttled {} times'.format(method, self.retries + 1), request_id)
+
+    async def query_all_instruments(self, timeout=10):
+        response = await self.query('ReqQryInstrument', ApiStruct.QryInstrument(), timeout)
+        return {pInstrument.InstrumentID for pInstrument, _ in response if pInstrument is not None}
+
+
+class AsyncMarketData:
+    """
+    可以 async for 的行情流, 回调线程把 tick 放入 deque, 只有在事件循环尚未被唤醒时才调用
+    call_soon_threadsafe, 行情密集推送时多条 tick 共用一次唤醒.
+    async for 每次返回一条 tick, batches() 每次返回当前所有 tick 的列表
+    """
+
+    def __init__(self, loop=None, timeout=None):
+        """
+        :param loop: 事件循环, 默认使用当前正在运行的事件循环
+        :param timeout: 迭代时的等待超时, 超时后 async for 结束
+        """
+        self.loop = loop or asyncio.get_running_loop()
+        self.timeout = timeout
+        self.buffer = deque()
+        self.scheduled = False
+        self.event = asyncio.Event()
+
+    def put_tick(self, depth_market_data):
+        self.put(ApiStruct.DepthMarketData.from_buffer_copy(depth_market_data))
+
+    def put(self, item):
+        self.buffer.append(item)
+        if not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon_threadsafe(self._wake)
+
+    def qsize(self):
+        return len(self.buffer)
+
+    def _wake(self):
+        self.scheduled = False
+        self.event.set()
+
+    async def _wait(self, timeout):
+        while not self.buffer:
+            # 先清除再检查, 清除之后写入的 tick 一定会再次唤醒
+            self.event.clear()
+            if self.buffer:
+                break
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def get(self, timeout=None):
+        if not await self._wait(timeout):
+            raise TimeoutError
+        return self.buffer.popleft()
+
+    async def get_batch(self, max_items=None, max_wait=None):
+        """
+        :return: tick 列表, 超时返回空列表
+        """
+        if not await self._wait(self.timeout if max_wait is None else max_wait):
+            return []
+        buffer = self.buffer
+        count = len(buffer) if max_items is None else min(len(buffer), max_items)
+        popleft = buffer.popleft
+        return [popleft() for _ in range(count)]
+
+    async def batches(self, max_items=None, max_wait=None):
+        while True:
+            batch = await self.get_batch(max_items, max_wait)
+            if not batch:
+                return
+            yield batch
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not await self._wait(self.timeout):
+            raise StopAsyncIteration
+        return self.buffer.popleft()
+
+
+class AsyncMarketDataApi(MarketDataApi):
+    def __init__(self, loop=None):
+        super().__init__()
+        self.loop = loop
+        self.login_future = None
+
+    async def start(self, user, password, broker, front, instrument_ids, market_data=None, snapshot=None,
+                    publisher=None, timeout=30):
+        """
+        登录行情并订阅合约, 登录成功后返回
+        :param market_data: 默认新建 AsyncMarketData
+        :return: market_data
+        """
+        self.loop = self.loop or asyncio.get_running_loop()
+        market_data = market_data if market_data is not None else AsyncMarketData(self.loop)
+        self.login_future = self.loop.create_future()
+        self.prepare(user, password, broker, front, instrument_ids, market_data=market_data, snapshot=snapshot,
+                     publisher=publisher)
+        await asyncio.wait_for(self.login_future, timeout)
+        return market_data
+
+    def OnRspUserLogin(self, pRspUserLogin, pRspInfo, nRequestID, bIsLast):
+        super().OnRspUserLogin(pRspUserLogin, pRspInfo, nRequestID, bIsLast)
+        error = None if pRspInfo.ErrorID == 0 else CtpError(pRspInfo.ErrorID, pRspInfo.ErrorMsg, nRequestID)
+        if self.login_future is not None:
+            self.loop.call_soon_threadsafe(_resolve, self.login_future, error)
+
+
+def _resolve(future, error):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(True)
+    else:
+        future.set_exception(error)
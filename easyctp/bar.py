@@ -0,0 +1,271 @@
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from easyctp.validator import DAY_MS, SESSION_SHIFT_MS, clock_ms, item_time_parsable
+
+INTERVALS = {
+    '1m': 60 * 1000,
+    '5m': 5 * 60 * 1000,
+    '15m': 15 * 60 * 1000,
+    '30m': 30 * 60 * 1000,
+    '1h': 60 * 60 * 1000,
+    '1d': None,
+}
+
+# 各交易所交易时段的结束时间, 结束时间之后 session_end_tolerance_ms 以内的收盘 tick 归入前一根 bar
+SESSION_ENDS = ('10:15:00', '11:30:00', '15:00:00', '15:15:00', '23:00:00', '23:30:00', '01:00:00', '02:30:00')
+
+
+Tick = namedtuple('Tick', ['InstrumentID', 'TradingDay', 'UpdateTime', 'UpdateMillisec', 'LastPrice', 'Volume',
+                           'Turnover', 'OpenInterest'])
+
+
+class BarAggregator:
+    """
+    按合约增量生成 1m/5m/15m/30m/1h/1d 的 OHLCV bar, 成交量和成交额由累计值差分得到.
+    时间统一使用 validator.session_time_keys 中的交易时段时间, 夜盘跨零点也保持单调.
+    进程启动后每个合约的第一个 tick 只用来记录累计值, 不计入成交量, 避免盘中重启时把当天的累计成交量算进一根 bar.
+    落在已经完成的 bar 中的迟到 tick 直接丢弃并计入 late, 不会重新生成同一时间的 bar 覆盖已经写入的数据.
+    TradingDay 或 UpdateTime 无法解析的 tick 直接丢弃并计入 invalid.
+    行情时钟越过交易时段结束时间后, 跨越该时间的未完成 bar (如 10:00-10:30 的 30m bar 和日线) 会先输出一次,
+    之后如果还有 tick 落入 (该合约在这个时段不休市), bar 完成时会以相同的开始时间再输出一次完整的数据.
+    完成的 bar 以 dict 列表的形式交给 sinks
+    """
+
+    def __init__(self, intervals=('1m', '5m', '15m', '30m', '1h', '1d'), session_ends=SESSION_ENDS,
+                 daily_close='15:15:00', grace_ms=500, session_end_tolerance_ms=500, sinks=None):
+        """
+        :param intervals: 需要生成的周期, 见 INTERVALS
+        :param session_ends: 交易时段结束时间
+        :param daily_close: 日线在该时间之后收盘
+        :param grace_ms: 行情时钟越过 bar 结束时间多少毫秒后才认为 bar 完成, 用于等待同一快照中其他合约的 tick
+        :param session_end_tolerance_ms: 交易时段结束时间之后多少毫秒以内的 tick 仍视为收盘 tick, 如 15:00:00.500
+        :param sinks: 接收完成 bar 列表的函数
+        """
+        unknown = [interval for interval in intervals if interval not in INTERVALS]
+        if unknown:
+            raise ValueError('unknown intervals: {}'.format(unknown))
+        self.intervals = tuple(intervals)
+        self.session_end_tolerance_ms = session_end_tolerance_ms
+        session_ends = [clock_ms(end.encode()) for end in session_ends]
+        # UpdateTime 的秒 -> 该秒可能处于容差范围内的交易时段结束时间
+        self.session_end_window = {}
+        for end in session_ends:
+            for second in range(end, end + session_end_tolerance_ms + 1, 1000):
+                self.session_end_window[second % DAY_MS] = end
+        # 交易时段结束时间在交易日内的偏移, 与 key - day_key 对应
+        self.session_end_offsets = sorted((end - SESSION_SHIFT_MS) % DAY_MS for end in session_ends)
+        self.daily_close_ms = (clock_ms(daily_close.encode()) - SESSION_SHIFT_MS) % DAY_MS
+        self.grace_ms = grace_ms
+        self.sinks = list(sinks or [])
+
+        self.bars = {interval: {} for interval in self.intervals}
+        self.next_close = {interval: None for interval in self.intervals}
+        # 每个周期下各合约最后一根完成的 bar 的结束时间
+        self.emitted = {interval: {} for interval in self.intervals}
+        self.cumulative = {}
+        self.market_key = None
+        self.market_wall = None
+        # 最近一次已经处理过的交易时段结束时间
+        self.session_flushed = None
+        self.late = 0
+        self.invalid = 0
+        self.lock = threading.Lock()
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def update(self, tick):
+        with self.lock:
+            finished = self._update(tick)
+            finished.extend(self._advance(self.market_key))
+        self._emit(finished)
+
+    def update_batch(self, batch):
+        if isinstance(batch, np.ndarray):
+            # recarray 的字段是 numpy 标量, 先批量转换为 python 对象
+            batch = map(Tick._make, zip(*(batch[name].tolist() for name in Tick._fields)))
+        finished = []
+        with self.lock:
+            for tick in batch:
+                finished.extend(self._update(tick))
+            finished.extend(self._advance(self.market_key))
+        self._emit(finished)
+
+    def advance(self, wall=None):
+        """
+        没有新 tick 时按本地时钟推算行情时钟, 让午休和收盘后的最后一根 bar 也能及时完成
+        """
+        wall = time.time() if wall is None else wall
+        with self.lock:
+            if self.market_key is None:
+                return
+            finished = self._advance(self.market_key + int((wall - self.market_wall) * 1000))
+        self._emit(finished)
+
+    def close(self):
+        """
+        完成所有未结束的 bar
+        """
+        finished = []
+        with self.lock:
+            for interval in self.intervals:
+                for instrument_id, bar in self.bars[interval].items():
+                    self._finish(interval, instrument_id, bar, finished)
+                self.bars[interval] = {}
+                self.next_close[interval] = None
+        self._emit(finished)
+
+    def _update(self, tick):
+        if not item_time_parsable(tick):
+            # 没有经过 FilterInvalidItem 的行情中可能有空的 TradingDay 或损坏的 UpdateTime
+            self.invalid += 1
+            return []
+        instrument_id = tick.InstrumentID
+        trading_day = tick.TradingDay
+        day_key = int(trading_day) * DAY_MS
+        clock = clock_ms(tick.UpdateTime)
+        millisec = tick.UpdateMillisec
+        key = day_key + (clock + millisec - SESSION_SHIFT_MS) % DAY_MS
+
+        volume, turnover = tick.Volume, tick.Turnover
+        previous = self.cumulative.get(instrument_id)
+        if previous is None:
+            # 不知道重启前的累计值, 只记录不计入
+            volume_delta, turnover_delta = 0, 0.0
+            self.cumulative[instrument_id] = (trading_day, volume, turnover)
+        elif previous[0] != trading_day:
+            volume_delta, turnover_delta = volume, turnover
+            self.cumulative[instrument_id] = (trading_day, volume, turnover)
+        elif volume < previous[1]:
+            # 乱序的旧快照, 累计值保持不变
+            volume_delta, turnover_delta = 0, 0.0
+        else:
+            volume_delta, turnover_delta = volume - previous[1], turnover - previous[2]
+            self.cumulative[instrument_id] = (trading_day, volume, turnover)
+
+        if self.market_key is None or key > self.market_key:
+            self.market_key = key
+            self.market_wall = time.time()
+
+        finished = []
+        # 收盘 tick 按结束时间前 1 毫秒计算所属的 bar
+        position = clock + millisec
+        session_end = self.session_end_window.get(clock)
+        if session_end is not None and 0 <= position - session_end <= self.session_end_tolerance_ms:
+            position = session_end - 1
+        bar_key = key - (clock + millisec - position)
+        price = tick.LastPrice
+        for interval in self.intervals:
+            length = INTERVALS[interval]
+            if length is None:
+                start, end = day_key, day_key + self.daily_close_ms
+            else:
+                start = bar_key - position % length
+                end = start + length
+
+            if start < self.emitted[interval].get(instrument_id, 0):
+                self.late += 1
+                continue
+            bars = self.bars[interval]
+            bar = bars.get(instrument_id)
+            if bar is not None and bar['_start'] != start:
+                if start < bar['_start']:
+                    self.late += 1
+                    continue
+                self._finish(interval, instrument_id, bars.pop(instrument_id), finished)
+                bar = None
+            if bar is None:
+                bar = bars[instrument_id] = {
+                    'instrument_id': instrument_id,
+                    'interval': interval,
+                    'trading_day': trading_day,
+                    'start': '00:00:00' if length is None else self._start_time(start, day_key),
+                    'open': price, 'high': price, 'low': price, 'close': price,
+                    'volume': 0, 'turnover': 0.0, 'open_interest': tick.OpenInterest, 'count': 0,
+                    '_start': start, '_end': end, '_close': self._close_key(end, day_key), '_emitted_count': 0,
+                }
+                if self.next_close[interval] is None or bar['_close'] < self.next_close[interval]:
+                    self.next_close[interval] = bar['_close']
+            if price > bar['high']:
+                bar['high'] = price
+            if price < bar['low']:
+                bar['low'] = price
+            bar['close'] = price
+            bar['volume'] += volume_delta
+            bar['turnover'] += turnover_delta
+            bar['open_interest'] = tick.OpenInterest
+            bar['count'] += 1
+        return finished
+
+    def _advance(self, market_key):
+        finished = []
+        if market_key is None:
+            return finished
+        deadline = market_key - self.grace_ms
+        for interval in self.intervals:
+            next_close = self.next_close[interval]
+            if next_close is None or next_close > deadline:
+                continue
+            bars = self.bars[interval]
+            for instrument_id in [instrument_id for instrument_id, bar in bars.items() if bar['_close'] <= deadline]:
+                self._finish(interval, instrument_id, bars.pop(instrument_id), finished)
+            self.next_close[interval] = min((bar['_close'] for bar in bars.values()), default=None)
+        self._flush_session(deadline, finished)
+        return finished
+
+    def _close_key(self, end, day_key):
+        """
+        结束于交易时段结束时间的 bar 需要多等待 session_end_tolerance_ms, 收盘 tick 才能计入
+        """
+        if end - day_key in self.session_end_offsets:
+            return end + self.session_end_tolerance_ms
+        return end
+
+    def _flush_session(self, deadline, finished):
+        """
+        行情时钟越过交易时段结束时间后, 输出跨越该时间的未完成 bar, 不必等到 bar 本身的结束时间
+        """
+        day_key = deadline - deadline % DAY_MS
+        offset = deadline - day_key - self.session_end_tolerance_ms
+        passed = [end for end in self.session_end_offsets if end <= offset]
+        # 当天还没有交易时段结束时以交易日开始作为位置
+        session_end = day_key + passed[-1] if passed else day_key
+        if self.session_flushed is None:
+            # 启动后第一次只记录位置, 不输出启动前已经结束的交易时段
+            self.session_flushed = session_end
+            return
+        if session_end <= self.session_flushed:
+            return
+        self.session_flushed = session_end
+        for interval in self.intervals:
+            for bar in self.bars[interval].values():
+                if bar['_start'] < session_end < bar['_end'] and bar['count'] != bar['_emitted_count']:
+                    bar['_emitted_count'] = bar['count']
+                    # bar 之后还可能继续更新, 输出副本
+                    finished.append(dict(bar))
+
+    def _finish(self, interval, instrument_id, bar, finished):
+        self.emitted[interval][instrument_id] = bar['_end']
+        if bar['count'] != bar['_emitted_count']:
+            finished.append(bar)
+
+    @staticmethod
+    def _start_time(start, day_key):
+        clock = (start - day_key + SESSION_SHIFT_MS) % DAY_MS // 1000
+        return '{:02d}:{:02d}:{:02d}'.format(clock // 3600, clock // 60 % 60, clock % 60)
+
+    def _emit(self, finished):
+        if not finished:
+            return
+        bars = []
+        for bar in finished:
+            bar = {name: value for name, value in bar.items() if not name.startswith('_')}
+            bar['instrument_id'] = bar['instrument_id'].decode()
+            bar['trading_day'] = bar['trading_day'].decode()
+            bars.append(bar)
+        for sink in self.sinks:
+            sink(bars)
@@ -0,0 +1,97 @@
+import ctypes
+import threading
+from queue import Empty
+
+import numpy as np
+from ctp.futures import ApiStruct
+
+
+def struct_dtype(struct):
+    """
+    根据 ctypes 结构体的 _fields_ 生成内存布局完全一致的 numpy structured dtype,
+    这样可以直接 memmove 整个结构体而不需要逐个字段读取
+    :param struct: ApiStruct 中的结构体类型, 如 ApiStruct.DepthMarketData
+    """
+    names, formats, offsets = [], [], []
+    for name, ctype in struct._fields_:
+        names.append(name)
+        formats.append(_ctype_format(ctype))
+        offsets.append(getattr(struct, name).offset)
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                     'itemsize': ctypes.sizeof(struct)})
+
+
+def _ctype_format(ctype):
+    if issubclass(ctype, ctypes.Array) and ctype._type_ is ctypes.c_char:
+        return 'S{}'.format(ctype._length_)
+    if ctype is ctypes.c_char:
+        return 'S1'
+    return np.dtype(ctype)
+
+
+DEPTH_MARKET_DATA_DTYPE = struct_dtype(ApiStruct.DepthMarketData)
+
+
+def to_array(items, dtype=DEPTH_MARKET_DATA_DTYPE):
+    """
+    把 ctypes 结构体列表按原始内存拼接为 numpy structured array, 已经是数组时直接返回
+    """
+    if isinstance(items, np.ndarray):
+        return items
+    itemsize = dtype.itemsize
+    data = b''.join([ctypes.string_at(ctypes.addressof(item), itemsize) for item in items])
+    return np.frombuffer(data, dtype=dtype).view(np.recarray)
+
+
+class TickBuffer:
+    """
+    预分配的环形 tick 缓冲区, 回调线程直接把 DepthMarketData 的原始内存拷贝进来,
+    消费者以 numpy recarray 视图的方式批量读取.
+    返回的视图在缓冲区写满一圈之前有效, 需要长期持有时请自行 copy()
+    """
+
+    def __init__(self, capacity=1 << 16, struct=ApiStruct.DepthMarketData):
+        self.struct = struct
+        self.dtype = DEPTH_MARKET_DATA_DTYPE if struct is ApiStruct.DepthMarketData else struct_dtype(struct)
+        self.capacity = capacity
+        self.itemsize = self.dtype.itemsize
+        self.array = np.zeros(capacity, dtype=self.dtype).view(np.recarray)
+        self._address = self.array.ctypes.data
+
+        self.write_seq = 0
+        self.read_seq = 0
+        self.overrun = 0
+        self.not_empty = threading.Condition()
+
+    def put(self, struct):
+        slot = self.write_seq % self.capacity
+        ctypes.memmove(self._address + slot * self.itemsize, ctypes.addressof(struct), self.itemsize)
+        with self.not_empty:
+            self.write_seq += 1
+            self.not_empty.notify()
+
+    def get_batch(self, max_items=None, timeout=None):
+        """
+        :param max_items: 单批最多返回的条数, None 表示取出当前所有可读数据
+        :param timeout: 没有数据时的最长等待时间, None 表示一直等待
+        :return: 缓冲区内连续一段的 recarray 视图
+        """
+        with self.not_empty:
+            if not self.not_empty.wait_for(lambda: self.write_seq > self.read_seq, timeout):
+                raise Empty
+            write_seq = self.write_seq
+
+        # 消费者落后超过一圈, 被覆盖的数据直接跳过
+        if write_seq - self.read_seq > self.capacity:
+            self.overrun += write_seq - self.capacity - self.read_seq
+            self.read_seq = write_seq - self.capacity
+
+        start = self.read_seq % self.capacity
+        count = min(write_seq - self.read_seq, self.capacity - start)
+        if max_items is not None:
+            count = min(count, max_items)
+        self.read_seq += count
+        return self.array[start:start + count]
+
+    def __len__(self):
+        return min(self.write_seq - self.read_seq, self.capacity)
@@ -0,0 +1,109 @@
+import ctypes
+import sys
+
+import numpy as np
+from ctp.futures import ApiStruct
+
+# 各个 sink 共用的 tick 数值字段
+TICK_FIELDS = ('LastPrice', 'PreSettlementPrice', 'PreClosePrice', 'PreOpenInterest', 'OpenPrice',
+               'HighestPrice', 'LowestPrice', 'Volume', 'Turnover', 'OpenInterest', 'ClosePrice',
+               'SettlementPrice', 'UpperLimitPrice', 'LowerLimitPrice', 'PreDelta', 'BidPrice1', 'BidVolume1',
+               'AskPrice1', 'AskVolume1', 'AveragePrice')
+
+
+class DecodeCache(dict):
+    """
+    bytes -> str 的解码缓存, 合约代码, 日期和时间等字符串只解码一次并 intern
+    """
+
+    def __init__(self, max_size=1 << 20):
+        super().__init__()
+        self.max_size = max_size
+
+    def __missing__(self, key):
+        if len(self) >= self.max_size:
+            self.clear()
+        value = self[key] = sys.intern(key.decode())
+        return value
+
+
+class StructConverter:
+    """
+    根据结构体的 _fields_ 生成一次转换函数, 把 ctypes 结构体转换为 dict, 字符串字段自动解码
+    """
+
+    def __init__(self, struct=ApiStruct.DepthMarketData, fields=None, decode_cache=None):
+        """
+        :param struct: ApiStruct 中的结构体类型
+        :param fields: 需要提取的字段, 默认全部字段
+        :param decode_cache: 共享的 DecodeCache
+        """
+        struct_fields = dict(struct._fields_)
+        self.struct = struct
+        self.fields = tuple(fields or struct_fields)
+        unknown = [name for name in self.fields if name not in struct_fields]
+        if unknown:
+            raise ValueError('unknown fields for {}: {}'.format(struct.__name__, unknown))
+        self.string_fields = frozenset(name for name in self.fields if _is_string(struct_fields[name]))
+        self.decode_cache = decode_cache if decode_cache is not None else DecodeCache()
+        self.decode = self.decode_cache.__getitem__
+
+        self.convert = self._compile('convert', 'item', '{{{}}}', "'{0}': {1}")
+        self.columns = self._compile('columns', 'items', '{{{}}}', "'{0}': [{1} for item in items]")
+        self.values = self._compile('values', 'item', '({},)', '{1}')
+
+    def _compile(self, name, argument, template, entry):
+        entries = []
+        for field in self.fields:
+            value = '_decode(item.{})'.format(field) if field in self.string_fields else 'item.{}'.format(field)
+            entries.append(entry.format(field, value))
+        source = 'def {}({}):\n    return {}\n'.format(name, argument, template.format(', '.join(entries)))
+        namespace = {'_decode': self.decode}
+        exec(source, namespace)
+        return namespace[name]
+
+    def __call__(self, item):
+        return self.convert(item)
+
+    def convert_batch(self, batch):
+        """
+        :param batch: ctypes 结构体列表或 TickBuffer 返回的 recarray
+        :return: dict 列表
+        """
+        if isinstance(batch, np.ndarray):
+            columns = self.columns_of(batch)
+            return [dict(zip(self.fields, row)) for row in zip(*(columns[name] for name in self.fields))]
+        convert = self.convert
+        return [convert(item) for item in batch]
+
+    def columns_of(self, batch):
+        """
+        :return: {字段: 值列表} 形式的列数据
+        """
+        if not isinstance(batch, np.ndarray):
+            return self.columns(batch)
+        columns = {}
+        decode = self.decode
+        for name in self.fields:
+            values = batch[name].tolist()
+            columns[name] = [decode(value) for value in values] if name in self.string_fields else values
+        return columns
+
+
+def _is_string(ctype):
+    return ctype is ctypes.c_char or (issubclass(ctype, ctypes.Array) and ctype._type_ is ctypes.c_char)
+
+
+_decode_cache = DecodeCache()
+_converters = {}
+
+
+def converter_for(struct=ApiStruct.DepthMarketData, fields=None):
+    """
+    获取按结构体类型和字段缓存的 StructConverter, 同一进程内共享解码缓存
+    """
+    key = (struct, tuple(fields) if fields else None)
+    converter = _converters.get(key)
+    if converter is None:
+        converter = _converters[key] = StructConverter(struct, fields, decode_cache=_decode_cache)
+    return converter
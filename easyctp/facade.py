@@ -1,76 +1,197 @@
 import datetime
+import os
 
 import pymongo
-from dateutil.parser import parse
+from ctp.futures import ApiStruct
+from pymongo.errors import BulkWriteError, ConnectionFailure, ExecutionTimeout, PyMongoError, WTimeoutError
 
-from easyctp.pipeline import SaveInflux
+from easyctp.converter import TICK_FIELDS, converter_for
+from easyctp.instrument import InstrumentCache
+from easyctp.log import log
+from easyctp.metrics import REGISTRY
+from easyctp.pipeline import BuildBar, SaveInflux
 from easyctp.quotation import MarketDataApi
-from easyctp.trader import EasyTrader
+from easyctp.shard import ShardSupervisor, start_reporter
+from easyctp.shm import SharedTickPublisher
+from easyctp.utils import parse_tick_time
+from easyctp.writer import BatchWriter
+
+# mongodb 重复键错误码
+DUPLICATE_KEY = 11000
+
+_document_converter = converter_for(ApiStruct.DepthMarketData,
+                                   TICK_FIELDS + ('InstrumentID', 'ActionDay', 'TradingDay'))
+_time_converter = converter_for(ApiStruct.DepthMarketData, ('UpdateTime', 'UpdateMillisec'))
+
+
+def _run_influx_shard(index, instrument_ids, stats_queue, options):
+    """
+    分片进程入口, 负责 instrument_ids 的行情订阅和写入
+    """
+    shm_path = options.pop('shm_path', None)
+    if shm_path:
+        options['shm_path'] = '{}.{}'.format(shm_path, index)
+    spool_dir = options.pop('spool_dir', None)
+    if spool_dir:
+        options['spool_dir'] = os.path.join(spool_dir, 'shard-{}'.format(index))
+    # 主进程使用 metrics_port, 第 i 个分片使用 metrics_port + 1 + i
+    metrics_port = options.pop('metrics_port', None)
+    if metrics_port:
+        REGISTRY.serve(metrics_port + 1 + index)
+    pipe = MarketDataFacade.build_influx(instrument_ids=instrument_ids, **options)
+    start_reporter(stats_queue, index, pipe.stats, 10)
+    pipe.start()
 
 
 class MarketDataFacade:
     @classmethod
-    def to_influx(cls, user, password, broker, front, instrument_ids, influxdb_uri, worker=10, trade_front=None):
+    def to_influx(cls, user, password, broker, front, instrument_ids, influxdb_uri, worker=2, trade_front=None,
+                  shm_path=None, shards=None, split='product', metrics_port=None, spool_dir=None):
+        """
+        :param shards: 大于 1 时按 split 把合约分到多个进程采集, 见 ShardSupervisor
+        :param split: 分片方式, product 或 hash
+        :param metrics_port: 在该端口提供 prometheus 格式的 /metrics 接口, 分片时各分片依次使用之后的端口
+        :param spool_dir: influxdb 不可用时暂存数据的目录, 分片时每个分片使用其中的 shard-{index} 子目录
+        """
         if instrument_ids == 'all':
-            trader = EasyTrader()
-            trader.login(user=user, password=password, broker=broker,
-                         front=trade_front)
-            instrument_ids = trader.query_all_instruments()
+            instrument_ids = InstrumentCache().get(user=user, password=password, broker=broker,
+                                                   front=trade_front).instrument_ids()
         print('合约总数: ', len(instrument_ids))
+
+        if shards is not None and shards > 1:
+            options = dict(user=user, password=password, broker=broker, front=front, influxdb_uri=influxdb_uri,
+                           worker=worker, shm_path=shm_path, metrics_port=metrics_port, spool_dir=spool_dir)
+            supervisor = ShardSupervisor(_run_influx_shard, instrument_ids, shards, args=(options,), split=split)
+            if metrics_port:
+                REGISTRY.collector('easyctp_shard', lambda: supervisor.stats()['total'])
+                REGISTRY.serve(metrics_port)
+            supervisor.run()
+            return
+
+        if metrics_port:
+            REGISTRY.serve(metrics_port)
+
+        pipe = cls.build_influx(user=user, password=password, broker=broker, front=front,
+                                instrument_ids=instrument_ids, influxdb_uri=influxdb_uri, worker=worker,
+                                shm_path=shm_path, spool_dir=spool_dir)
+        pipe.start()
+
+    @classmethod
+    def build_influx(cls, user, password, broker, front, instrument_ids, influxdb_uri, worker=2, shm_path=None,
+                     spool_dir=None):
+        """
+        登录行情并创建 BuildBar -> SaveInflux pipeline, 返回尚未 start 的 SaveInflux
+        """
         md = MarketDataApi()
+        publisher = SharedTickPublisher(shm_path) if shm_path else None
         market_data = md.prepare(user=user, password=password, broker=broker,
                                  front=front,
-                                 instrument_ids=instrument_ids)
+                                 instrument_ids=instrument_ids,
+                                 publisher=publisher)
 
+        bar = BuildBar(market_data)
         pipe = SaveInflux(
-            market_data, worker=worker, host=influxdb_uri)
-        pipe.start()
+            bar, worker=worker, host=influxdb_uri, spool_dir=spool_dir)
+        bar.add_sink(pipe.write_bars)
+        md.session.add_sink(pipe.write_gaps)
+        return pipe
 
 
 class MarketDataExporter:
     @classmethod
     def export_to(cls, strategy, user, password, broker, front, instrument_ids, trade_front=None):
         if instrument_ids == 'all':
-            trader = EasyTrader()
-            trader.login(user=user, password=password, broker=broker,
-                         front=trade_front)
-            instrument_ids = trader.query_all_instruments()
+            instrument_ids = InstrumentCache().get(user=user, password=password, broker=broker,
+                                                   front=trade_front).instrument_ids()
         print('合约总数: ', len(instrument_ids))
         md = MarketDataApi()
         market_data = md.prepare(user=user, password=password, broker=broker,
                                  front=front,
                                  instrument_ids=instrument_ids)
 
-        for data in market_data:
-            print(data)
-            strategy.save(data)
+        # 一次取出队列中积压的全部 tick, 交给 strategy 的批量写入器
+        for batch in market_data.iter_batches():
+            strategy.save_batch(batch)
 
 
 class MongoStrategy:
-    def __init__(self, mongo_uri):
+    def __init__(self, mongo_uri, batch_size=1000, flush_interval=1.0, max_pending=500000, overflow='block',
+                 worker=1, spool_dir=None):
+        """
+        :param spool_dir: mongodb 不可用时暂存文档的目录, 恢复后批量回放, None 表示写入失败时丢弃.
+            回放是至少一次 (at-least-once) 写入: time series collection 没有唯一的 _id 索引,
+            写入中途失败或回放后 checkpoint 落盘前退出时, 已经写入的文档会再写入一次, 查询时需要按 InstrumentID 和 time 去重
+        """
         self._client = pymongo.MongoClient(host=mongo_uri)
         self._db = self._client.get_default_database()
+        self.ensure_collection()
+
+        self.writer = BatchWriter(self.insert_many, encode=self.convert_to_documents, batch_size=batch_size,
+                                  flush_interval=flush_interval, max_pending=max_pending, overflow=overflow,
+                                  worker=worker, name='mongodb', spool_dir=spool_dir, retryable=self.retryable)
+
+    def ensure_collection(self):
+        if 'history' not in self._db.list_collection_names():
+            try:
+                self._db.create_collection('history', timeseries={'timeField': 'time', 'metaField': 'InstrumentID',
+                                                                  'granularity': 'seconds'})
+            except PyMongoError as e:
+                # mongodb 5.0 以下不支持 time series collection, 使用普通集合
+                log.info('create time series collection failed, fallback to normal collection: {}'.format(e))
+        self._db.history.create_index([('InstrumentID', pymongo.ASCENDING), ('time', pymongo.ASCENDING)])
 
     def save(self, item):
+        self.writer.put([item])
+
+    def save_batch(self, batch):
+        self.writer.put(batch.copy())
+
+    def insert_many(self, documents):
+        try:
+            self._db.history.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            # insert_many 会先给文档填上 _id, 普通集合回放时已经写入的文档报重复键, 可以忽略.
+            # time series collection 不检查 _id, 不会报错, 已经写入的文档会重复
+            errors = [error for error in e.details.get('writeErrors', []) if error.get('code') != DUPLICATE_KEY]
+            if errors or e.details.get('writeConcernErrors'):
+                raise
+
+    @staticmethod
+    def retryable(error):
+        """
+        连接失败, 超时和带 RetryableWriteError 标签的错误等数据库恢复后重试, 其他错误 (文档无效等) 重试也不会成功
+        """
+        if isinstance(error, (ConnectionFailure, ExecutionTimeout, WTimeoutError)):
+            return True
+        return isinstance(error, PyMongoError) and error.has_error_label('RetryableWriteError')
+
+    def close(self):
+        self.writer.close()
+
+    @staticmethod
+    def convert_to_documents(items):
+        """
+        :param items: ctypes 结构体列表或 recarray, 转换后的值都是 python 原生类型, 可以直接编码为 bson
+        :return: 文档列表, 时间无法解析的 tick 被跳过
+        """
         now = datetime.datetime.now()
-        time_str = '{}T{}.{:03d}'.format(item.ActionDay.decode(), item.UpdateTime.decode(),
-                                         item.UpdateMillisec)
-        tick = dict(LastPrice=item.LastPrice, PreSettlementPrice=item.PreSettlementPrice,
-                    PreClosePrice=item.PreClosePrice, PreOpenInterest=item.PreOpenInterest,
-                    OpenPrice=item.OpenPrice, HighestPrice=item.HighestPrice,
-                    LowestPrice=item.LowestPrice,
-                    Volume=item.Volume,
-                    Turnover=item.Turnover, OpenInterest=item.OpenInterest, ClosePrice=item.ClosePrice,
-                    SettlementPrice=item.SettlementPrice, UpperLimitPrice=item.UpperLimitPrice,
-                    LowerLimitPrice=item.LowerLimitPrice,
-                    PreDelta=item.PreDelta,
-                    BidPrice1=item.BidPrice1, BidVolume1=item.BidVolume1, AskPrice1=item.AskPrice1,
-                    AskVolume1=item.AskVolume1, AveragePrice=item.AveragePrice,
-                    InstrumentID=item.InstrumentID.decode(),
-                    ActionDay=item.ActionDay.decode(),
-                    TradingDay=item.TradingDay.decode(),
-                    time_str=time_str,
-                    time=parse(time_str),
-                    created_at=now, created_date=now.strftime('%Y%m%d'))
-
-        self._db.history.insert(tick)
+        created_date = now.strftime('%Y%m%d')
+        documents = _document_converter.convert_batch(items)
+        times = _time_converter.columns_of(items)
+        valid = []
+        for tick, update_time, millisec in zip(documents, times['UpdateTime'], times['UpdateMillisec']):
+            action_day = tick['ActionDay']
+            # 部分交易所夜盘的 ActionDay 为空
+            if len(action_day) != 8 or len(update_time) != 8:
+                continue
+            try:
+                tick['time'] = parse_tick_time(action_day, update_time, millisec)
+            except ValueError:
+                continue
+            tick['time_str'] = '{}T{}.{:03d}'.format(action_day, update_time, millisec)
+            tick['created_at'] = now
+            tick['created_date'] = created_date
+            valid.append(tick)
+        if len(valid) < len(documents):
+            log.warning('skip {} ticks with invalid ActionDay/UpdateTime'.format(len(documents) - len(valid)))
+        return valid
@@ -0,0 +1,182 @@
+import calendar
+import gzip
+import time
+from operator import attrgetter
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+from easyctp.converter import TICK_FIELDS
+from easyctp.validator import UTC_OFFSET_MS
+
+INFLUX_FIELDS = TICK_FIELDS
+
+INTEGER_FIELDS = ('Volume', 'BidVolume1', 'AskVolume1')
+
+# 盘中基本不变的字段, 按合约缓存格式化结果, 值变化时才重新格式化
+STATIC_FIELDS = ('PreSettlementPrice', 'PreClosePrice', 'PreOpenInterest', 'OpenPrice', 'ClosePrice',
+                 'SettlementPrice', 'UpperLimitPrice', 'LowerLimitPrice', 'PreDelta')
+
+TIME_FIELDS = ('InstrumentID', 'TradingDay', 'UpdateTime', 'UpdateMillisec')
+
+
+class LineProtocolEncoder:
+    """
+    直接把 tick 编码为 influxdb line protocol, 时间精度为毫秒.
+    每个合约的 measurement,tag 前缀, 不变字段的格式化结果和每个交易日的起始时间戳都只计算一次
+    """
+
+    def __init__(self, measurement='ctp', fields=INFLUX_FIELDS):
+        self.measurement = measurement
+        self.dynamic_fields = tuple(name for name in fields if name not in STATIC_FIELDS)
+        self.static_fields = tuple(name for name in fields if name in STATIC_FIELDS)
+        self.fields = self.dynamic_fields + self.static_fields
+        self._templates = {name: '{}={}i' if name in INTEGER_FIELDS else '{}={!r}' for name in self.fields}
+        self._template = ','.join(self._templates[name].replace('{}', name, 1) for name in self.dynamic_fields)
+        self._getter = attrgetter(*(self.fields + TIME_FIELDS))
+        self._prefixes = {}
+        self._statics = {}
+        self._days = {}
+        self._seconds = {}
+
+    def prefix(self, instrument_id):
+        try:
+            return self._prefixes[instrument_id]
+        except KeyError:
+            tag = instrument_id.decode() if isinstance(instrument_id, bytes) else instrument_id
+            tag = tag.replace(',', r'\,').replace('=', r'\=').replace(' ', r'\ ')
+            prefix = self._prefixes[instrument_id] = '{},instrument_id={} '.format(self.measurement, tag)
+            return prefix
+
+    def timestamp(self, trading_day, update_time, millisec):
+        try:
+            day = self._days[trading_day]
+        except KeyError:
+            day = self._days[trading_day] = calendar.timegm(time.strptime(trading_day.decode(), '%Y%m%d')) * 1000
+
+        try:
+            seconds = self._seconds[update_time]
+        except KeyError:
+            seconds = self._seconds[update_time] = (
+                int(update_time[0:2]) * 3600 + int(update_time[3:5]) * 60 + int(update_time[6:8])) * 1000
+        return day + seconds + millisec - UTC_OFFSET_MS
+
+    def rows(self, batch):
+        """
+        :param batch: ctypes 结构体列表或 TickBuffer 返回的 recarray
+        :return: 每行为 fields + (InstrumentID, TradingDay, UpdateTime, UpdateMillisec) 的元组
+        """
+        if isinstance(batch, np.ndarray):
+            return zip(*(batch[name].tolist() for name in self.fields + TIME_FIELDS))
+        return map(self._getter, batch)
+
+    def encode(self, item):
+        return self.encode_batch([item])[0]
+
+    def encode_batch(self, batch):
+        lines = []
+        append = lines.append
+        template = self._template
+        prefixes = self._prefixes
+        statics = self._statics
+        dynamic_size = len(self.dynamic_fields)
+        size = len(self.fields)
+        for row in self.rows(batch):
+            instrument_id, trading_day, update_time, millisec = row[size:]
+            try:
+                timestamp = self.timestamp(trading_day, update_time, millisec)
+            except ValueError:
+                # 时间格式错误的 tick 无法写入, 应由 FilterInvalidItem 提前过滤
+                continue
+            prefix = prefixes.get(instrument_id) or self.prefix(instrument_id)
+
+            values = row[:dynamic_size]
+            fields = template.format(*values)
+            if '=nan' in fields or '=inf' in fields or '=-inf' in fields:
+                fields = self._encode_fields(self.dynamic_fields, values)
+
+            # nan 与自身不相等, 先统一替换为 None 再与缓存比较
+            static = tuple([None if value != value else value for value in row[dynamic_size:size]])
+            cached = statics.get(instrument_id)
+            if cached is None or cached[0] != static:
+                cached = statics[instrument_id] = (static, self._encode_fields(self.static_fields, static))
+            if cached[1]:
+                fields = '{},{}'.format(fields, cached[1]) if fields else cached[1]
+            append('{}{} {}'.format(prefix, fields, timestamp).encode())
+        return lines
+
+    def encode_bars(self, bars):
+        """
+        :param bars: BarAggregator 生成的 bar, 写入 {measurement}_bar_{interval},
+            不使用旧版 cq 写入的 {measurement}_{interval}, 避免两种数据混在一起
+        """
+        lines = []
+        for bar in bars:
+            timestamp = self.timestamp(bar['trading_day'].encode(), bar['start'].encode(), 0)
+            lines.append('{}_bar_{},instrument_id={} open={!r},high={!r},low={!r},close={!r},volume={}i,turnover={!r},'
+                         'open_interest={!r},count={}i {}'.format(
+                             self.measurement, bar['interval'], bar['instrument_id'], bar['open'], bar['high'],
+                             bar['low'], bar['close'], bar['volume'], bar['turnover'], bar['open_interest'],
+                             bar['count'], timestamp).encode())
+        return lines
+
+    def encode_gaps(self, gaps):
+        """
+        :param gaps: SessionSupervisor 记录的断线缺口, 写入 {measurement}_gap, 时间为重连后第一条 tick 的时间
+        """
+        lines = []
+        for gap in gaps:
+            update_time, millisec = gap['first_time'].split('.')
+            timestamp = self.timestamp(gap['trading_day'].encode(), update_time.encode(), int(millisec))
+            fields = 'first_time="{}",reason={}i'.format(gap['first_time'], gap['reason'])
+            if gap['last_time'] is not None:
+                fields = 'last_time="{}",'.format(gap['last_time']) + fields
+            lines.append('{}_gap,instrument_id={} {} {}'.format(
+                self.measurement, gap['instrument_id'], fields, timestamp).encode())
+        return lines
+
+    def _encode_fields(self, names, values):
+        # line protocol 不支持 nan 和 inf, 直接跳过这些字段
+        templates = self._templates
+        return ','.join(templates[name].format(name, value) for name, value in zip(names, values)
+                        if value is not None and value == value and value not in (float('inf'), float('-inf')))
+
+
+class InfluxWriter:
+    """
+    基于 keep-alive 连接池的 influxdb http 写入客户端, 可选 gzip 压缩
+    """
+
+    def __init__(self, host='localhost', port=8086, username='root', password='root', database=None,
+                 compress=True, timeout=30, pool_size=10):
+        self.url = 'http://{}:{}/write'.format(host, port)
+        self.params = {'db': database, 'precision': 'ms'}
+        self.compress = compress
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        self.session.headers['Content-Type'] = 'application/octet-stream'
+        if compress:
+            self.session.headers['Content-Encoding'] = 'gzip'
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+
+    def write(self, lines):
+        body = b'\n'.join(lines)
+        if self.compress:
+            body = gzip.compress(body, compresslevel=1)
+        response = self.session.post(self.url, params=self.params, data=body, timeout=self.timeout)
+        if response.status_code != 204:
+            raise requests.HTTPError('influxdb write error {}: {}'.format(response.status_code, response.text),
+                                     response=response)
+        return len(body)
+
+    @staticmethod
+    def retryable(error):
+        """
+        400 表示数据格式错误或部分写入, 重试也不会成功, 其他错误 (连接失败, 超时, 5xx 等) 等数据库恢复后重试
+        """
+        response = getattr(error, 'response', None)
+        return response is None or response.status_code != 400
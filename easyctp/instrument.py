@@ -0,0 +1,159 @@
+import datetime
+import os
+
+import numpy as np
+from ctp.futures import ApiStruct
+
+from easyctp.buffer import struct_dtype, to_array
+from easyctp.log import log
+from easyctp.trader import EasyTrader
+
+INSTRUMENT_DTYPE = struct_dtype(ApiStruct.Instrument)
+DEFAULT_ROOT = os.path.join(os.path.expanduser('~'), '.easyctp', 'instruments')
+
+# 夜盘开始后行情和交易都已经属于下一个交易日
+NIGHT_SESSION_HOUR = 18
+
+
+def current_trading_day(now=None):
+    """
+    按本地时间推算当前交易日: 18 点之后算下一个工作日, 周末算下周一. 不考虑节假日,
+    节假日前后推算错误时只会导致缓存未命中, 重新从交易前置下载
+    :return: 类似 '20170104' 的字符串
+    """
+    now = now or datetime.datetime.now()
+    day = now.date()
+    if now.hour >= NIGHT_SESSION_HOUR:
+        day += datetime.timedelta(days=1)
+    while day.weekday() >= 5:
+        day += datetime.timedelta(days=1)
+    return day.strftime('%Y%m%d')
+
+
+class InstrumentTable:
+    """
+    一个交易日的全部合约信息, 保存为与 ApiStruct.Instrument 内存布局相同的 recarray,
+    按合约代码 O(1) 查找, 按品种, 交易所和到期日批量筛选
+    """
+
+    def __init__(self, records, trading_day=None):
+        self.records = records.view(np.recarray)
+        self.trading_day = trading_day
+        self.index = {instrument_id: i for i, instrument_id in enumerate(self.records.InstrumentID.tolist())}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, instrument_id):
+        return EasyTrader.auto_encode_bytes(instrument_id) in self.index
+
+    def __getitem__(self, instrument_id):
+        """
+        :return: ApiStruct.Instrument 副本
+        """
+        i = self.index[EasyTrader.auto_encode_bytes(instrument_id)]
+        return ApiStruct.Instrument.from_buffer_copy(self.records, i * self.records.dtype.itemsize)
+
+    def instrument_ids(self):
+        """
+        :return: 合约代码集合, 与 EasyTrader.query_all_instruments 相同
+        """
+        return set(self.index)
+
+    def by_product(self, *product_ids):
+        return self._select('ProductID', product_ids)
+
+    def by_exchange(self, *exchange_ids):
+        return self._select('ExchangeID', exchange_ids)
+
+    def by_expiry(self, start=None, end=None):
+        """
+        :param start: 到期日下限 (含), 类似 '20170104'
+        :param end: 到期日上限 (含)
+        """
+        expire = self.records.ExpireDate
+        mask = np.ones(len(expire), dtype=bool)
+        if start is not None:
+            mask &= expire >= EasyTrader.auto_encode_bytes(start)
+        if end is not None:
+            mask &= expire <= EasyTrader.auto_encode_bytes(end)
+        return self.records[mask]
+
+    def _select(self, field, values):
+        values = [EasyTrader.auto_encode_bytes(value) for value in values]
+        return self.records[np.isin(self.records[field], values)]
+
+
+class InstrumentCache:
+    """
+    按交易日缓存完整的合约信息, 同一交易日内重启时直接读取本地文件, 不再登录交易前置下载
+    """
+
+    def __init__(self, root=DEFAULT_ROOT, keep_days=5):
+        """
+        :param root: 缓存目录
+        :param keep_days: 保留最近几个交易日的缓存文件
+        """
+        self.root = root
+        self.keep_days = keep_days
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, trading_day):
+        return os.path.join(self.root, 'instruments-{}.npy'.format(trading_day))
+
+    def load(self, trading_day=None):
+        """
+        :return: InstrumentTable, 没有该交易日的缓存或格式不一致时返回 None
+        """
+        trading_day = trading_day or current_trading_day()
+        path = self.path(trading_day)
+        if not os.path.exists(path):
+            return None
+        try:
+            records = np.load(path)
+        except (OSError, ValueError) as e:
+            log.warning('合约缓存 {} 读取失败: {}'.format(path, e))
+            return None
+        if records.dtype != INSTRUMENT_DTYPE:
+            log.warning('合约缓存 {} 与当前 ApiStruct.Instrument 结构不一致, 忽略'.format(path))
+            return None
+        return InstrumentTable(records, trading_day)
+
+    def save(self, trading_day, instruments):
+        """
+        :param instruments: ApiStruct.Instrument 列表
+        """
+        records = to_array(list(instruments), INSTRUMENT_DTYPE)
+        path = self.path(trading_day)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, records)
+        os.replace(tmp_path, path)
+        self._cleanup()
+        return InstrumentTable(records, trading_day)
+
+    def _cleanup(self):
+        files = sorted(name for name in os.listdir(self.root)
+                       if name.startswith('instruments-') and name.endswith('.npy'))
+        for name in files[:-self.keep_days]:
+            os.remove(os.path.join(self.root, name))
+
+    def get(self, user, password, broker, front, trading_day=None, timeout=10):
+        """
+        优先使用本地缓存, 缓存过期时登录交易前置下载全部合约并保存
+        :param front: 交易服务器地址
+        :return: InstrumentTable
+        """
+        trading_day = trading_day or current_trading_day()
+        table = self.load(trading_day)
+        if table is not None:
+            log.info('使用交易日 {} 的合约缓存, 合约数 {}'.format(trading_day, len(table)))
+            return table
+
+        trader = EasyTrader()
+        trader.login(user=user, password=password, broker=broker, front=front)
+        instruments = trader.scheduler.query_instruments(timeout=timeout).result()
+        # 仍然按本地推算的交易日保存, 节假日前后与前置返回的交易日不同时下次启动也能命中
+        log.info('下载合约信息, 本地交易日 {} 前置交易日 {} 合约数 {}'.format(
+            trading_day, trader.trading_day, len(instruments)))
+        return self.save(trading_day, instruments)
@@ -0,0 +1,268 @@
+import bisect
+import itertools
+import threading
+import time
+import weakref
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from easyctp.log import log
+from easyctp.validator import DAY_MS, UTC_OFFSET_MS, clock_ms
+
+# 交易所时间到本地接收时间的延迟, 单位毫秒
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+# pipeline 每批处理耗时, 单位秒
+BATCH_BUCKETS_SECONDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+# 每 64 条 tick 计算一次延迟, 摊到每条 tick 的开销很小
+LATENCY_SAMPLE_MASK = 63
+
+
+_instance_ids = itertools.count()
+
+
+def instance_id():
+    """
+    进程内递增的实例编号, 作为 id 标签区分同一类型的多个实例, 每个实例的指标只由自己的线程更新
+    """
+    return str(next(_instance_ids))
+
+
+class Counter:
+    """
+    计数器, inc 加锁, 可以在多个线程中调用.
+    热路径上可以直接 counter.value += n, 但只限于通过 id 标签独占该计数器的单个线程
+    """
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count', 'lock')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+def exchange_latency_ms(update_time, millisec, now=None):
+    """
+    交易所时间 (UpdateTime, 北京时间) 到本地时钟的延迟, 跨零点时取最近的一侧
+    """
+    now_ms = int((time.time() if now is None else now) * 1000 + UTC_OFFSET_MS) % DAY_MS
+    delay = now_ms - clock_ms(update_time) - millisec
+    return (delay + DAY_MS // 2) % DAY_MS - DAY_MS // 2
+
+
+class MetricsRegistry:
+    """
+    进程内的指标集合: counter 和 histogram 由热路径直接更新, gauge 和 collector 在导出时才调用,
+    通过 serve() 以 prometheus 文本格式提供 http 接口, 或通过 start_dump() 定期输出到日志
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.gauges = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def counter(self, metric, **labels):
+        return self._get(metric, labels, Counter)
+
+    def histogram(self, metric, buckets, **labels):
+        return self._get(metric, labels, lambda: Histogram(buckets))
+
+    def _get(self, metric, labels, factory):
+        key = (metric, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(key, factory())
+        return metric
+
+    def remove(self, metric, **labels):
+        """
+        移除 counter 或 histogram, 用于回收对象自己的 id 标签下的指标
+        """
+        with self.lock:
+            self.metrics.pop((metric, tuple(sorted(labels.items()))), None)
+
+    def gauge(self, metric, func, **labels):
+        """
+        :param func: 导出时调用, 返回当前值
+        """
+        self.gauges[(metric, tuple(sorted(labels.items())))] = _ref(func)
+
+    def collector(self, metric, func, key_label=None, **labels):
+        """
+        :param func: 导出时调用, 返回 {key: 数值}, 非数值的项忽略
+        :param key_label: 为 None 时每个 key 导出为 {metric}_{key}, 否则导出为 metric{key_label="key"}
+        """
+        with self.lock:
+            self.collectors.append((metric, _ref(func), key_label, tuple(sorted(labels.items()))))
+
+    def samples(self):
+        """
+        :return: [(name, labels, value)], histogram 展开为 _bucket/_sum/_count
+        """
+        samples = []
+        for (name, labels), metric in list(self.metrics.items()):
+            if isinstance(metric, Counter):
+                samples.append((name, labels, metric.value))
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + ('+Inf',), metric.counts):
+                cumulative += count
+                samples.append((name + '_bucket', labels + (('le', str(bound)),), cumulative))
+            samples.append((name + '_sum', labels, metric.sum))
+            samples.append((name + '_count', labels, metric.count))
+
+        for key, ref in list(self.gauges.items()):
+            func = ref()
+            if func is None:
+                self.gauges.pop(key, None)
+                continue
+            value = self._call(func)
+            if value is not None:
+                samples.append(key + (value,))
+
+        dead = []
+        for collector in list(self.collectors):
+            name, ref, key_label, labels = collector
+            func = ref()
+            if func is None:
+                dead.append(collector)
+                continue
+            for key, value in (self._call(func) or {}).items():
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    continue
+                if key_label is None:
+                    samples.append(('{}_{}'.format(name, key), labels, value))
+                else:
+                    samples.append((name, labels + ((key_label, str(key)),), value))
+        if dead:
+            # 对象被回收后移除对应的 collector
+            with self.lock:
+                self.collectors = [c for c in self.collectors if c not in dead]
+        return samples
+
+    @staticmethod
+    def _call(func):
+        try:
+            return func()
+        except Exception as e:
+            log.warning('metrics collect error: {}'.format(e))
+            return None
+
+    def render(self):
+        lines = []
+        for name, labels, value in self.samples():
+            if labels:
+                label_text = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+                lines.append('{}{{{}}} {}'.format(name, label_text, value))
+            else:
+                lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=9108, host='127.0.0.1'):
+        """
+        在后台线程中提供 http://host:port/metrics
+        """
+        server = MetricsServer((host, port), self)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        log.info('metrics 接口 http://{}:{}/metrics'.format(host, server.server_address[1]))
+        return server
+
+    def start_dump(self, interval=60):
+        """
+        每 interval 秒把所有非 histogram 桶的指标输出到日志
+        """
+
+        def run():
+            while True:
+                time.sleep(interval)
+                values = ['{}{}={}'.format(name, dict(labels) if labels else '', value)
+                          for name, labels, value in self.samples() if not name.endswith('_bucket')]
+                log.info('metrics: {}'.format(', '.join(values)))
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, registry):
+        super().__init__(address, MetricsHandler)
+        self.registry = registry
+
+
+def _ref(func):
+    # 绑定方法只保存弱引用, 不影响对象回收
+    if hasattr(func, '__self__') and func.__self__ is not None and not isinstance(func.__self__, type):
+        try:
+            return weakref.WeakMethod(func)
+        except TypeError:
+            pass
+    return lambda: func
+
+
+class StageMetrics:
+    """
+    pipeline 单个 stage 的输入/输出条数和每批处理耗时, 输入减输出即为被过滤的条数.
+    同一个 stage 的多个实例通过 id 标签区分, 各自的计数只在自己的线程中更新, 实例被回收后移除对应的指标
+    """
+    METRICS = ('easyctp_stage_received_total', 'easyctp_stage_emitted_total', 'easyctp_stage_batch_seconds')
+
+    def __init__(self, stage, registry=None, instance=None):
+        """
+        :param instance: id 标签, 默认使用 instance_id()
+        """
+        registry = registry or REGISTRY
+        self.instance = instance if instance is not None else instance_id()
+        labels = dict(stage=stage, id=self.instance)
+        self.received = registry.counter('easyctp_stage_received_total', **labels)
+        self.emitted = registry.counter('easyctp_stage_emitted_total', **labels)
+        self.batch_seconds = registry.histogram('easyctp_stage_batch_seconds', BATCH_BUCKETS_SECONDS, **labels)
+        weakref.finalize(self, _remove, registry, self.METRICS, labels)
+
+
+def _remove(registry, metrics, labels):
+    for metric in metrics:
+        registry.remove(metric, **labels)
+
+
+REGISTRY = MetricsRegistry()
@@ -1,16 +1,30 @@
+import os
 import threading
-from queue import Queue, Empty
+import time
+from queue import Empty
 from urllib.parse import urlparse
 
 import influxdb
 from ctp.futures import ApiStruct
 
+from easyctp.bar import BarAggregator
+from easyctp.buffer import DEPTH_MARKET_DATA_DTYPE
+from easyctp.converter import TICK_FIELDS, converter_for
+from easyctp.influx import InfluxWriter, LineProtocolEncoder
 from easyctp.log import log
+from easyctp.metrics import REGISTRY, StageMetrics
+from easyctp.store import TickStore
+from easyctp.validator import TickValidator
+from easyctp.writer import BatchWriter
+
+_tick_converter = converter_for(ApiStruct.DepthMarketData, TICK_FIELDS)
+_decode = _tick_converter.decode
 
 
 class BasePipeline:
     def __init__(self, queue):
         self.queue = queue
+        self.metrics = StageMetrics(type(self).__name__)
 
     def __next__(self):
         return self.get()
@@ -18,25 +32,73 @@ class BasePipeline:
     def __iter__(self):
         return self
 
-    def start(self):
+    def start(self, batch=False, max_items=None):
+        if not batch:
+            while True:
+                self.__next__()
         while True:
-            self.__next__()
+            self.get_batch(max_items)
 
     def get(self):
+        metrics = self.metrics
         while True:
             item = self.queue.get()
+            metrics.received.value += 1
 
             convert_item = self._process_item(item)
             if convert_item is not None:
+                metrics.emitted.value += 1
                 return convert_item
 
+    def get_batch(self, max_items=None, max_wait=None):
+        """
+        从上游一次取出一批数据并经过 _process_batch 处理, 上游超时时返回空批次
+        """
+        while True:
+            if hasattr(self.queue, 'get_batch'):
+                batch = self.queue.get_batch(max_items, max_wait)
+            else:
+                try:
+                    batch = [self.queue.get(timeout=max_wait)]
+                except Empty:
+                    batch = []
+            if len(batch) == 0:
+                return batch
+
+            metrics = self.metrics
+            metrics.received.value += len(batch)
+            start = time.perf_counter()
+            convert_batch = self._process_batch(batch)
+            metrics.batch_seconds.observe(time.perf_counter() - start)
+            metrics.emitted.value += len(convert_batch)
+            if len(convert_batch) > 0:
+                return convert_batch
+
+    def iter_batches(self, max_items=None, max_wait=None):
+        while True:
+            batch = self.get_batch(max_items, max_wait)
+            if len(batch) == 0:
+                return
+            yield batch
+
     def _process_item(self, item):
         return item
 
+    def _process_batch(self, batch):
+        process_item = self._process_item
+        return [convert_item for convert_item in map(process_item, batch) if convert_item is not None]
+
 
 class ConvertDict(BasePipeline):
+    def __init__(self, queue, fields=None):
+        super().__init__(queue)
+        self.converter = converter_for(ApiStruct.DepthMarketData, fields)
+
     def _process_item(self, item):
-        return dict(item)
+        return self.converter(item)
+
+    def _process_batch(self, batch):
+        return self.converter.convert_batch(batch)
 
 
 class SaveMysql(BasePipeline):
@@ -48,21 +110,58 @@ class SaveMongo(BasePipeline):
 
 
 class FilterInvalidItem(BasePipeline):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, log_interval=10, **kwargs):
         super().__init__(*args, **kwargs)
+        self.validator = TickValidator(log_interval=log_interval)
+        REGISTRY.collector('easyctp_ticks_rejected_total', self.rejected, key_label='reason', id=self.metrics.instance)
+        REGISTRY.collector('easyctp_ticks_sanitized_total', self.sanitized, key_label='field', id=self.metrics.instance)
+
+    def rejected(self):
+        return dict(self.validator.rejected)
+
+    def sanitized(self):
+        return dict(self.validator.sanitized)
 
     def _process_item(self, item: ApiStruct.DepthMarketData):
-        if len(item.UpdateTime) != 8:
-            log.warn('invalid update time, item: {} skipping'.format(simple(item)))
-            return None
-        if len(item.ActionDay) != 8:
-            log.warn('invalid time, item: {} skipping'.format(simple(item)))
-            return None
-        if len(item.InstrumentID) <= 2:
-            log.warn('invalid instrument id, item: {} skipping'.format(simple(item)))
-            return None
+        if self.validator.validate_item(item):
+            return self.validator.sanitize_item(item)
+        return None
+
+    def _process_batch(self, batch):
+        return self.validator.filter(batch)
+
+
+class BuildBar(BasePipeline):
+    """
+    在进程内生成 bar, tick 原样传给下游, 完成的 bar 交给通过 add_sink 注册的 sink
+    """
+
+    def __init__(self, queue, intervals=('1m', '5m', '15m', '30m', '1h', '1d'), sinks=None, grace_ms=500,
+                 advance_interval=0.2):
+        super().__init__(queue)
+        self.aggregator = BarAggregator(intervals=intervals, grace_ms=grace_ms, sinks=sinks)
+        self.advance_interval = advance_interval
+        threading.Thread(target=self.advance_worker, daemon=True).start()
+
+    def add_sink(self, sink):
+        self.aggregator.add_sink(sink)
+
+    def advance_worker(self):
+        while True:
+            time.sleep(self.advance_interval)
+            try:
+                self.aggregator.advance()
+            except Exception as e:
+                log.error('bar advance unexpected error: {}'.format(e))
+
+    def _process_item(self, item):
+        self.aggregator.update(item)
         return item
 
+    def _process_batch(self, batch):
+        self.aggregator.update_batch(batch)
+        return batch
+
 
 class SaveInflux(BasePipeline):
     CQ_TEMPLATE = '''
@@ -72,13 +171,27 @@ class SaveInflux(BasePipeline):
               FROM ctp{previous_interval}
               GROUP BY time({interval}), instrument_id
         END'''
+    DROP_CQ_TEMPLATE = 'DROP CONTINUOUS QUERY "{db}_ctp_{interval}" ON "{db}"'
 
-    def __init__(self, queue, worker=10, batch_size=20,
+    def __init__(self, queue, worker=2, batch_size=5000, batch_bytes=1 << 20,
                  host='localhost',
                  port=8086,
                  username='root',
                  password='root',
-                 database=None):
+                 database=None,
+                 compress=True,
+                 flush_interval=1.0,
+                 max_pending=500000,
+                 overflow='block',
+                 spill_dir=None,
+                 continuous_query=False,
+                 spool_dir=None,
+                 drop_continuous_query=False):
+        """
+        :param continuous_query: 创建旧版本使用的 cq, bar 默认由 BuildBar 在进程内生成
+        :param spool_dir: 数据库不可用时把已编码的数据压缩保存到该目录, 恢复后批量回放, None 表示写入失败时丢弃
+        :param drop_continuous_query: 删除旧版本创建的 cq, 默认只在存在时打印警告
+        """
         super().__init__(queue)
         if 'influxdb://' in host:
             args = urlparse(host)
@@ -95,71 +208,229 @@ class SaveInflux(BasePipeline):
         self.client.create_database(database)
         self.client.switch_database(database)
 
-        # create cq if not exists
+        self.encoder = LineProtocolEncoder()
+        self.writer = InfluxWriter(host=host, port=port, username=username, password=password, database=database,
+                                   compress=compress, pool_size=worker)
+
+        # bar 默认由 BuildBar 在进程内生成, 只有显式开启时才创建 cq, 旧版本创建的 cq 只有显式要求时才删除
         intervals = ['1m', '5m', '15m', '30m', '1h', '1d']
-        for i, interval in enumerate(intervals):
-            previous_interval = '_' + intervals[i - 1] if i != 0 else ''
-            cq = self.CQ_TEMPLATE.format(previous_interval=previous_interval, interval=interval, db=database)
-            self.client.query(cq)
+        if continuous_query:
+            for i, interval in enumerate(intervals):
+                previous_interval = '_' + intervals[i - 1] if i != 0 else ''
+                cq = self.CQ_TEMPLATE.format(previous_interval=previous_interval, interval=interval, db=database)
+                self.client.query(cq)
+        elif drop_continuous_query:
+            for interval in intervals:
+                try:
+                    self.client.query(self.DROP_CQ_TEMPLATE.format(interval=interval, db=database))
+                except influxdb.exceptions.InfluxDBClientError as e:
+                    log.warning('drop continuous query {}_ctp_{} failed: {}'.format(database, interval, e))
+        else:
+            self._warn_continuous_query(database, intervals)
+
+        # spool 中保存编码后的 line protocol, 回放时直接拼接发送
+        spool = dict(spool_dir=spool_dir, spool_codec='lines', retryable=self.writer.retryable)
+        self.batch_writer = BatchWriter(self.writer.write, encode=self.encoder.encode_batch,
+                                        batch_size=batch_size, batch_bytes=batch_bytes,
+                                        flush_interval=flush_interval, max_pending=max_pending,
+                                        overflow=overflow, spill_dir=spill_dir, worker=worker,
+                                        name='influxdb', **spool)
+        self.bar_writer = BatchWriter(self.writer.write, encode=self.encoder.encode_bars,
+                                      batch_size=batch_size, flush_interval=flush_interval,
+                                      name='influxdb_bar', **spool)
+        self.gap_writer = BatchWriter(self.writer.write, encode=self.encoder.encode_gaps,
+                                      batch_size=batch_size, flush_interval=flush_interval,
+                                      name='influxdb_gap', **spool)
+
+    def _warn_continuous_query(self, database, intervals):
+        names = {'{}_ctp_{}'.format(database, interval) for interval in intervals}
+        try:
+            points = self.client.query('SHOW CONTINUOUS QUERIES').get_points(measurement=database)
+        except influxdb.exceptions.InfluxDBClientError as e:
+            log.warning('show continuous queries failed: {}'.format(e))
+            return
+        existing = sorted(names & {point['name'] for point in points})
+        if existing:
+            log.warning('continuous queries {} still write ctp_<interval> alongside in-process bars, '
+                        'pass drop_continuous_query=True to drop them'.format(existing))
 
-        self.batch_queue = Queue()
+    def stats(self):
+        return self.batch_writer.stats()
 
-        for _ in range(worker):
-            threading.Thread(target=self.batch_insert_worker, args=(batch_size,)).start()
+    def write_bars(self, bars):
+        self.bar_writer.put(bars)
 
-    def batch_insert_worker(self, batch_size):
-        points = []
-        while True:
-            try:
-                try:
-                    item = self.batch_queue.get(timeout=0.5)
-                except Empty:
-                    if len(points) > 0:
-                        self.client.write_points(points)
-                    continue
-                point = self.convert_to_point(item)
-                points.append(point)
-
-                if len(points) < batch_size:
-                    continue
-                self.flush_points(points)
-            except Exception as e:
-                log.error('batch insert unexpected error: {}'.format(e))
+    def write_gaps(self, gaps):
+        self.gap_writer.put(gaps)
 
     @staticmethod
     def convert_to_point(item):
         return {
             'measurement': 'ctp',
             'tags': {
-                'instrument_id': item.InstrumentID.decode(),
+                'instrument_id': _decode(item.InstrumentID),
             },
-            'fields': dict(LastPrice=item.LastPrice, PreSettlementPrice=item.PreSettlementPrice,
-                           PreClosePrice=item.PreClosePrice, PreOpenInterest=item.PreOpenInterest,
-                           OpenPrice=item.OpenPrice, HighestPrice=item.HighestPrice,
-                           LowestPrice=item.LowestPrice,
-                           Volume=item.Volume,
-                           Turnover=item.Turnover, OpenInterest=item.OpenInterest, ClosePrice=item.ClosePrice,
-                           SettlementPrice=item.SettlementPrice, UpperLimitPrice=item.UpperLimitPrice,
-                           LowerLimitPrice=item.LowerLimitPrice,
-                           PreDelta=item.PreDelta,
-                           BidPrice1=item.BidPrice1, BidVolume1=item.BidVolume1, AskPrice1=item.AskPrice1,
-                           AskVolume1=item.AskVolume1, AveragePrice=item.AveragePrice),
-            'time': '{}T{}.{:03d}+08:00'.format(item.TradingDay.decode(), item.UpdateTime.decode(),
+            'fields': _tick_converter(item),
+            'time': '{}T{}.{:03d}+08:00'.format(_decode(item.TradingDay), _decode(item.UpdateTime),
                                                 item.UpdateMillisec)
         }
 
-    def flush_points(self, points):
-        try:
-            self.client.write_points(points)
-        except Exception as e:
-            log.error(
-                'influxdb client write points error: {}, points: {}'.format(e, points))
-        del points[:]
+    def _process_item(self, item):
+        self.batch_writer.put([item])
+        return item
+
+    def _process_batch(self, batch):
+        # 来自 BufferedMarketData 的批次是环形缓冲区的视图, 交给后台线程前需要复制
+        self.batch_writer.put(batch.copy())
+        return batch
+
+
+class SaveTickStore(BasePipeline):
+    def __init__(self, queue, root, buffer_size=1 << 16, fsync=True, flush_interval=1.0, max_open_files=256):
+        super().__init__(queue)
+        self.store = TickStore(root, buffer_size=buffer_size, fsync=fsync, flush_interval=flush_interval,
+                               max_open_files=max_open_files)
 
     def _process_item(self, item):
-        self.batch_queue.put(item)
+        self.store.save(item)
         return item
 
+    def _process_batch(self, batch):
+        self.store.save_batch(batch)
+        return batch
+
+
+class SaveParquet(BasePipeline):
+    """
+    按交易日保存为 parquet 数据集, 目录为 root/TradingDay/part-00000.parquet.
+    每次刷新写出一个完整关闭的 part 文件 (先写临时文件再改名), 当天的数据随时可以用 pq.read_table(目录) 读取,
+    进程异常退出最多丢失尚未刷新的缓冲.
+    part 文件数量由 rows_per_part 和 flush_interval 决定, flush_interval 越小丢失的数据越少, 但小文件越多.
+    需要安装 pyarrow (pip install easyctp[parquet]), 只在创建 SaveParquet 时导入
+    """
+
+    def __init__(self, queue, root, rows_per_part=1000000, row_group_size=100000, compression='snappy', fields=None,
+                 flush_interval=600.0):
+        """
+        :param root: parquet 数据集根目录
+        :param rows_per_part: 累积多少行写出一个 part 文件
+        :param row_group_size: part 文件内每个 row group 的最大行数
+        :param fields: 需要保存的字段, 默认保存 DepthMarketData 的所有字段
+        :param flush_interval: 缓冲中的数据最多保留多少秒就写出, 默认 10 分钟, 一个交易日最多几十个按时间写出的 part
+        """
+        import pyarrow as pa
+
+        super().__init__(queue)
+        self.root = root
+        self.rows_per_part = rows_per_part
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.flush_interval = flush_interval
+        self.fields = tuple(fields or DEPTH_MARKET_DATA_DTYPE.names)
+        if 'TradingDay' not in self.fields:
+            raise ValueError('fields must contain TradingDay')
+        self.schema = pa.schema([
+            (name, pa.dictionary(pa.int32(), pa.string()) if name == 'InstrumentID'
+             else pa.string() if DEPTH_MARKET_DATA_DTYPE[name].kind == 'S'
+             else pa.from_numpy_dtype(DEPTH_MARKET_DATA_DTYPE[name]))
+            for name in self.fields])
+        self.converter = converter_for(ApiStruct.DepthMarketData, self.fields)
+        self._day_index = self.fields.index('TradingDay')
+        os.makedirs(root, exist_ok=True)
+
+        self.trading_day = None
+        self.part = 0
+        # 单条写入的 tick 先按行保存, 批量写入的按列保存, 刷新时统一转换为 arrow
+        self.rows = []
+        self.columns = {name: [] for name in self.fields}
+        self.size = 0
+        self._last_flush = time.time()
+
+    def _process_item(self, item):
+        values = self.converter.values(item)
+        if values[self._day_index] != self.trading_day:
+            self.rotate(values[self._day_index])
+        self.rows.append(values)
+        self.size += 1
+        self._maybe_flush()
+        return item
+
+    def _process_batch(self, batch):
+        columns = self.converter.columns_of(batch)
+        trading_days = columns['TradingDay']
+        start = 0
+        while start < len(trading_days):
+            trading_day = trading_days[start]
+            end = start + 1
+            while end < len(trading_days) and trading_days[end] == trading_day:
+                end += 1
+            if trading_day != self.trading_day:
+                self.rotate(trading_day)
+            self._move_rows()
+            for name in self.fields:
+                self.columns[name].extend(columns[name][start:end])
+            self.size += end - start
+            start = end
+        self._maybe_flush()
+        return batch
+
+    def _move_rows(self):
+        if self.rows:
+            for name, values in zip(self.fields, zip(*self.rows)):
+                self.columns[name].extend(values)
+            self.rows = []
+
+    def _maybe_flush(self):
+        if self.size >= self.rows_per_part or time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._last_flush = time.time()
+        if self.size == 0:
+            return
+        self._move_rows()
+        arrays = []
+        for field in self.schema:
+            values = self.columns[field.name]
+            if field.name == 'InstrumentID':
+                arrays.append(pa.array(values, pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(values, field.type))
+        self.columns = {name: [] for name in self.fields}
+        self.size = 0
+
+        directory = os.path.join(self.root, self.trading_day)
+        path = os.path.join(directory, 'part-{:05d}.parquet'.format(self.part))
+        # 以 . 开头的临时文件不会被 pyarrow 当作数据集的一部分读取
+        tmp_path = os.path.join(directory, '.part-{:05d}.parquet.tmp'.format(self.part))
+        pq.write_table(pa.Table.from_arrays(arrays, schema=self.schema), tmp_path, compression=self.compression,
+                       use_dictionary=['InstrumentID'], row_group_size=self.row_group_size)
+        os.replace(tmp_path, path)
+        self.part += 1
+
+    def rotate(self, trading_day=None):
+        """
+        写出当前交易日的缓冲并切换到 trading_day, 同一交易日重启时从已有的 part 编号之后继续
+        """
+        if self.trading_day is not None:
+            self.flush()
+            log.info('parquet trading day {} finished, parts: {}'.format(self.trading_day, self.part))
+        self.trading_day = trading_day
+        if trading_day is None:
+            return
+
+        directory = os.path.join(self.root, trading_day)
+        os.makedirs(directory, exist_ok=True)
+        parts = [int(name[5:10]) for name in os.listdir(directory)
+                 if name.startswith('part-') and name.endswith('.parquet')]
+        self.part = max(parts) + 1 if parts else 0
+
+    def close(self):
+        self.rotate(None)
+
 
 class PrintItem(BasePipeline):
     def _process_item(self, item):
@@ -0,0 +1,170 @@
+import threading
+import time
+from queue import Queue
+
+from ctp.futures import ApiStruct
+
+from easyctp.log import log
+
+# ReqQry* 的返回值: -2 未处理请求超过许可数, -3 每秒发送请求数超过许可数
+THROTTLED = (-2, -3)
+
+_END = object()
+
+
+class CtpError(Exception):
+    def __init__(self, error_id, error_msg='', request_id=None):
+        if isinstance(error_msg, bytes):
+            error_msg = error_msg.decode('gbk', errors='replace')
+        super().__init__('ErrorID: {} ErrorMsg: {}'.format(error_id, error_msg))
+        self.error_id = error_id
+        self.error_msg = error_msg
+        self.request_id = request_id
+
+
+class QueryHandle:
+    """
+    QueryScheduler.submit 的返回值, 迭代时逐条返回响应结构体, result() 等待全部响应
+    """
+
+    def __init__(self, method, request, timeout):
+        self.method = method
+        self.request = request
+        self.timeout = timeout
+        self.items = Queue()
+        self.done = threading.Event()
+
+    def __iter__(self):
+        while True:
+            item = self.items.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def result(self):
+        return list(self)
+
+    def _put(self, item):
+        self.items.put(item)
+
+    def _finish(self, error=None):
+        if error is not None:
+            self.items.put(error)
+        self.items.put(_END)
+        self.done.set()
+
+
+class QueryScheduler:
+    """
+    串行发送 ReqQry* 请求: ctp 每个会话同一时刻只允许一个未完成的查询, 并限制每秒查询次数.
+    请求先进入队列, 后台线程在上一个查询的 bIsLast 返回且距离上次发送超过 interval 后立即发送下一个,
+    被流控 (返回 -2/-3) 时等待后重试, 响应通过 QueryHandle 逐条返回
+    """
+
+    def __init__(self, trader, interval=1.0, retries=10, retry_delay=1.0):
+        """
+        :param trader: EasyTrader, 需要已经登录
+        :param interval: 两次查询之间的最小间隔秒数
+        :param retries: 被流控时的最大重试次数
+        :param retry_delay: 被流控后的等待秒数
+        """
+        self.trader = trader
+        self.interval = interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.requests = Queue()
+        self.last_sent = 0.0
+
+        self.sent = 0
+        self.throttled = 0
+        self.failed = 0
+        self.received = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, method, request, timeout=10):
+        """
+        :param method: 请求方法名, 如 'ReqQryInstrument', 对应的 OnRsp* 需要把响应放入 trader.results_map
+        :param request: 请求结构体
+        :param timeout: 等待每一条响应的超时秒数
+        :return: QueryHandle
+        """
+        handle = QueryHandle(method, request, timeout)
+        self.requests.put(handle)
+        return handle
+
+    def run(self):
+        while True:
+            handle = self.requests.get()
+            try:
+                self._execute(handle)
+            except Exception as e:
+                self.failed += 1
+                log.error('查询 {} 失败: {}'.format(handle.method, e))
+                handle._finish(e)
+            else:
+                handle._finish()
+
+    def _execute(self, handle):
+        results_map = self.trader.results_map
+        for _ in range(self.retries + 1):
+            delay = self.last_sent + self.interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            request_id = next(self.trader.request_id)
+            results_map.create(request_id)
+            ret = getattr(self.trader, handle.method)(handle.request, request_id)
+            self.last_sent = time.time()
+            if ret == 0:
+                break
+            results_map.discard(request_id)
+            if ret not in THROTTLED:
+                raise CtpError(ret, '{} returned {}'.format(handle.method, ret), request_id)
+            self.throttled += 1
+            log.warning('查询 {} 被流控 ({}), {} 秒后重试'.format(handle.method, ret, self.retry_delay))
+            time.sleep(self.retry_delay)
+        else:
+            raise CtpError(ret, '{} throttled {} times'.format(handle.method, self.retries + 1), request_id)
+        self.sent += 1
+
+        for data, rsp_info in results_map.iter(request_id, timeout=handle.timeout):
+            if rsp_info is not None and rsp_info.ErrorID != 0:
+                raise CtpError(rsp_info.ErrorID, rsp_info.ErrorMsg, request_id)
+            # 没有数据时 ctp 仍然会返回一条数据为空的 bIsLast 响应
+            if data is not None:
+                self.received += 1
+                handle._put(data)
+
+    def query_instruments(self, exchange_id=b'', timeout=10):
+        return self.submit('ReqQryInstrument', ApiStruct.QryInstrument(ExchangeID=exchange_id), timeout)
+
+    def query_margin_rates(self, instrument_id=b'', hedge_flag=ApiStruct.HF_Speculation, timeout=10):
+        request = ApiStruct.QryInstrumentMarginRate(BrokerID=self.trader.broker, InvestorID=self.trader.user,
+                                                    InstrumentID=instrument_id, HedgeFlag=hedge_flag)
+        return self.submit('ReqQryInstrumentMarginRate', request, timeout)
+
+    def query_commission_rates(self, instrument_id=b'', timeout=10):
+        request = ApiStruct.QryInstrumentCommissionRate(BrokerID=self.trader.broker, InvestorID=self.trader.user,
+                                                        InstrumentID=instrument_id)
+        return self.submit('ReqQryInstrumentCommissionRate', request, timeout)
+
+    def query_positions(self, instrument_id=b'', timeout=10):
+        request = ApiStruct.QryInvestorPosition(BrokerID=self.trader.broker, InvestorID=self.trader.user,
+                                                InstrumentID=instrument_id)
+        return self.submit('ReqQryInvestorPosition', request, timeout)
+
+    def query_accounts(self, timeout=10):
+        request = ApiStruct.QryTradingAccount(BrokerID=self.trader.broker, InvestorID=self.trader.user)
+        return self.submit('ReqQryTradingAccount', request, timeout)
+
+    def stats(self):
+        return {
+            'pending': self.requests.qsize(),
+            'sent': self.sent,
+            'throttled': self.throttled,
+            'failed': self.failed,
+            'received': self.received,
+        }
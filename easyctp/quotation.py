@@ -1,16 +1,24 @@
 import itertools
 import tempfile
+import threading
+import time
+from collections import deque
 from copy import copy
 from queue import Queue, Empty
 
 from ctp.futures import ApiStruct, MdApi
 
+from easyctp.buffer import TickBuffer
 from easyctp.log import log
+from easyctp.metrics import LATENCY_BUCKETS_MS, LATENCY_SAMPLE_MASK, REGISTRY, exchange_latency_ms, instance_id
+from easyctp.session import SessionSupervisor
 from easyctp.utils import dict_iter
 
 
 class MarketData(object):
-    def __init__(self, queue=Queue(), timeout=None):
+    def __init__(self, queue=None, timeout=None):
+        # 默认参数不能直接写 Queue(), 否则所有实例会共用同一个队列
+        queue = Queue() if queue is None else queue
         assert isinstance(queue, Queue)
         self.queue = queue
         self.timeout = timeout
@@ -27,13 +35,286 @@ class MarketData(object):
     def put(self, *args, **kwargs):
         self.queue.put_nowait(*args, **kwargs)
 
+    def put_tick(self, depth_market_data):
+        # 回调传入的结构体指向 ctp 内部内存, 必须复制后再入队
+        self.put(copy(depth_market_data))
+
     def get(self, *args, **kwargs):
         return self.queue.get(*args, **kwargs)
 
+    def qsize(self):
+        """
+        尚未被消费的条数
+        """
+        return self.queue.qsize()
+
+    def get_batch(self, max_items=None, max_wait=None):
+        """
+        一次取出队列中当前所有可读的数据, 只在队列为空时阻塞
+        :param max_items: 单批最多返回的条数, None 表示不限制
+        :param max_wait: 队列为空时的最长等待时间, None 表示使用 self.timeout
+        :return: tick 列表, 超时返回空列表
+        """
+        max_wait = self.timeout if max_wait is None else max_wait
+        try:
+            batch = [self.queue.get(timeout=max_wait)]
+        except Empty:
+            return []
+
+        queue = self.queue
+        with queue.mutex:
+            count = len(queue.queue)
+            if max_items is not None:
+                count = min(count, max_items - 1)
+            popleft = queue.queue.popleft
+            batch.extend(popleft() for _ in range(count))
+            if count > 0:
+                queue.not_full.notify(count)
+        return batch
+
+    def iter_batches(self, max_items=None, max_wait=None):
+        while True:
+            batch = self.get_batch(max_items, max_wait)
+            if len(batch) == 0:
+                return
+            yield batch
+
     def __iter__(self):
         return self
 
 
+class BufferedMarketData(MarketData):
+    """
+    基于 TickBuffer 的行情对象, 回调中直接拷贝原始内存.
+    get_batch / iter_batches 每次返回一批 tick 的 recarray 视图, 下游 pipeline 需要以 start(batch=True) 批量处理;
+    get 和迭代每次返回一条 DepthMarketData 副本, 与 MarketData 相同, 但每条都要复制, 只适合兼容逐条处理的代码
+    """
+
+    def __init__(self, capacity=1 << 16, timeout=None, buffer=None):
+        self.buffer = buffer if buffer is not None else TickBuffer(capacity)
+        self.timeout = timeout
+
+    def __next__(self):
+        try:
+            return self.get(timeout=self.timeout)
+        except Empty:
+            raise StopIteration
+
+    def put_tick(self, depth_market_data):
+        self.buffer.put(depth_market_data)
+
+    def put(self, *args, **kwargs):
+        self.buffer.put(*args, **kwargs)
+
+    def get(self, block=True, timeout=None):
+        """
+        与 Queue.get 相同, 返回一条 DepthMarketData 副本, 超时抛出 Empty
+        """
+        record = self.buffer.get_batch(1, timeout if block else 0)
+        return self.buffer.struct.from_buffer_copy(record)
+
+    def qsize(self):
+        return len(self.buffer)
+
+    def get_batch(self, max_items=None, max_wait=None):
+        max_wait = self.timeout if max_wait is None else max_wait
+        try:
+            return self.buffer.get_batch(max_items, max_wait)
+        except Empty:
+            return self.buffer.array[:0]
+
+
+class TickBus(MarketData):
+    """
+    一对多的行情总线: ctp 回调线程把 tick 写入按序号编号的环形日志, 每个订阅者各自维护读取位置,
+    互不影响. 订阅者落后超过 capacity 条时丢弃最旧的数据并计数, 不会阻塞回调线程
+    """
+
+    def __init__(self, capacity=1 << 18):
+        """
+        :param capacity: 环形日志长度, 必须是 2 的幂, 即每个订阅者最多允许落后的条数
+        """
+        if capacity & (capacity - 1):
+            raise ValueError('capacity must be a power of 2: {}'.format(capacity))
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.log = [None] * capacity
+        self.sequence = 0
+        self.subscribers = []
+        self.changed = threading.Condition()
+        self.waiting = 0
+
+    def put_tick(self, depth_market_data):
+        # from_buffer_copy 直接复制结构体内存, 比 copy.copy 快一个数量级
+        self.put(ApiStruct.DepthMarketData.from_buffer_copy(depth_market_data))
+
+    def put(self, item):
+        # 只有一个写线程, 先写入数据再推进序号, 读取方看到新序号时数据一定已经写好
+        sequence = self.sequence
+        self.log[sequence & self.mask] = item
+        self.sequence = sequence + 1
+        if self.waiting:
+            with self.changed:
+                self.changed.notify_all()
+
+    def __next__(self):
+        raise TypeError('TickBus can not be consumed directly, use subscribe()')
+
+    def get(self, *args, **kwargs):
+        raise TypeError('TickBus can not be consumed directly, use subscribe()')
+
+    def get_batch(self, max_items=None, max_wait=None):
+        raise TypeError('TickBus can not be consumed directly, use subscribe()')
+
+    def qsize(self):
+        """
+        落后最多的订阅者尚未读取的条数
+        """
+        return max((subscriber.lag for subscriber in self.subscribers), default=0)
+
+    def subscribe(self, instrument_ids=None, timeout=None, name=None):
+        """
+        :param instrument_ids: 只接收这些合约的 tick, None 表示全部合约
+        :param timeout: 订阅者迭代时的等待超时, 与 MarketData 相同
+        :param name: 订阅者名称, 用于 stats
+        :return: BusSubscriber, 从订阅时刻之后的 tick 开始读取
+        """
+        name = name or 'subscriber-{}'.format(len(self.subscribers))
+        subscriber = BusSubscriber(self, instrument_ids, timeout, name)
+        self.subscribers = self.subscribers + [subscriber]
+        REGISTRY.collector('easyctp_bus', subscriber.stats, subscriber=name)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers = [x for x in self.subscribers if x is not subscriber]
+
+    def wait(self, sequence, timeout):
+        """
+        等待序号超过 sequence, 返回是否有新数据
+        """
+        if self.sequence > sequence:
+            return True
+        with self.changed:
+            self.waiting += 1
+            try:
+                return self.changed.wait_for(lambda: self.sequence > sequence, timeout)
+            finally:
+                self.waiting -= 1
+
+    def stats(self):
+        return {
+            'published': self.sequence,
+            'capacity': self.capacity,
+            'subscribers': [subscriber.stats() for subscriber in self.subscribers],
+        }
+
+
+class BusSubscriber(MarketData):
+    """
+    TickBus 的订阅者, 接口与 MarketData 相同, 可以直接作为 pipeline 或 strategy 的上游
+    """
+
+    def __init__(self, bus, instrument_ids=None, timeout=None, name=None):
+        self.bus = bus
+        self.instrument_ids = None if instrument_ids is None else frozenset(
+            MarketDataApi.auto_encode_bytes(instrument) for instrument in instrument_ids)
+        self.timeout = timeout
+        self.name = name
+        self.cursor = bus.sequence
+        self.pending = deque()
+        self.received = 0
+        self.dropped = 0
+        self.filtered = 0
+
+    def __next__(self):
+        try:
+            return self.get(timeout=self.timeout)
+        except Empty:
+            raise StopIteration
+
+    def put(self, *args, **kwargs):
+        raise TypeError('publish to the TickBus instead of a subscriber')
+
+    def put_tick(self, depth_market_data):
+        raise TypeError('publish to the TickBus instead of a subscriber')
+
+    def get(self, block=True, timeout=None):
+        """
+        与 Queue.get 相同, 超时抛出 Empty
+        """
+        if not self.pending:
+            self.pending.extend(self._read(None, timeout if block else 0))
+            if not self.pending:
+                raise Empty
+        return self.pending.popleft()
+
+    def get_batch(self, max_items=None, max_wait=None):
+        """
+        读取当前位置之后所有已发布的 tick, 只在没有新数据时阻塞
+        :return: tick 列表, 超时返回空列表
+        """
+        if self.pending:
+            count = len(self.pending) if max_items is None else min(len(self.pending), max_items)
+            popleft = self.pending.popleft
+            return [popleft() for _ in range(count)]
+        return self._read(max_items, self.timeout if max_wait is None else max_wait)
+
+    def _read(self, max_items, max_wait):
+        deadline = None if max_wait is None else time.time() + max_wait
+        bus = self.bus
+        while True:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            if not bus.wait(self.cursor, remaining):
+                return []
+
+            start, end = self.cursor, bus.sequence
+            if end - start > bus.capacity:
+                self.dropped += end - bus.capacity - start
+                start = end - bus.capacity
+            if max_items is not None:
+                end = min(end, start + max_items)
+            log, mask = bus.log, bus.mask
+            batch = [log[i & mask] for i in range(start, end)]
+
+            # 读取期间写线程可能已经绕回并覆盖了最早的数据
+            overwritten = bus.sequence - bus.capacity - start
+            if overwritten > 0:
+                self.dropped += overwritten
+                batch = batch[overwritten:]
+            self.cursor = end
+            self.received += len(batch)
+
+            if self.instrument_ids is not None:
+                instrument_ids = self.instrument_ids
+                count = len(batch)
+                batch = [tick for tick in batch if tick.InstrumentID in instrument_ids]
+                self.filtered += count - len(batch)
+            if batch:
+                return batch
+
+    @property
+    def lag(self):
+        return self.bus.sequence - self.cursor + len(self.pending)
+
+    def qsize(self):
+        return self.lag
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'cursor': self.cursor,
+            'lag': self.lag,
+            'lag_ratio': self.lag / self.bus.capacity,
+            'received': self.received,
+            'dropped': self.dropped,
+            'filtered': self.filtered,
+            'instruments': None if self.instrument_ids is None else len(self.instrument_ids),
+        }
+
+
 class MarketDataApi(MdApi):
     def __init__(self):
         super(MdApi, self).__init__()
@@ -44,22 +325,39 @@ class MarketDataApi(MdApi):
 
         self.request_id = itertools.count()
         self.market_data = None
+        self.snapshot = None
+        self.publisher = None
+        self.session = SessionSupervisor(self)
+        # 每个连接的计数只在自己的回调线程中更新
+        self.metrics_id = instance_id()
+        REGISTRY.collector('easyctp_session', self.session.stats, id=self.metrics_id)
+
+        self.ticks = REGISTRY.counter('easyctp_ticks_received_total', id=self.metrics_id)
+        self.latency = REGISTRY.histogram('easyctp_tick_latency_ms', LATENCY_BUCKETS_MS, id=self.metrics_id)
 
-    def prepare(self, user, password, broker, front, instrument_ids, market_data=MarketData()):
+    def prepare(self, user, password, broker, front, instrument_ids, market_data=None, snapshot=None,
+                publisher=None):
         """
         :param user: investor id
         :param password: password
         :param broker: broker id
         :param front: 行情服务器地址, 类似 tcp://127.0.0.1:8000
         :param instrument_ids: 订阅合约列表, 类似　['rb1705', 'rb1710]
-        :param market_data: 返回的接受市场数据对象
+        :param market_data: 返回的接受市场数据对象, 默认新建 MarketData, 多个消费者共用一个连接时传入 TickBus
+        :param snapshot: 可选的 SnapshotTable, 保存每个合约的最新 tick
+        :param publisher: 可选的 SharedTickPublisher, 把 tick 发布到共享内存供其他进程读取
         :return: market_data: 返回的接受市场数据对象
         """
         self.user = self.auto_encode_bytes(user)
         self.password = self.auto_encode_bytes(password)
         self.broker = self.auto_encode_bytes(broker)
 
-        self.market_data = market_data
+        self.market_data = market_data if market_data is not None else MarketData()
+        self.snapshot = snapshot
+        self.publisher = publisher
+        if hasattr(self.market_data, 'qsize'):
+            REGISTRY.gauge('easyctp_queue_depth', self.market_data.qsize, source=type(self.market_data).__name__,
+                           id=self.metrics_id)
 
         self.instrument_ids = [self.auto_encode_bytes(instrument) for instrument in instrument_ids]
 
@@ -75,25 +373,49 @@ class MarketDataApi(MdApi):
             return value.encode()
         return value
 
+    def login(self):
+        user_login_args = ApiStruct.ReqUserLogin(UserID=self.user,
+                                                 Password=self.password,
+                                                 BrokerID=self.broker)
+        ret = self.ReqUserLogin(user_login_args, next(self.request_id))
+
+        if ret == 0:
+            log.info('登录信息发送成功，等待返回')
+
     def OnRspUserLogin(self, pRspUserLogin, pRspInfo, nRequestID, bIsLast):
         if pRspInfo.ErrorID == 0:
-            log.info('登录成功，开始订阅合约 {}'.format(self.instrument_ids))
-            self.SubscribeMarketData(self.instrument_ids)
+            log.info('登录成功，开始订阅合约, 合约数 {}'.format(len(self.instrument_ids)))
         else:
             log.error('登录失败 ErrorID: {} ErrorMsg: {}'.format(pRspInfo.ErrorID, pRspInfo.ErrorMsg))
+        self.session.on_login(pRspInfo.ErrorID)
+
+    def OnRspSubMarketData(self, pSpecificInstrument, pRspInfo, nRequestID, bIsLast):
+        if pRspInfo is not None and pRspInfo.ErrorID != 0:
+            instrument_id = pSpecificInstrument.InstrumentID if pSpecificInstrument is not None else None
+            self.session.on_subscribe_error(instrument_id, pRspInfo.ErrorID, pRspInfo.ErrorMsg)
 
     def OnFrontDisconnected(self, nReason):
-        log.error('客户端无法注册服务器地址: {}'.format(nReason))
+        self.session.on_disconnected(nReason)
 
     def OnFrontConnected(self):
         log.info('客户端与交易后台建立连接成功, 开始登录')
-        user_login_args = ApiStruct.ReqUserLogin(UserID=self.user,
-                                                 Password=self.password,
-                                                 BrokerID=self.broker)
-        ret = self.ReqUserLogin(user_login_args, next(self.request_id))
-
-        if ret == 0:
-            log.info('登录信息发送成功，等待返回')
+        self.session.on_connected()
 
     def OnRtnDepthMarketData(self, pDepthMarketData):
-        self.market_data.put(copy(pDepthMarketData))
+        ticks = self.ticks
+        ticks.value += 1
+        if not ticks.value & LATENCY_SAMPLE_MASK:
+            self._sample_latency(pDepthMarketData)
+        self.session.on_tick(pDepthMarketData)
+        if self.snapshot is not None:
+            self.snapshot.update(pDepthMarketData)
+        if self.publisher is not None:
+            self.publisher.put_tick(pDepthMarketData)
+        self.market_data.put_tick(pDepthMarketData)
+
+    def _sample_latency(self, tick):
+        try:
+            self.latency.observe(exchange_latency_ms(tick.UpdateTime, tick.UpdateMillisec))
+        except ValueError:
+            # 个别交易所推送的 UpdateTime 为空
+            pass
@@ -0,0 +1,134 @@
+import random
+import threading
+import time
+from queue import Queue
+
+from ctp.futures import ApiStruct
+
+from easyctp.log import log
+from easyctp.quotation import MarketData
+from easyctp.store import TickStoreReader
+from easyctp.validator import DBL_MAX, session_time_key
+
+
+class MarketDataReplayer:
+    """
+    用录制的 tick 代替 MarketDataApi 作为行情来源, 在后台线程中按原始时间间隔调用 market_data.put_tick,
+    下游的 pipeline 和 strategy 不需要任何修改
+    """
+
+    def __init__(self):
+        self.market_data = None
+        self.speed = None
+        self.replayed = 0
+        self.finished = threading.Event()
+        self.thread = None
+
+    def prepare(self, ticks, market_data=None, speed=None):
+        """
+        :param ticks: DepthMarketData 的可迭代对象, 如 from_tick_store(...) 或 synthetic_ticks(...)
+        :param market_data: 接收行情的对象, 默认 MarketData(Queue())
+        :param speed: None 表示尽可能快, 1 表示按真实时间回放, N 表示 N 倍速
+        :return: market_data
+        """
+        self.market_data = market_data if market_data is not None else MarketData(Queue())
+        self.speed = speed
+        self.thread = threading.Thread(target=self.run, args=(ticks,), daemon=True)
+        self.thread.start()
+        return self.market_data
+
+    def run(self, ticks):
+        put_tick = self.market_data.put_tick
+        start_wall = None
+        start_key = None
+        for tick in ticks:
+            if self.speed is not None:
+                key = session_time_key(tick.TradingDay, tick.UpdateTime, tick.UpdateMillisec)
+                if start_key is None:
+                    start_wall, start_key = time.time(), key
+                delay = start_wall + (key - start_key) / 1000 / self.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            put_tick(tick)
+            self.replayed += 1
+        log.info('回放结束, 共 {} 条 tick'.format(self.replayed))
+        self.finished.set()
+
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+
+def from_records(records):
+    """
+    把 TickStoreReader 返回的 recarray 逐条还原为 DepthMarketData 结构体
+    """
+    data = records.tobytes()
+    itemsize = records.dtype.itemsize
+    from_buffer_copy = ApiStruct.DepthMarketData.from_buffer_copy
+    for offset in range(0, len(data), itemsize):
+        yield from_buffer_copy(data, offset)
+
+
+def from_tick_store(root, trading_day, instrument_ids=None, start=None, end=None):
+    """
+    按交易时间顺序回放 TickStore 中某个交易日的 tick
+    """
+    records = TickStoreReader(root).replay(trading_day, instrument_ids, start, end)
+    return from_records(records)
+
+
+def synthetic_ticks(instruments=100, snapshots=1000, trading_day='20170104', start='09:00:00', interval_ms=500,
+                    seed=0):
+    """
+    生成确定性的模拟行情: 每个快照周期内所有合约各推送一条, 用于模拟开盘时的集中推送
+    :param instruments: 合约数量或合约代码列表
+    :param snapshots: 快照次数
+    :param interval_ms: 快照间隔, ctp 为 500ms
+    """
+    if isinstance(instruments, int):
+        instruments = ['ins{:04d}'.format(i) for i in range(instruments)]
+    rnd = random.Random(seed)
+    trading_day = trading_day.encode()
+    hour, minute, second = (int(x) for x in start.split(':'))
+    start_ms = ((hour * 60 + minute) * 60 + second) * 1000
+
+    states = []
+    for instrument_id in instruments:
+        price = rnd.randint(1000, 5000)
+        states.append({
+            'InstrumentID': instrument_id.encode(),
+            'PreSettlementPrice': float(price),
+            'PreClosePrice': float(price),
+            'PreOpenInterest': float(rnd.randint(1000, 100000)),
+            'OpenPrice': float(price),
+            'HighestPrice': float(price),
+            'LowestPrice': float(price),
+            'UpperLimitPrice': price * 1.1,
+            'LowerLimitPrice': price * 0.9,
+            'LastPrice': float(price),
+            'Volume': 0,
+            'Turnover': 0.0,
+            'OpenInterest': 0.0,
+        })
+
+    for snapshot in range(snapshots):
+        now_ms = (start_ms + snapshot * interval_ms) % (24 * 3600 * 1000)
+        update_time = '{:02d}:{:02d}:{:02d}'.format(now_ms // 3600000, now_ms // 60000 % 60,
+                                                    now_ms // 1000 % 60).encode()
+        for state in states:
+            price = max(state['LastPrice'] + rnd.choice((-1, 0, 0, 1)), 1.0)
+            volume = rnd.randint(0, 20)
+            state['LastPrice'] = price
+            state['HighestPrice'] = max(state['HighestPrice'], price)
+            state['LowestPrice'] = min(state['LowestPrice'], price)
+            state['Volume'] += volume
+            state['Turnover'] += price * volume * 10
+            state['OpenInterest'] = state['PreOpenInterest'] + rnd.randint(-500, 500)
+            yield ApiStruct.DepthMarketData(
+                TradingDay=trading_day, ActionDay=trading_day, UpdateTime=update_time,
+                UpdateMillisec=now_ms % 1000,
+                BidPrice1=price - 1, BidVolume1=rnd.randint(1, 100),
+                AskPrice1=price + 1, AskVolume1=rnd.randint(1, 100),
+                AveragePrice=state['Turnover'] / state['Volume'] if state['Volume'] else 0.0,
+                ClosePrice=DBL_MAX, SettlementPrice=DBL_MAX,
+                **state)
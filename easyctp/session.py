@@ -0,0 +1,167 @@
+import threading
+import time
+from collections import deque
+
+from easyctp.log import log
+
+DISCONNECTED = 'disconnected'
+CONNECTED = 'connected'
+LOGGED_IN = 'logged_in'
+SUBSCRIBED = 'subscribed'
+
+
+class SessionSupervisor:
+    """
+    跟踪 MarketDataApi 的连接状态. ctp api 断线后会自己重连前置, 这里负责:
+    频繁断线时按退避时间延迟登录, 登录后分批重新订阅, 以及记录每个合约断线前最后一条和重连后第一条 tick 的时间.
+    缺口在合约重连后的第一条 tick 到达时生成, 以 dict 列表的形式交给 sinks
+    """
+
+    def __init__(self, api, chunk_size=500, chunk_interval=0.05, backoff=1.0, max_backoff=60.0,
+                 stable_seconds=60.0, max_gaps=10000, sinks=None):
+        """
+        :param api: MarketDataApi
+        :param chunk_size: 每次 SubscribeMarketData 的合约数量
+        :param chunk_interval: 两批订阅之间的间隔秒数
+        :param backoff: 断线后首次登录的等待秒数, 连续断线时加倍
+        :param max_backoff: 最长等待秒数
+        :param stable_seconds: 连接保持超过该时间后再断线, 等待时间重新从 0 开始
+        :param max_gaps: 内存中保留的缺口记录数量
+        :param sinks: 接收缺口列表的函数
+        """
+        self.api = api
+        self.chunk_size = chunk_size
+        self.chunk_interval = chunk_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_seconds = stable_seconds
+        self.sinks = list(sinks or [])
+
+        self.state = DISCONNECTED
+        self.failures = 0
+        self.logged_in_at = None
+        self.disconnected_at = None
+        self.disconnect_reason = None
+        self.login_timer = None
+        self.generation = 0
+
+        # 每个合约最后一条 tick 的 (UpdateTime, UpdateMillisec)
+        self.last_times = {}
+        self.open_gaps = {}
+        self.gaps = deque(maxlen=max_gaps)
+
+        self.disconnects = 0
+        self.logins = 0
+        self.login_failures = 0
+        self.subscribe_failures = 0
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def on_tick(self, tick):
+        instrument_id = tick.InstrumentID
+        self.last_times[instrument_id] = (tick.UpdateTime, tick.UpdateMillisec)
+        if self.open_gaps:
+            gap = self.open_gaps.pop(instrument_id, None)
+            if gap is not None:
+                self._close_gap(gap, tick)
+
+    def on_disconnected(self, reason):
+        now = time.time()
+        if self.state != DISCONNECTED and self.logins:
+            self.disconnects += 1
+            if self.logged_in_at is not None and now - self.logged_in_at > self.stable_seconds:
+                self.failures = 0
+            self.failures += 1
+            self.disconnected_at = now
+            self.disconnect_reason = reason
+            # 已订阅但重连前仍未收到 tick 的合约保留原来的缺口起点
+            for instrument_id in self.api.instrument_ids or ():
+                if instrument_id not in self.open_gaps:
+                    self.open_gaps[instrument_id] = {
+                        'instrument_id': instrument_id,
+                        'last_time': self.last_times.get(instrument_id),
+                        'disconnected_at': now,
+                        'reason': reason,
+                    }
+        self.state = DISCONNECTED
+        self.generation += 1
+        if self.login_timer is not None:
+            self.login_timer.cancel()
+        log.error('行情前置断开, 原因: {}, 第 {} 次断线'.format(reason, self.disconnects))
+
+    def on_connected(self):
+        self.state = CONNECTED
+        delay = 0 if self.failures <= 1 else min(self.backoff * 2 ** (self.failures - 2), self.max_backoff)
+        if delay:
+            log.info('连续断线 {} 次, {:.1f} 秒后登录'.format(self.failures, delay))
+            self.login_timer = threading.Timer(delay, self._login, args=(self.generation,))
+            self.login_timer.daemon = True
+            self.login_timer.start()
+        else:
+            self._login(self.generation)
+
+    def _login(self, generation):
+        if generation != self.generation or self.state != CONNECTED:
+            return
+        self.api.login()
+
+    def on_login(self, error_id):
+        if error_id != 0:
+            self.login_failures += 1
+            delay = min(self.backoff * 2 ** min(self.login_failures - 1, 16), self.max_backoff)
+            log.info('{:.1f} 秒后重新登录'.format(delay))
+            self.login_timer = threading.Timer(delay, self._login, args=(self.generation,))
+            self.login_timer.daemon = True
+            self.login_timer.start()
+            return
+        self.logins += 1
+        self.login_failures = 0
+        self.logged_in_at = time.time()
+        self.state = LOGGED_IN
+        # 分批订阅需要等待, 不能阻塞回调线程
+        threading.Thread(target=self.subscribe, args=(self.generation,), daemon=True).start()
+
+    def subscribe(self, generation):
+        instrument_ids = list(self.api.instrument_ids or ())
+        for i in range(0, len(instrument_ids), self.chunk_size):
+            if generation != self.generation:
+                return
+            chunk = instrument_ids[i:i + self.chunk_size]
+            ret = self.api.SubscribeMarketData(chunk)
+            if ret != 0:
+                self.subscribe_failures += 1
+                log.error('订阅合约失败, 返回值 {}, 合约 {} - {}'.format(ret, chunk[0], chunk[-1]))
+            time.sleep(self.chunk_interval)
+        if generation == self.generation:
+            self.state = SUBSCRIBED
+            log.info('订阅完成, 合约数 {}'.format(len(instrument_ids)))
+
+    def on_subscribe_error(self, instrument_id, error_id, error_msg):
+        self.subscribe_failures += 1
+        log.error('订阅 {} 失败 ErrorID: {} ErrorMsg: {}'.format(instrument_id, error_id, error_msg))
+
+    def _close_gap(self, gap, tick):
+        gap['trading_day'] = tick.TradingDay.decode()
+        gap['instrument_id'] = gap['instrument_id'].decode()
+        last_time = gap['last_time']
+        gap['last_time'] = None if last_time is None else '{}.{:03d}'.format(last_time[0].decode(), last_time[1])
+        gap['first_time'] = '{}.{:03d}'.format(tick.UpdateTime.decode(), tick.UpdateMillisec)
+        gap['reconnected_at'] = time.time()
+        self.gaps.append(gap)
+        for sink in self.sinks:
+            try:
+                sink([gap])
+            except Exception as e:
+                log.error('gap sink error: {}'.format(e))
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'disconnects': self.disconnects,
+            'logins': self.logins,
+            'login_failures': self.login_failures,
+            'subscribe_failures': self.subscribe_failures,
+            'open_gaps': len(self.open_gaps),
+            'gaps': len(self.gaps),
+        }
@@ -0,0 +1,195 @@
+import multiprocessing
+import re
+import threading
+import time
+import zlib
+from queue import Empty
+
+from easyctp.log import log
+
+SPLIT_METHODS = ('product', 'hash')
+
+_PRODUCT_PATTERN = re.compile(rb'^[A-Za-z]+')
+
+
+def product_of(instrument_id):
+    """
+    合约代码的品种部分, 如 b'rb1705' -> b'rb', 期权 b'm1707-C-2800' -> b'm'
+    """
+    match = _PRODUCT_PATTERN.match(instrument_id)
+    return match.group(0) if match else instrument_id
+
+
+def shard_instruments(instrument_ids, shards, split='product'):
+    """
+    把合约分配到 shards 个分片
+    :param split: product 同一品种的合约放在同一分片, 按合约数量均衡; hash 按合约代码的 crc32 分配
+    :return: 每个分片的合约列表
+    """
+    if split not in SPLIT_METHODS:
+        raise ValueError('split must be one of {}: {}'.format(SPLIT_METHODS, split))
+    instrument_ids = sorted(instrument.encode() if isinstance(instrument, str) else instrument
+                            for instrument in instrument_ids)
+    result = [[] for _ in range(shards)]
+    if split == 'hash':
+        for instrument_id in instrument_ids:
+            result[zlib.crc32(instrument_id) % shards].append(instrument_id)
+        return result
+
+    products = {}
+    for instrument_id in instrument_ids:
+        products.setdefault(product_of(instrument_id), []).append(instrument_id)
+    # 大品种优先放入当前合约最少的分片
+    for _, group in sorted(products.items(), key=lambda x: (-len(x[1]), x[0])):
+        min(result, key=len).extend(group)
+    return result
+
+
+def start_reporter(stats_queue, index, stats, interval):
+    """
+    在分片进程中定期把 stats() 的结果发送给 ShardSupervisor
+    """
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                stats_queue.put_nowait((index, time.time(), stats()))
+            except Exception as e:
+                log.warning('shard {} report stats error: {}'.format(index, e))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+class ShardSupervisor:
+    """
+    在多个进程中分别运行 target(index, instrument_ids, stats_queue, *args), 每个进程负责一部分合约,
+    使用独立的行情连接和写入线程, 不再受单个进程 GIL 的限制.
+    进程退出后按退避时间自动重启, 并汇总各分片通过 start_reporter 上报的统计
+    """
+
+    def __init__(self, target, instrument_ids, shards, args=(), split='product', restart_delay=1.0,
+                 max_restart_delay=60.0, stable_seconds=60.0):
+        """
+        :param target: 分片进程的入口函数, 必须可以被 pickle (模块级函数)
+        :param instrument_ids: 全部合约
+        :param shards: 分片数量
+        :param args: 传给 target 的其他参数
+        :param split: 分片方式, 见 shard_instruments
+        :param restart_delay: 首次重启的等待秒数, 连续失败时加倍
+        :param max_restart_delay: 最长重启等待秒数
+        :param stable_seconds: 进程运行超过该时间后退出视为偶发故障, 重启等待重新从 restart_delay 开始
+        """
+        self.target = target
+        self.args = tuple(args)
+        self.shards = shard_instruments(instrument_ids, shards, split)
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stable_seconds = stable_seconds
+
+        # ctp 的 api 内部有线程, fork 出来的子进程状态不可靠, 统一使用 spawn
+        self.context = multiprocessing.get_context('spawn')
+        self.stats_queue = self.context.Queue()
+        self.processes = [None] * len(self.shards)
+        self.started_at = [None] * len(self.shards)
+        self.restart_at = [0.0] * len(self.shards)
+        self.failures = [0] * len(self.shards)
+        self.restarts = [0] * len(self.shards)
+        self.shard_stats = [None] * len(self.shards)
+        self.running = False
+
+    def start(self):
+        self.running = True
+        for index, instrument_ids in enumerate(self.shards):
+            log.info('分片 {} 合约数 {}'.format(index, len(instrument_ids)))
+            self._start(index)
+
+    def _start(self, index):
+        process = self.context.Process(target=self.target, name='easyctp-shard-{}'.format(index),
+                                       args=(index, self.shards[index], self.stats_queue) + self.args,
+                                       daemon=True)
+        process.start()
+        self.processes[index] = process
+        self.started_at[index] = time.time()
+
+    def supervise(self, interval=1.0):
+        """
+        检查一次各分片进程并接收统计, 进程退出时安排重启
+        """
+        deadline = time.time() + interval
+        while True:
+            try:
+                index, reported_at, stats = self.stats_queue.get(timeout=max(deadline - time.time(), 0))
+                self.shard_stats[index] = dict(stats, reported_at=reported_at)
+            except Empty:
+                break
+
+        now = time.time()
+        for index, process in enumerate(self.processes):
+            if process is None or process.is_alive():
+                if process is None and self.running and now >= self.restart_at[index]:
+                    self.restarts[index] += 1
+                    log.info('重启分片 {}, 第 {} 次'.format(index, self.restarts[index]))
+                    self._start(index)
+                continue
+            process.join()
+            if now - self.started_at[index] > self.stable_seconds:
+                self.failures[index] = 0
+            delay = min(self.restart_delay * 2 ** self.failures[index], self.max_restart_delay)
+            self.failures[index] += 1
+            log.error('分片 {} 进程 {} 退出, exitcode: {}, {:.1f} 秒后重启'.format(
+                index, process.pid, process.exitcode, delay))
+            self.processes[index] = None
+            self.restart_at[index] = now + delay
+
+    def run(self, interval=1.0, stats_interval=60.0):
+        """
+        启动所有分片并一直监控, 每 stats_interval 秒输出一次汇总统计
+        """
+        self.start()
+        next_report = time.time() + stats_interval
+        try:
+            while self.running:
+                self.supervise(interval)
+                if time.time() >= next_report:
+                    next_report += stats_interval
+                    log.info('分片统计: {}'.format(self.stats()['total']))
+        finally:
+            self.stop()
+
+    def stop(self, timeout=10):
+        self.running = False
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join(timeout)
+
+    def stats(self):
+        """
+        :return: total 为各分片计数之和 (*_max 取最大值, 平均值不汇总), shards 为每个分片的进程状态和最近一次上报的统计
+        """
+        total = {}
+        shards = []
+        for index, process in enumerate(self.processes):
+            stats = self.shard_stats[index] or {}
+            for name, value in stats.items():
+                if not isinstance(value, (int, float)) or isinstance(value, bool) or name == 'reported_at' \
+                        or name.endswith(('_avg', '_last')):
+                    continue
+                if name.endswith('_max'):
+                    total[name] = max(total.get(name, 0), value)
+                else:
+                    total[name] = total.get(name, 0) + value
+            shards.append({
+                'shard': index,
+                'instruments': len(self.shards[index]),
+                'pid': process.pid if process is not None else None,
+                'alive': process is not None and process.is_alive(),
+                'restarts': self.restarts[index],
+                'stats': stats,
+            })
+        return {'total': total, 'shards': shards}
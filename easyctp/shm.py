@@ -0,0 +1,245 @@
+import ctypes
+import mmap
+import os
+import tempfile
+import time
+from queue import Empty
+
+import numpy as np
+from ctp.futures import ApiStruct
+
+from easyctp.buffer import DEPTH_MARKET_DATA_DTYPE
+from easyctp.log import log
+from easyctp.quotation import MarketData
+
+MAGIC = b'EZCTPRNG'
+VERSION = 1
+HEADER_SIZE = 64
+DEFAULT_PATH = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'easyctp-ticks')
+
+
+class RingHeader(ctypes.Structure):
+    _fields_ = [
+        ('magic', ctypes.c_char * 8),
+        ('version', ctypes.c_uint32),
+        ('itemsize', ctypes.c_uint32),
+        ('capacity', ctypes.c_uint64),
+        ('sequence', ctypes.c_uint64),
+        ('writer_pid', ctypes.c_uint64),
+    ]
+
+
+HEADER_DTYPE = np.dtype([(name, 'S8' if name == 'magic' else np.dtype(ctype))
+                         for name, ctype in RingHeader._fields_])
+SEQUENCE_OFFSET = RingHeader.sequence.offset
+
+
+def ring_size(capacity, itemsize=DEPTH_MARKET_DATA_DTYPE.itemsize):
+    """
+    文件布局: 64 字节文件头, capacity 个 uint64 序号戳, capacity 条 DepthMarketData 原始记录
+    """
+    return HEADER_SIZE + capacity * 8 + capacity * itemsize
+
+
+class SharedTickPublisher:
+    """
+    把 tick 写入 mmap 文件中的环形缓冲区, 同一台机器上的其他进程通过 SharedMarketData 读取.
+    记录与 DepthMarketData 的内存布局相同, 不需要序列化. 只允许一个写进程.
+    每条记录写入前把序号戳清零, 写完后设为 sequence + 1, 最后推进文件头中的 sequence,
+    读取方据此判断记录是否完整以及是否已被覆盖
+    """
+
+    def __init__(self, path=DEFAULT_PATH, capacity=1 << 16):
+        """
+        :param path: 共享文件路径, 默认在 /dev/shm 下
+        :param capacity: 环形缓冲区条数, 必须是 2 的幂
+        """
+        if capacity & (capacity - 1):
+            raise ValueError('capacity must be a power of 2: {}'.format(capacity))
+        self.path = path
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.itemsize = DEPTH_MARKET_DATA_DTYPE.itemsize
+        size = ring_size(capacity, self.itemsize)
+
+        # 布局相同的旧文件继续沿用并接着原来的序号写, 读取方在采集进程重启后不需要重新打开.
+        # 大小不同时删除后重建, 已经映射旧文件的读取方不会因为文件被截断而出错
+        reuse = os.path.exists(path) and os.path.getsize(path) == size
+        if os.path.exists(path) and not reuse:
+            os.unlink(path)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if not reuse:
+                os.ftruncate(fd, size)
+            self.mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self.header = RingHeader.from_buffer(self.mmap)
+        self.stamps = (ctypes.c_uint64 * capacity).from_buffer(self.mmap, HEADER_SIZE)
+        self.records = (ApiStruct.DepthMarketData * capacity).from_buffer(self.mmap, HEADER_SIZE + capacity * 8)
+        self.sequence_value = ctypes.c_uint64.from_buffer(self.mmap, SEQUENCE_OFFSET)
+
+        if not (reuse and self.header.magic == MAGIC and self.header.version == VERSION
+                and self.header.itemsize == self.itemsize and self.header.capacity == capacity):
+            ctypes.memset(ctypes.addressof(self.stamps), 0, capacity * 8)
+            self.header.version = VERSION
+            self.header.itemsize = self.itemsize
+            self.header.capacity = capacity
+            self.header.sequence = 0
+            self.header.magic = MAGIC
+        self.header.writer_pid = os.getpid()
+        self.sequence = self.header.sequence
+        log.info('共享内存行情 {} 容量 {} 起始序号 {}'.format(path, capacity, self.sequence))
+
+    def put_tick(self, depth_market_data):
+        sequence = self.sequence
+        slot = sequence & self.mask
+        stamps = self.stamps
+        stamps[slot] = 0
+        self.records[slot] = depth_market_data
+        stamps[slot] = sequence + 1
+        self.sequence = sequence + 1
+        self.sequence_value.value = sequence + 1
+
+    def put(self, depth_market_data):
+        self.put_tick(depth_market_data)
+
+    def close(self):
+        # mmap 关闭前必须释放所有 from_buffer 导出的对象
+        del self.header, self.stamps, self.records, self.sequence_value
+        self.mmap.close()
+
+
+class SharedMarketData(MarketData):
+    """
+    SharedTickPublisher 的读取端, 接口与 BufferedMarketData 相同: get_batch 返回一批 tick 的 recarray,
+    get 和迭代每次返回一条 DepthMarketData 副本.
+    跨进程没有通知机制, 没有新数据时先自旋 spin 次, 再以 poll_interval 为间隔轮询
+    """
+
+    def __init__(self, path=DEFAULT_PATH, timeout=None, poll_interval=0.0005, spin=1000, from_start=False):
+        """
+        :param path: SharedTickPublisher 的共享文件路径
+        :param timeout: 迭代时的等待超时, 与 MarketData 相同
+        :param poll_interval: 轮询间隔秒数
+        :param spin: 每次等待时先不休眠地检查的次数, 越大延迟越低, 占用的 cpu 越多
+        :param from_start: 从缓冲区中最早的一条开始读, 默认只读打开之后的新数据
+        """
+        self.path = path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.spin = spin
+        self.dtype = DEPTH_MARKET_DATA_DTYPE
+
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = np.frombuffer(self.mmap, dtype=HEADER_DTYPE, count=1)[0]
+        if header['magic'] != MAGIC or header['version'] != VERSION:
+            raise ValueError('{} is not an easyctp tick ring'.format(path))
+        if header['itemsize'] != self.dtype.itemsize:
+            raise ValueError('DepthMarketData size mismatch: ring {} local {}'.format(header['itemsize'],
+                                                                                     self.dtype.itemsize))
+        self.capacity = int(header['capacity'])
+        self.mask = self.capacity - 1
+        self._sequence = np.frombuffer(self.mmap, dtype=np.uint64, count=1, offset=SEQUENCE_OFFSET)
+        self.stamps = np.frombuffer(self.mmap, dtype=np.uint64, count=self.capacity, offset=HEADER_SIZE)
+        self.records = np.frombuffer(self.mmap, dtype=self.dtype, count=self.capacity,
+                                     offset=HEADER_SIZE + self.capacity * 8)
+
+        sequence = self.sequence
+        self.cursor = max(sequence - self.capacity, 0) if from_start else sequence
+        self.received = 0
+        self.dropped = 0
+
+    @property
+    def sequence(self):
+        return int(self._sequence[0])
+
+    def __next__(self):
+        try:
+            return self.get(timeout=self.timeout)
+        except Empty:
+            raise StopIteration
+
+    def put(self, *args, **kwargs):
+        raise TypeError('SharedMarketData is read only')
+
+    def put_tick(self, depth_market_data):
+        raise TypeError('SharedMarketData is read only')
+
+    def get(self, block=True, timeout=None):
+        """
+        与 Queue.get 相同, 返回一条 DepthMarketData 副本, 超时抛出 Empty
+        """
+        while True:
+            batch = self._read(1, timeout if block else 0)
+            if len(batch):
+                return ApiStruct.DepthMarketData.from_buffer_copy(batch)
+            if not self.lag:
+                raise Empty
+
+    def get_batch(self, max_items=None, max_wait=None):
+        """
+        :return: 新 tick 的 recarray 副本, 超时返回空数组
+        """
+        return self._read(max_items, self.timeout if max_wait is None else max_wait)
+
+    def _wait(self, max_wait):
+        # 用不等于判断, 写进程重建文件导致序号回退时也能返回
+        cursor = self.cursor
+        for _ in range(self.spin):
+            if self._sequence[0] != cursor:
+                return True
+        deadline = None if max_wait is None else time.time() + max_wait
+        while self._sequence[0] == cursor:
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+    def _read(self, max_items, max_wait):
+        if not self._wait(max_wait):
+            return self.records[:0].view(np.recarray)
+
+        start, end = self.cursor, self.sequence
+        if end < start:
+            # 写进程重新创建了文件, 从头开始读
+            log.warning('共享内存行情序号回退 {} -> {}, 从头读取'.format(start, end))
+            start = max(end - self.capacity, 0)
+        if end - start > self.capacity:
+            self.dropped += end - self.capacity - start
+            start = end - self.capacity
+        if max_items is not None:
+            end = min(end, start + max_items)
+
+        slots = np.arange(start, end, dtype=np.uint64) & np.uint64(self.mask)
+        batch = self.records[slots]
+        # 先复制记录再检查序号戳, 复制过程中被写进程覆盖的记录序号戳会变化
+        valid = self.stamps[slots] == np.arange(start + 1, end + 1, dtype=np.uint64)
+        if not valid.all():
+            self.dropped += int(len(valid) - valid.sum())
+            batch = batch[valid]
+        self.cursor = end
+        self.received += len(batch)
+        return batch.view(np.recarray)
+
+    @property
+    def lag(self):
+        return self.sequence - self.cursor
+
+    def qsize(self):
+        return self.lag
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'cursor': self.cursor,
+            'lag': self.lag,
+            'received': self.received,
+            'dropped': self.dropped,
+        }
+
+    def close(self):
+        del self._sequence, self.stamps, self.records
+        self.mmap.close()
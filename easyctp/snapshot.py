@@ -0,0 +1,186 @@
+import threading
+
+import numpy as np
+from ctp.futures import ApiStruct
+
+from easyctp.buffer import DEPTH_MARKET_DATA_DTYPE
+from easyctp.log import log
+
+
+class Subscription:
+    def __init__(self, table, callback, instrument_ids, condition):
+        self.table = table
+        self.callback = callback
+        self.instrument_ids = instrument_ids
+        self.condition = condition
+
+    def cancel(self):
+        self.table.unsubscribe(self)
+
+
+class SnapshotTable:
+    """
+    每个合约最新一条 tick 的内存快照, 数据保存在预分配的 numpy 数组中, 按 InstrumentID 定位到固定槽位.
+    只有一个写线程 (ctp 回调线程), 读取使用 seqlock, 不需要加锁.
+    订阅的回调在写线程中执行, 需要尽快返回
+    """
+
+    def __init__(self, capacity=4096):
+        self.dtype = DEPTH_MARKET_DATA_DTYPE
+        self.itemsize = self.dtype.itemsize
+        self.slots = {}
+        self.subscribers = {}
+        self.all_subscribers = []
+        self.changed = threading.Condition()
+        self.waiting = 0
+        self._grow_lock = threading.Lock()
+        self._state = self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        # ctypes 结构体数组保存数据, 写入时直接按槽位赋值, numpy 视图用于批量读取
+        structs = (ApiStruct.DepthMarketData * capacity)()
+        array = np.frombuffer(structs, dtype=self.dtype).view(np.recarray)
+        # 版本号放在 list 中, 避免每次更新都创建 numpy 标量
+        versions = [0] * capacity
+        return structs, array, versions
+
+    def update(self, tick):
+        instrument_id = tick.InstrumentID
+        slot = self.slots.get(instrument_id)
+        if slot is None:
+            slot = self._add(instrument_id)
+        structs, _, versions = self._state
+
+        # 写入期间版本号为奇数, 读取方发现版本号为奇数或前后不一致时重试
+        versions[slot] += 1
+        structs[slot] = tick
+        versions[slot] += 1
+
+        subscribers = self.subscribers.get(instrument_id)
+        if subscribers or self.all_subscribers:
+            self._notify(tick, subscribers)
+        if self.waiting:
+            with self.changed:
+                self.changed.notify_all()
+
+    def put_tick(self, tick):
+        # 与 MarketData 接口一致, 可以直接作为 MarketDataReplayer 等行情来源的接收对象
+        self.update(tick)
+
+    def _add(self, instrument_id):
+        with self._grow_lock:
+            slot = len(self.slots)
+            structs, array, versions = self._state
+            if slot >= len(structs):
+                state = self._allocate(len(structs) * 2)
+                state[1][:len(array)] = array
+                state[2][:len(versions)] = versions
+                self._state = state
+            self.slots[instrument_id] = slot
+            return slot
+
+    def _notify(self, tick, subscribers):
+        for subscription in (subscribers or []) + self.all_subscribers:
+            try:
+                if subscription.condition is None or subscription.condition(tick):
+                    subscription.callback(tick)
+            except Exception as e:
+                log.error('snapshot subscriber error: {}'.format(e))
+
+    def get(self, instrument_id):
+        """
+        :return: 最新 tick 的 DepthMarketData 副本, 没有数据时返回 None
+        """
+        slot = self.slots.get(self._encode(instrument_id))
+        if slot is None:
+            return None
+        while True:
+            structs, _, versions = self._state
+            version = versions[slot]
+            if version & 1:
+                continue
+            tick = ApiStruct.DepthMarketData.from_buffer_copy(structs, slot * self.itemsize)
+            if versions[slot] == version:
+                return tick
+
+    def get_record(self, instrument_id):
+        """
+        :return: 最新 tick 的 numpy record 副本
+        """
+        slot = self.slots.get(self._encode(instrument_id))
+        if slot is None:
+            return None
+        while True:
+            _, array, versions = self._state
+            version = versions[slot]
+            if version & 1:
+                continue
+            record = array[slot:slot + 1].copy()
+            if versions[slot] == version:
+                return record[0]
+
+    def snapshot(self):
+        """
+        :return: 所有合约最新 tick 的 recarray 副本, 各合约之间不保证是同一时刻
+        """
+        _, array, _ = self._state
+        return array[:len(self.slots)].copy()
+
+    def instruments(self):
+        return [instrument_id.decode() for instrument_id in self.slots]
+
+    def __contains__(self, instrument_id):
+        return self._encode(instrument_id) in self.slots
+
+    def __len__(self):
+        return len(self.slots)
+
+    def subscribe(self, callback, instrument_ids=None, condition=None):
+        """
+        :param callback: 合约有新 tick 时调用 callback(tick), tick 为回调中的原始结构体, 需要保存时请自行 copy
+        :param instrument_ids: 订阅的合约列表, None 表示全部合约
+        :param condition: 过滤函数 condition(tick), 返回 True 时才调用 callback
+        :return: Subscription, 调用 cancel() 取消订阅
+        """
+        instrument_ids = None if instrument_ids is None else [self._encode(x) for x in instrument_ids]
+        subscription = Subscription(self, callback, instrument_ids, condition)
+        # 写线程遍历的是列表本身, 这里整体替换列表而不是原地修改
+        if instrument_ids is None:
+            self.all_subscribers = self.all_subscribers + [subscription]
+        else:
+            for instrument_id in instrument_ids:
+                self.subscribers[instrument_id] = self.subscribers.get(instrument_id, []) + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription.instrument_ids is None:
+            self.all_subscribers = [x for x in self.all_subscribers if x is not subscription]
+            return
+        for instrument_id in subscription.instrument_ids:
+            self.subscribers[instrument_id] = [x for x in self.subscribers.get(instrument_id, [])
+                                               if x is not subscription]
+
+    def wait_for(self, instrument_id, predicate, timeout=None):
+        """
+        阻塞直到合约的最新 tick 满足 predicate(tick), 超时返回 None
+        """
+        with self.changed:
+            # 先登记再检查, 保证写线程在检查之后的更新一定会发出通知
+            self.waiting += 1
+            try:
+                result = self.changed.wait_for(lambda: self._check(instrument_id, predicate), timeout)
+            finally:
+                self.waiting -= 1
+        return result or None
+
+    def _check(self, instrument_id, predicate):
+        tick = self.get(instrument_id)
+        if tick is not None and predicate(tick):
+            return tick
+        return None
+
+    @staticmethod
+    def _encode(instrument_id):
+        if isinstance(instrument_id, str):
+            return instrument_id.encode()
+        return instrument_id
@@ -0,0 +1,283 @@
+import glob
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+from easyctp.log import log
+
+MAGIC = b'EZSP'
+# magic, 压缩后长度, crc32, 记录条数
+FRAME_HEADER = struct.Struct('<4sIII')
+
+
+def _pickle_dumps(records):
+    return pickle.dumps(records, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _join_lines(lines):
+    return b'\n'.join(lines)
+
+
+def _split_lines(data):
+    return data.split(b'\n') if data else []
+
+
+CODECS = {
+    'pickle': (_pickle_dumps, pickle.loads),
+    # influxdb line protocol 中的换行已经转义, 直接按行拼接, 回放时不需要重新编码
+    'lines': (_join_lines, _split_lines),
+}
+
+
+class WriteAheadSpool:
+    """
+    数据库不可用时保存待写批次的本地日志. 每批记录用 zlib 压缩并加上帧头 (长度, crc32, 条数) 追加到分段文件,
+    回放方按顺序读取并合并成大批次写入, 写入成功后 commit 更新 checkpoint, 重启后从 checkpoint 继续.
+    进程在写入成功之后, checkpoint 落盘之前退出时, 最后一次回放的数据会重复写入一次, 即至少一次 (at-least-once) 写入
+    """
+
+    def __init__(self, directory, name, codec='pickle', segment_bytes=64 << 20, level=1, fsync=True):
+        """
+        :param directory: 分段文件和 checkpoint 所在目录
+        :param name: 文件名前缀, 同一目录下的多个 spool 需要使用不同的 name
+        :param codec: 记录的序列化方式, 见 CODECS
+        :param segment_bytes: 单个分段文件超过该大小后新建下一个分段
+        :param level: zlib 压缩级别
+        :param fsync: 每次追加和 commit 后是否 fsync, 关闭时只保证进程崩溃不丢数据, 不保证机器掉电.
+            只有写入失败的批次和回放才会追加或 commit, 开启的开销很小
+        """
+        if codec not in CODECS:
+            raise ValueError('unknown spool codec: {}'.format(codec))
+        self.directory = directory
+        self.name = name
+        self.dumps, self.loads = CODECS[codec]
+        self.segment_bytes = segment_bytes
+        self.level = level
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self.checkpoint_path = os.path.join(directory, '{}.checkpoint'.format(name))
+
+        self.appended = 0
+        self.committed = 0
+        self.corrupted = 0
+        self.pending = 0
+
+        # 每个分段中可以读取的字节数
+        self.sizes = {}
+        # 每个分段中 checkpoint 之后尚未回放的条数, 跳过损坏的数据时按它扣除 pending
+        self.unread = {}
+        # 最近一次 read 的结束位置和在各分段中读取的条数
+        self._consumed = None
+        for path in sorted(glob.glob(os.path.join(directory, '{}-*.seg'.format(name)))):
+            self.sizes[self._sequence(path)] = os.path.getsize(path)
+        self.position = self._load_checkpoint()
+        self._remove_before(self.position[0])
+        for sequence in sorted(self.sizes):
+            self._recover(sequence, self.position[1] if sequence == self.position[0] else 0)
+
+        self._write_sequence = max(self.sizes) if self.sizes else self.position[0]
+        self._file = open(self.path(self._write_sequence), 'ab')
+        self.sizes[self._write_sequence] = self._file.tell()
+        self.unread.setdefault(self._write_sequence, 0)
+        self._reader = None
+        if self.pending:
+            log.info('{} spool has {} records to replay'.format(name, self.pending))
+
+    def path(self, sequence):
+        return os.path.join(self.directory, '{}-{:012d}.seg'.format(self.name, sequence))
+
+    @staticmethod
+    def _sequence(path):
+        return int(path.rsplit('-', 1)[1].split('.')[0])
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                sequence, offset = map(int, f.read().split())
+        except (OSError, ValueError):
+            sequence, offset = (min(self.sizes) if self.sizes else 0), 0
+        if sequence not in self.sizes:
+            # checkpoint 指向的分段已经不存在, 从之后最早的分段开始
+            following = [s for s in self.sizes if s > sequence]
+            sequence, offset = (min(following) if following else sequence), 0
+        return sequence, offset
+
+    def _recover(self, sequence, offset):
+        """
+        统计 offset 之后的条数, 截断进程退出时写了一半的帧
+        """
+        size = self.sizes[sequence]
+        self.unread[sequence] = 0
+        with open(self.path(sequence), 'rb') as f:
+            while offset + FRAME_HEADER.size <= size:
+                f.seek(offset)
+                magic, length, _, count = FRAME_HEADER.unpack(f.read(FRAME_HEADER.size))
+                if magic != MAGIC or offset + FRAME_HEADER.size + length > size:
+                    break
+                self.pending += count
+                self.unread[sequence] += count
+                offset += FRAME_HEADER.size + length
+        if offset < size:
+            log.warning('{} spool segment {} truncated from {} to {} bytes'.format(self.name, sequence, size, offset))
+            with open(self.path(sequence), 'r+b') as f:
+                f.truncate(offset)
+            self.sizes[sequence] = offset
+
+    def append(self, records):
+        """
+        追加一批记录, 可以在多个线程中调用
+        """
+        data = zlib.compress(self.dumps(records), self.level)
+        frame = FRAME_HEADER.pack(MAGIC, len(data), zlib.crc32(data), len(records)) + data
+        with self._lock:
+            if self.sizes[self._write_sequence] >= self.segment_bytes:
+                self._rotate()
+            self._file.write(frame)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self.sizes[self._write_sequence] += len(frame)
+            self.unread[self._write_sequence] += len(records)
+            self.pending += len(records)
+            self.appended += len(records)
+            self._not_empty.notify_all()
+
+    def _rotate(self):
+        self._file.close()
+        self._write_sequence += 1
+        self._file = open(self.path(self._write_sequence), 'ab')
+        self.sizes[self._write_sequence] = 0
+        self.unread[self._write_sequence] = 0
+
+    def wait(self, timeout=None):
+        """
+        等待有可回放的数据
+        """
+        with self._lock:
+            if not self.pending:
+                self._not_empty.wait(timeout)
+            return self.pending > 0
+
+    def wake(self):
+        """
+        唤醒 wait 中的线程, 用于关闭时
+        """
+        with self._lock:
+            self._not_empty.notify_all()
+
+    def read(self, max_records):
+        """
+        从当前 checkpoint 开始读取至少一帧, 累计超过 max_records 条后停止, 只能在一个线程中调用.
+        损坏的帧计入 corrupted 后跳过, 帧头损坏时无法找到下一帧, 跳过该分段的剩余部分
+        :return: (记录列表, 读取结束的位置, 读取和跳过的总条数), 写入成功后把后两项传给 commit
+        """
+        sequence, offset = self.position
+        records = []
+        count = 0
+        consumed = {}
+        while len(records) < max_records:
+            with self._lock:
+                end = self.sizes.get(sequence, 0)
+                unread = self.unread.get(sequence, 0)
+                following = [s for s in self.sizes if s > sequence]
+            if offset >= end:
+                if not following:
+                    break
+                sequence, offset = min(following), 0
+                continue
+
+            f = self._open_reader(sequence)
+            f.seek(offset)
+            magic, length, crc, frame_count = FRAME_HEADER.unpack(f.read(FRAME_HEADER.size))
+            if magic != MAGIC or offset + FRAME_HEADER.size + length > end:
+                # 同一时刻读到的 end 和 unread 是一致的, 两者之差就是跳过的条数
+                skipped = unread - consumed.get(sequence, 0)
+                log.error('{} spool segment {} corrupted at offset {}, skip the rest and drop {} records'.format(
+                    self.name, sequence, offset, skipped))
+                self.corrupted += skipped
+                consumed[sequence] = unread
+                count += skipped
+                offset = end
+                continue
+            data = f.read(length)
+            offset += FRAME_HEADER.size + length
+            consumed[sequence] = consumed.get(sequence, 0) + frame_count
+            count += frame_count
+            if zlib.crc32(data) != crc:
+                log.error('{} spool frame checksum mismatch, drop {} records'.format(self.name, frame_count))
+                self.corrupted += frame_count
+                continue
+            try:
+                records.extend(self.loads(zlib.decompress(data)))
+            except Exception as e:
+                log.error('{} spool frame decode error: {}, drop {} records'.format(self.name, e, frame_count))
+                self.corrupted += frame_count
+        self._consumed = ((sequence, offset), consumed)
+        return records, (sequence, offset), count
+
+    def _open_reader(self, sequence):
+        if self._reader is None or self._reader[0] != sequence:
+            if self._reader is not None:
+                self._reader[1].close()
+            self._reader = (sequence, open(self.path(sequence), 'rb'))
+        return self._reader[1]
+
+    def commit(self, position, count):
+        """
+        read 返回的记录写入成功后保存 checkpoint, 删除已经回放完的分段
+        :param position: read 返回的位置
+        :param count: read 返回的条数
+        """
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('{} {}\n'.format(*position))
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+        with self._lock:
+            if self._consumed is not None and self._consumed[0] == position:
+                for sequence, consumed in self._consumed[1].items():
+                    if sequence in self.unread:
+                        self.unread[sequence] -= consumed
+            self._consumed = None
+            self.position = position
+            self.pending -= count
+            self.committed += count
+            if not self.pending and position == (self._write_sequence, self.sizes[self._write_sequence]) \
+                    and position[1] > 0:
+                # 全部回放完后换一个新的分段, 已经回放的分段立即删除
+                self._rotate()
+                self.position = (self._write_sequence, 0)
+            self._remove_before(self.position[0])
+
+    def _remove_before(self, sequence):
+        for old in [s for s in self.sizes if s < sequence]:
+            del self.sizes[old]
+            self.unread.pop(old, None)
+            try:
+                os.remove(self.path(old))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+        if self._reader is not None:
+            self._reader[1].close()
+            self._reader = None
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'segments': len(self.sizes),
+            'bytes': sum(self.sizes.values()),
+            'appended': self.appended,
+            'committed': self.committed,
+            'corrupted': self.corrupted,
+        }
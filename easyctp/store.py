@@ -0,0 +1,284 @@
+import ctypes
+import json
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from easyctp.buffer import DEPTH_MARKET_DATA_DTYPE
+from easyctp.log import log
+from easyctp.validator import session_time_key, session_time_keys
+
+INDEX_FILE = 'index.json'
+TICK_SUFFIX = '.ticks'
+
+
+class TickStore:
+    """
+    本地追加写的 tick 存储, 目录结构为 root/TradingDay/InstrumentID.ticks,
+    每条记录就是 DepthMarketData 结构体的原始内存, 与 DEPTH_MARKET_DATA_DTYPE 完全一致.
+    写缓冲在超过 buffer_size 或距离上次刷新超过 flush_interval 时写入文件, 同时更新 index.json,
+    打开的文件按最近使用保留 max_open_files 个, 全市场订阅时不会超过进程的文件数限制
+    """
+
+    def __init__(self, root, buffer_size=1 << 16, fsync=True, flush_interval=1.0, max_open_files=256):
+        """
+        :param root: 存储根目录
+        :param buffer_size: 每个合约的写缓冲大小, 超过后一次性写入文件
+        :param fsync: 切换交易日和关闭时是否 fsync
+        :param flush_interval: 缓冲中的数据最多保留多少秒就写入文件
+        :param max_open_files: 同时打开的文件数上限
+        """
+        self.root = root
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self.flush_interval = flush_interval
+        self.max_open_files = max_open_files
+        self.dtype = DEPTH_MARKET_DATA_DTYPE
+        self.itemsize = self.dtype.itemsize
+
+        self.trading_day = None
+        self._files = OrderedDict()
+        self._buffers = {}
+        self._index = {}
+        # 当天写入过的合约, 切换交易日时 fsync
+        self._written = set()
+        self._index_dirty = False
+        self._last_flush = time.time()
+
+    def save(self, item):
+        trading_day = item.TradingDay
+        if trading_day != self.trading_day:
+            self.rotate(trading_day)
+        update_time = (item.UpdateTime, item.UpdateMillisec)
+        self._append(item.InstrumentID, ctypes.string_at(ctypes.addressof(item), self.itemsize), 1,
+                     update_time, update_time)
+        self._maybe_flush()
+
+    def save_batch(self, batch):
+        """
+        :param batch: TickBuffer 返回的 recarray 或 ctypes 结构体列表
+        """
+        if not isinstance(batch, np.ndarray):
+            for item in batch:
+                self.save(item)
+            return
+        if len(batch) == 0:
+            return
+
+        trading_days = batch['TradingDay']
+        for trading_day in np.unique(trading_days).tolist():
+            day_batch = batch if len(batch) == 1 or (trading_days == trading_day).all() \
+                else batch[trading_days == trading_day]
+            if trading_day != self.trading_day:
+                self.rotate(trading_day)
+
+            instrument_ids = day_batch['InstrumentID']
+            uniques, codes = np.unique(instrument_ids, return_inverse=True)
+            order = np.argsort(codes.reshape(-1), kind='stable')
+            records = np.ascontiguousarray(day_batch[order])
+            bounds = np.searchsorted(codes.reshape(-1)[order], np.arange(len(uniques) + 1))
+            for i, instrument_id in enumerate(uniques.tolist()):
+                rows = records[bounds[i]:bounds[i + 1]]
+                self._append(instrument_id, rows.tobytes(), len(rows),
+                             (rows['UpdateTime'][0], int(rows['UpdateMillisec'][0])),
+                             (rows['UpdateTime'][-1], int(rows['UpdateMillisec'][-1])))
+        self._maybe_flush()
+
+    def rotate(self, trading_day=None):
+        """
+        把当前交易日的缓冲写入磁盘, 写入索引并关闭文件, 然后切换到新的交易日
+        """
+        if self.trading_day is not None:
+            for instrument_id in list(self._buffers):
+                self._flush(instrument_id)
+            for f in self._files.values():
+                f.close()
+            if self.fsync:
+                for instrument_id in self._written:
+                    fd = os.open(self._path(instrument_id), os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+            self._write_index()
+            log.info('tick store rotated, trading day: {}, instruments: {}'.format(
+                self.trading_day.decode(), len(self._written)))
+
+        self._files = OrderedDict()
+        self._buffers = {}
+        self._index = {}
+        self._written = set()
+        self._index_dirty = False
+        self.trading_day = trading_day
+        if trading_day is not None:
+            os.makedirs(self.day_path(trading_day), exist_ok=True)
+            self._index = self._read_index()
+
+    def flush(self):
+        """
+        把所有缓冲写入文件并更新 index.json
+        """
+        for instrument_id in list(self._buffers):
+            self._flush(instrument_id)
+        if self._index_dirty:
+            self._write_index()
+        self._last_flush = time.time()
+
+    def _maybe_flush(self):
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def close(self):
+        self.rotate(None)
+
+    def day_path(self, trading_day):
+        if isinstance(trading_day, bytes):
+            trading_day = trading_day.decode()
+        return os.path.join(self.root, trading_day)
+
+    def _append(self, instrument_id, data, count, first, last):
+        buffer = self._buffers.get(instrument_id)
+        if buffer is None:
+            buffer = self._buffers[instrument_id] = bytearray()
+        buffer += data
+
+        entry = self._index.get(instrument_id)
+        if entry is None:
+            entry = self._index[instrument_id] = {'count': 0, 'first': None, 'last': None}
+            entry['first'] = '{}.{:03d}'.format(first[0].decode(), first[1])
+        entry['count'] += count
+        entry['last'] = '{}.{:03d}'.format(last[0].decode(), last[1])
+        self._index_dirty = True
+
+        if len(buffer) >= self.buffer_size:
+            self._flush(instrument_id)
+
+    def _flush(self, instrument_id):
+        buffer = self._buffers.pop(instrument_id, None)
+        if not buffer:
+            return
+        f = self._files.get(instrument_id)
+        if f is None:
+            if len(self._files) >= self.max_open_files:
+                self._files.popitem(last=False)[1].close()
+            f = self._files[instrument_id] = open(self._path(instrument_id), 'ab', buffering=0)
+            self._written.add(instrument_id)
+        else:
+            self._files.move_to_end(instrument_id)
+        f.write(buffer)
+
+    def _path(self, instrument_id):
+        return os.path.join(self.day_path(self.trading_day), instrument_id.decode() + TICK_SUFFIX)
+
+    def _read_index(self):
+        path = os.path.join(self.day_path(self.trading_day), INDEX_FILE)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            index = json.load(f)
+        return {instrument_id.encode(): entry for instrument_id, entry in index['instruments'].items()}
+
+    def _write_index(self):
+        # 只在数据写入文件之后调用, 索引中的条数不会超过文件中的记录数
+        self._index_dirty = False
+        path = os.path.join(self.day_path(self.trading_day), INDEX_FILE)
+        index = {
+            'itemsize': self.itemsize,
+            'fields': list(self.dtype.names),
+            'instruments': {instrument_id.decode(): entry for instrument_id, entry in self._index.items()},
+        }
+        with open(path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(path + '.tmp', path)
+
+
+class TickStoreReader:
+    """
+    以 numpy memmap 方式读取 TickStore 的数据, 不需要任何解析
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.dtype = DEPTH_MARKET_DATA_DTYPE
+        self._keys = {}
+
+    def trading_days(self):
+        return sorted(name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name)))
+
+    def index(self, trading_day):
+        path = os.path.join(self.root, trading_day, INDEX_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            index = json.load(f)
+        if index['itemsize'] != self.dtype.itemsize:
+            raise ValueError('tick store record size {} does not match DepthMarketData size {}'.format(
+                index['itemsize'], self.dtype.itemsize))
+        return index
+
+    def instruments(self, trading_day):
+        index = self.index(trading_day)
+        if index is not None:
+            return sorted(index['instruments'])
+        return sorted(name[:-len(TICK_SUFFIX)] for name in os.listdir(os.path.join(self.root, trading_day))
+                      if name.endswith(TICK_SUFFIX))
+
+    def load(self, trading_day, instrument_id, start=None, end=None):
+        """
+        :param trading_day: 交易日, 如 '20170104'
+        :param instrument_id: 合约代码, 如 'rb1705'
+        :param start: 起始时间 (包含), 如 '21:00:00', 按交易时段顺序比较, 夜盘早于日盘
+        :param end: 结束时间 (不包含)
+        :return: 指向文件内容的只读 recarray
+        """
+        path = os.path.join(self.root, trading_day, instrument_id + TICK_SUFFIX)
+        if not os.path.exists(path) or os.path.getsize(path) < self.dtype.itemsize:
+            return np.zeros(0, dtype=self.dtype).view(np.recarray)
+        count = os.path.getsize(path) // self.dtype.itemsize
+        records = np.memmap(path, dtype=self.dtype, mode='r', shape=(count,)).view(np.recarray)
+        if start is None and end is None:
+            return records
+
+        keys = self.time_keys(path, records)
+        lo = 0 if start is None else np.searchsorted(keys, session_time_key(trading_day, start), side='left')
+        hi = len(records) if end is None else np.searchsorted(keys, session_time_key(trading_day, end), side='left')
+        return records[lo:hi]
+
+    def load_day(self, trading_day, instrument_ids=None, start=None, end=None):
+        """
+        :return: {InstrumentID: recarray}
+        """
+        instrument_ids = instrument_ids or self.instruments(trading_day)
+        return {instrument_id: self.load(trading_day, instrument_id, start, end) for instrument_id in instrument_ids}
+
+    def replay(self, trading_day, instrument_ids=None, start=None, end=None):
+        """
+        :return: 当天所有合约的 tick 按交易时间排序合并后的 recarray
+        """
+        arrays = [records for records in self.load_day(trading_day, instrument_ids, start, end).values()
+                  if len(records) > 0]
+        if not arrays:
+            return np.zeros(0, dtype=self.dtype).view(np.recarray)
+        records = _concatenate(arrays, self.dtype)
+        keys = session_time_keys(records)
+        return records[np.argsort(keys, kind='stable')].view(np.recarray)
+
+    def time_keys(self, path, records):
+        cached = self._keys.get(path)
+        if cached is not None and len(cached) == len(records):
+            return cached
+        # 同一合约的 tick 按到达顺序写入, 这里取累计最大值保证 searchsorted 的前提成立
+        keys = np.maximum.accumulate(session_time_keys(records))
+        self._keys[path] = keys
+        return keys
+
+
+def _concatenate(arrays, dtype):
+    """
+    np.concatenate 默认会去掉结构体中的对齐填充, 这里指定输出数组保持与 DepthMarketData 相同的内存布局
+    """
+    records = np.empty(sum(len(records) for records in arrays), dtype=dtype)
+    np.concatenate(arrays, out=records)
+    return records
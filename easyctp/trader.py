@@ -1,34 +1,61 @@
 import itertools
 import tempfile
 import time
-from collections import defaultdict
 from copy import copy
 from queue import Queue, Empty
 
 from ctp.futures import TraderApi, ApiStruct
 
 from easyctp.log import log
+from easyctp.query import CtpError, QueryScheduler
 
 
 class ResultMap:
+    """
+    按 request id 保存查询响应, 发送请求前先 create, 之后到达的响应才会保留.
+    未知或已经结束的请求的响应直接丢弃, 不会留下无人读取的队列
+    """
+
     def __init__(self):
-        self.map = defaultdict(Queue)
+        self.map = {}
+
+    def create(self, request_id):
+        # 必须在发送请求前调用, 避免与回调线程同时创建
+        self.map[request_id] = Queue()
+
+    def discard(self, request_id):
+        self.map.pop(request_id, None)
 
     def get(self, request_id, timeout=None):
-        res_collect = []
+        return list(self.iter(request_id, timeout))
+
+    def iter(self, request_id, timeout=None):
+        """
+        逐条返回响应, 不需要等到 bIsLast
+        :param timeout: 等待每一条响应的超时
+        """
+        queue = self.map.setdefault(request_id, Queue())
         while True:
             try:
-                *res, is_last = self.map[request_id].get(timeout=timeout)
+                *res, is_last = queue.get(timeout=timeout)
             except Empty as e:
+                self.map.pop(request_id, None)
                 raise TimeoutError from e
-            res_collect.append(res)
             if is_last:
-                del self.map[request_id]
-                return res_collect
+                self.map.pop(request_id, None)
+            yield res
+            if is_last:
+                return
 
     def put(self, request_id, *args):
+        queue = self.map.get(request_id)
+        if queue is None:
+            return
         item = tuple(copy(x) for x in args)
-        self.map[request_id].put(item)
+        queue.put(item)
+
+    def fail(self, request_id, rsp_info):
+        self.put(request_id, None, rsp_info, True)
 
 
 class EasyTrader(TraderApi):
@@ -42,6 +69,8 @@ class EasyTrader(TraderApi):
         self.request_id = itertools.count()
         self.results_map = ResultMap()
         self.login_success = False
+        self.trading_day = None
+        self._scheduler = None
 
     def login(self, user, password, broker, front):
         """
@@ -50,6 +79,18 @@ class EasyTrader(TraderApi):
         :param broker: broker id
         :param front: 行情服务器地址, 类似 tcp://127.0.0.1:8000
         """
+        self.connect(user, password, broker, front)
+
+        while True:
+            if self.login_success:
+                return
+            else:
+                time.sleep(0.01)
+
+    def connect(self, user, password, broker, front):
+        """
+        连接交易前置, 连接成功后在 OnFrontConnected 中自动登录, 不等待登录结果
+        """
         self.user = self.auto_encode_bytes(user)
         self.password = self.auto_encode_bytes(password)
         self.broker = self.auto_encode_bytes(broker)
@@ -60,12 +101,6 @@ class EasyTrader(TraderApi):
         self.SubscribePrivateTopic(ApiStruct.TERT_RESUME)
         self.Init()
 
-        while True:
-            if self.login_success:
-                return
-            else:
-                time.sleep(0.01)
-
     @staticmethod
     def auto_encode_bytes(value):
         if isinstance(value, str):
@@ -76,6 +111,7 @@ class EasyTrader(TraderApi):
         assert isinstance(pRspInfo, ApiStruct.RspInfo)
         if pRspInfo.ErrorID == 0:
             log.info('登录成功')
+            self.trading_day = pRspUserLogin.TradingDay
             self.login_success = True
         else:
             log.error('登录失败 ErrorID: {}, ErrorMsg: {}'.format(pRspInfo.ErrorID, pRspInfo.ErrorMsg.decode('gbk')))
@@ -96,16 +132,32 @@ class EasyTrader(TraderApi):
     def OnRspQryInstrument(self, pInstrument, pRspInfo, nRequestID, bIsLast):
         self.results_map.put(nRequestID, pInstrument, pRspInfo, bIsLast)
 
+    def OnRspQryInstrumentMarginRate(self, pInstrumentMarginRate, pRspInfo, nRequestID, bIsLast):
+        self.results_map.put(nRequestID, pInstrumentMarginRate, pRspInfo, bIsLast)
+
+    def OnRspQryInstrumentCommissionRate(self, pInstrumentCommissionRate, pRspInfo, nRequestID, bIsLast):
+        self.results_map.put(nRequestID, pInstrumentCommissionRate, pRspInfo, bIsLast)
+
+    def OnRspQryInvestorPosition(self, pInvestorPosition, pRspInfo, nRequestID, bIsLast):
+        self.results_map.put(nRequestID, pInvestorPosition, pRspInfo, bIsLast)
+
+    def OnRspQryTradingAccount(self, pTradingAccount, pRspInfo, nRequestID, bIsLast):
+        self.results_map.put(nRequestID, pTradingAccount, pRspInfo, bIsLast)
+
     def OnRspError(self, pRspInfo, nRequestID, bIsLast):
         log.error('发生错误 ErrorID: {} ErrorMsg: {}'.format(pRspInfo.ErrorID, pRspInfo.ErrorMsg.decode('gbk')))
+        # 让等待该请求的查询立即结束, 不必等到超时
+        self.results_map.fail(nRequestID, pRspInfo)
+
+    @property
+    def scheduler(self):
+        if self._scheduler is None:
+            self._scheduler = QueryScheduler(self)
+        return self._scheduler
 
     def query_all_instruments(self, timeout=10):
-        instrument = ApiStruct.QryInstrument()
-        request_id = next(self.request_id)
-        self.ReqQryInstrument(instrument, request_id)
-
-        instrument_ids = set()
-        response = self.results_map.get(request_id, timeout=timeout)
-        for pInstrument, _ in response:
-            instrument_ids.add(pInstrument.InstrumentID)
-        return instrument_ids
+        """
+        :param timeout: 等待每一条响应的超时, 被流控时自动重试
+        :return: 合约代码集合
+        """
+        return {pInstrument.InstrumentID for pInstrument in self.scheduler.query_instruments(timeout=timeout)}
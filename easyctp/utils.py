@@ -1,7 +1,21 @@
+import datetime
+from functools import lru_cache
+
+from easyctp.converter import converter_for
+
+
 def dict_iter(self):
-    for k, _ in self._fields_:
-        v = getattr(self, k)
-        if not isinstance(v, bytes):
-            yield k, v
-        else:
-            yield k, v.decode()
\ No newline at end of file
+    return iter(converter_for(type(self))(self).items())
+
+
+@lru_cache(maxsize=1 << 16)
+def _parse_second(day, update_time):
+    return datetime.datetime(int(day[0:4]), int(day[4:6]), int(day[6:8]),
+                             int(update_time[0:2]), int(update_time[3:5]), int(update_time[6:8]))
+
+
+def parse_tick_time(day, update_time, millisec):
+    """
+    直接按定长格式解析 ActionDay/TradingDay (20170104) 与 UpdateTime (09:00:01), 同一秒的结果会被缓存
+    """
+    return _parse_second(day, update_time) + datetime.timedelta(milliseconds=int(millisec))
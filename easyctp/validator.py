@@ -0,0 +1,270 @@
+import math
+import sys
+from copy import copy
+import time
+from collections import Counter
+
+import numpy as np
+
+from easyctp.log import log
+
+DBL_MAX = sys.float_info.max
+
+# 夜盘 21:00 开始, 将时间整体平移 18 小时后同一交易日内的时间单调递增
+SESSION_SHIFT_MS = 18 * 3600 * 1000
+DAY_MS = 24 * 3600 * 1000
+# 行情时间为北京时间
+UTC_OFFSET_MS = 8 * 3600 * 1000
+
+SENTINEL_PRICE_FIELDS = ('ClosePrice', 'SettlementPrice', 'PreDelta', 'CurrDelta')
+
+
+def clock_ms(update_time):
+    """
+    :param update_time: 如 b'09:30:01'
+    :return: 当天零点起的毫秒数
+    """
+    return (int(update_time[0:2]) * 3600 + int(update_time[3:5]) * 60 + int(update_time[6:8])) * 1000
+
+
+def column(batch, name, dtype=None):
+    """
+    从 recarray 批次或 ctypes 结构体列表中取出一列 numpy 数组
+    """
+    if isinstance(batch, np.ndarray):
+        return batch[name]
+    return np.array([getattr(item, name) for item in batch], dtype=dtype)
+
+
+def digits(values, width):
+    """
+    把定长数字字符串列 (如 b'20170104') 按字节解析为整数矩阵, 每列一个字节
+    """
+    values = np.ascontiguousarray(values, dtype='S{}'.format(width))
+    return values.view(np.uint8).reshape(-1, width).astype(np.int64) - ord('0')
+
+
+def session_time_keys(batch):
+    """
+    :return: 按 TradingDay 和交易时段排序的毫秒级时间戳, 用于判断同一合约的时间是否单调
+    """
+    update_time = digits(column(batch, 'UpdateTime', 'S9'), 8)
+    seconds = ((update_time[:, 0] * 10 + update_time[:, 1]) * 3600 +
+               (update_time[:, 3] * 10 + update_time[:, 4]) * 60 +
+               update_time[:, 6] * 10 + update_time[:, 7])
+    millisec = column(batch, 'UpdateMillisec', np.int64).astype(np.int64)
+    day_ms = (seconds * 1000 + millisec - SESSION_SHIFT_MS) % DAY_MS
+
+    trading_day = digits(column(batch, 'TradingDay', 'S9'), 8)
+    trading_day = trading_day.dot(10 ** np.arange(7, -1, -1, dtype=np.int64))
+    return trading_day * DAY_MS + day_ms
+
+
+def session_time_parsable(batch):
+    """
+    :return: TradingDay 和 UpdateTime 的数字位是否都是数字, 只有这些 tick 参与时间单调性检查
+    """
+    update_time = digits(column(batch, 'UpdateTime', 'S9'), 8)[:, [0, 1, 3, 4, 6, 7]]
+    trading_day = digits(column(batch, 'TradingDay', 'S9'), 8)
+    return ((update_time >= 0) & (update_time <= 9)).all(axis=1) & ((trading_day >= 0) & (trading_day <= 9)).all(axis=1)
+
+
+def item_time_parsable(item):
+    """
+    :return: 单条 tick 的 TradingDay 和 UpdateTime 是否可以解析, 与 session_time_parsable 对应
+    """
+    update_time = item.UpdateTime
+    return len(update_time) == 8 and len(item.TradingDay) == 8 and item.TradingDay.isdigit() and \
+        update_time[0:2].isdigit() and update_time[3:5].isdigit() and update_time[6:8].isdigit()
+
+
+def session_time_key(trading_day, update_time, millisec=0):
+    """
+    单条 tick 的 session_time_keys, 如 session_time_key(b'20170104', b'21:00:00')
+    """
+    if isinstance(trading_day, bytes):
+        trading_day = trading_day.decode()
+    if isinstance(update_time, bytes):
+        update_time = update_time.decode()
+    seconds = int(update_time[0:2]) * 3600 + int(update_time[3:5]) * 60 + int(update_time[6:8])
+    return int(trading_day) * DAY_MS + (seconds * 1000 + millisec - SESSION_SHIFT_MS) % DAY_MS
+
+
+class TickValidator:
+    """
+    对整批 tick 做向量化校验, 返回有效性掩码, 拒绝原因按计数聚合并限频输出日志.
+    时间单调性只用其他规则都通过的 tick 推进, 同一串 tick 逐条校验和按任意大小分批校验的结果相同.
+    传入的批次可能是环形缓冲区的视图或 TickBus 分发给多个订阅者的对象, 校验和 sanitize 都不会修改原数据
+    """
+
+    def __init__(self, log_interval=10, check_crossed=True, check_monotonic=True):
+        self.log_interval = log_interval
+        self.check_crossed = check_crossed
+        self.check_monotonic = check_monotonic
+
+        self.last_time = {}
+        self.rejected = Counter()
+        self.sanitized = Counter()
+        self._pending = Counter()
+        self._last_report = time.time()
+
+    def validate(self, batch):
+        size = len(batch)
+        if size == 0:
+            return np.zeros(0, dtype=bool)
+
+        instrument_ids = column(batch, 'InstrumentID', 'S31')
+        update_time = column(batch, 'UpdateTime', 'S9')
+        action_day = column(batch, 'ActionDay', 'S9')
+        time_valid = np.char.str_len(update_time) == 8
+        valid = time_valid.copy()
+        self._reject('invalid_update_time', ~time_valid)
+
+        day_valid = np.char.str_len(action_day) == 8
+        self._reject('invalid_action_day', valid & ~day_valid)
+        valid &= day_valid
+
+        id_valid = np.char.str_len(instrument_ids) > 2
+        self._reject('invalid_instrument_id', valid & ~id_valid)
+        valid &= id_valid
+
+        last_price = column(batch, 'LastPrice', np.float64)
+        price_valid = np.isfinite(last_price) & (last_price != DBL_MAX)
+        self._reject('invalid_last_price', valid & ~price_valid)
+        valid &= price_valid
+
+        if self.check_crossed:
+            crossed = ((column(batch, 'BidVolume1', np.int64) > 0) & (column(batch, 'AskVolume1', np.int64) > 0) &
+                       (column(batch, 'BidPrice1', np.float64) > column(batch, 'AskPrice1', np.float64)))
+            self._reject('crossed_book', valid & crossed)
+            valid &= ~crossed
+
+        if self.check_monotonic:
+            monotonic = self._monotonic(batch, instrument_ids, valid & session_time_parsable(batch))
+            self._reject('non_monotonic_time', valid & ~monotonic)
+            valid &= monotonic
+
+        self._report()
+        return valid
+
+    def validate_item(self, item):
+        """
+        单条 tick 的标量版本 validate, 规则与批量校验一致, 避免为一条数据构造 numpy 数组
+        """
+        reason = None
+        if len(item.UpdateTime) != 8:
+            reason = 'invalid_update_time'
+        elif len(item.ActionDay) != 8:
+            reason = 'invalid_action_day'
+        elif len(item.InstrumentID) <= 2:
+            reason = 'invalid_instrument_id'
+        elif not math.isfinite(item.LastPrice) or item.LastPrice == DBL_MAX:
+            reason = 'invalid_last_price'
+        elif self.check_crossed and item.BidVolume1 > 0 and item.AskVolume1 > 0 and item.BidPrice1 > item.AskPrice1:
+            reason = 'crossed_book'
+
+        if self.check_monotonic and reason is None and item_time_parsable(item):
+            key = session_time_key(item.TradingDay, item.UpdateTime, item.UpdateMillisec)
+            if key < self.last_time.get(item.InstrumentID, -1):
+                reason = 'non_monotonic_time'
+            else:
+                self.last_time[item.InstrumentID] = key
+
+        if reason is not None:
+            self.rejected[reason] += 1
+            self._pending[reason] += 1
+        self._report()
+        return reason is None
+
+    def filter(self, batch):
+        """
+        :return: 有效的 tick, 哨兵值已替换为 nan, 需要替换的数据都是副本
+        """
+        mask = self.validate(batch)
+        if isinstance(batch, np.ndarray):
+            # 布尔索引总是返回副本, 可以直接修改
+            return self._sanitize_array(batch[mask])
+        return [self.sanitize_item(item) for item, ok in zip(batch, mask) if ok]
+
+    def _monotonic(self, batch, instrument_ids, checkable):
+        keys = session_time_keys(batch)
+        uniques, codes = np.unique(instrument_ids, return_inverse=True)
+        codes = codes.reshape(-1)
+        previous = np.array([self.last_time.get(uid, -1) for uid in uniques.tolist()], dtype=np.int64)
+        if not checkable.any():
+            return np.ones(len(keys), dtype=bool)
+
+        # 无法解析的时间和没有历史记录的合约都当作最早时间处理
+        latest = keys[checkable].max()
+        floor = max(min(keys[checkable].min(), previous[previous >= 0].min(initial=latest)),
+                    latest - (1 << 39)) - 1
+        keys = np.where(checkable, np.maximum(keys, floor), floor)
+        previous = np.maximum(previous, floor)
+
+        order = np.argsort(codes, kind='stable')
+        sorted_codes = codes[order].astype(np.int64)
+        sorted_keys = keys[order]
+
+        # 把合约编号放到高位, 一次 maximum.accumulate 就得到每个合约内的累计最大时间
+        high = sorted_codes << 40
+        running_max = np.maximum.accumulate(high | (sorted_keys - floor)) - high + floor
+
+        group_start = np.ones(len(sorted_codes), dtype=bool)
+        group_start[1:] = sorted_codes[1:] != sorted_codes[:-1]
+        prior_max = np.empty_like(running_max)
+        prior_max[1:] = running_max[:-1]
+        prior_max[group_start] = floor
+        prior_max = np.maximum(prior_max, previous[sorted_codes])
+        sorted_ok = (sorted_keys >= prior_max) | (sorted_keys == floor)
+
+        group_end = np.ones(len(sorted_codes), dtype=bool)
+        group_end[:-1] = group_start[1:]
+        for code, group_max in zip(sorted_codes[group_end].tolist(), running_max[group_end].tolist()):
+            if group_max > previous[code]:
+                self.last_time[uniques[code]] = group_max
+
+        ok = np.empty_like(sorted_ok)
+        ok[order] = sorted_ok
+        return ok
+
+    def sanitize_item(self, item):
+        """
+        未结算时 ClosePrice/SettlementPrice 等字段为 DBL_MAX, 替换为 nan 避免写入数据库
+        :return: 没有哨兵值时返回原对象, 否则返回替换后的副本
+        """
+        sanitized = item
+        for name in SENTINEL_PRICE_FIELDS:
+            if getattr(item, name, None) == DBL_MAX:
+                if sanitized is item:
+                    sanitized = copy(item)
+                setattr(sanitized, name, float('nan'))
+                self.sanitized[name] += 1
+        return sanitized
+
+    def _sanitize_array(self, batch):
+        # 只用于 filter 中已经复制过的批次
+        for name in SENTINEL_PRICE_FIELDS:
+            if name not in batch.dtype.names:
+                continue
+            values = batch[name]
+            sentinel = values == DBL_MAX
+            if sentinel.any():
+                values[sentinel] = np.nan
+                self.sanitized[name] += int(sentinel.sum())
+        return batch
+
+    def _reject(self, reason, mask):
+        count = int(np.count_nonzero(mask))
+        if count:
+            self.rejected[reason] += count
+            self._pending[reason] += count
+
+    def _report(self):
+        now = time.time()
+        if now - self._last_report < self.log_interval:
+            return
+        if self._pending:
+            log.warning('rejected ticks in last {:.0f}s: {}, total: {}'.format(
+                now - self._last_report, dict(self._pending), dict(self.rejected)))
+            self._pending.clear()
+        self._last_report = now
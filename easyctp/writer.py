@@ -0,0 +1,332 @@
+import glob
+import os
+import pickle
+import threading
+import time
+from collections import deque
+
+from easyctp.log import log
+from easyctp.metrics import REGISTRY
+from easyctp.spool import WriteAheadSpool
+
+
+class BatchWriter:
+    """
+    通用的批量写入器: 按条数/字节数或超时时间刷新, 待写队列有上限, 队列满时按 overflow 策略处理
+    overflow:
+        block: 阻塞生产者直到队列有空间
+        drop_oldest: 丢弃最早的待写数据
+        spill: 把新数据写入 spill_dir 下的临时文件, 队列空闲时再读回写入
+    设置 spool_dir 后写入失败的批次不再丢弃, 而是编码后追加到 WriteAheadSpool, 由回放线程在数据库恢复后批量写入
+    """
+    OVERFLOW_POLICIES = ('block', 'drop_oldest', 'spill')
+
+    def __init__(self, write, encode=None, size=None, batch_size=5000, batch_bytes=None, flush_interval=1.0,
+                 max_pending=500000, overflow='block', spill_dir=None, worker=1, name='writer', spool_dir=None,
+                 spool_codec='pickle', replay_batch_size=None, retry_interval=1.0, max_retry_interval=30.0,
+                 retryable=None, max_replay_attempts=None, spool_fsync=True):
+        """
+        :param write: 实际写入函数, 参数为一批编码后的记录
+        :param encode: 在写入线程中把 put 进来的一组原始数据转换为记录列表, None 表示不转换
+        :param size: 计算单条记录字节数的函数, 配合 batch_bytes 使用
+        :param batch_size: 单次写入的最大记录数
+        :param batch_bytes: 单次写入的最大字节数, None 表示不限制
+        :param flush_interval: 批次中第一条数据到达后最多等待多少秒就写入
+        :param max_pending: 待写队列中最多保留的原始数据条数
+        :param overflow: 队列满时的处理策略, 见 OVERFLOW_POLICIES
+        :param spill_dir: overflow 为 spill 时的临时文件目录
+        :param worker: 写入线程数
+        :param spool_dir: 写入失败时保存批次的目录, None 表示失败后丢弃
+        :param spool_codec: spool 中记录的序列化方式, 见 spool.CODECS
+        :param replay_batch_size: 回放时单次写入的最大记录数, 默认为 batch_size 的 4 倍
+        :param retry_interval: 回放失败后的等待秒数, 连续失败时加倍
+        :param max_retry_interval: 回放失败后的最长等待秒数
+        :param retryable: 判断写入异常是否值得重试的函数, 返回 False 的批次直接丢弃, None 表示全部重试
+        :param max_replay_attempts: 回放时同一批记录最多尝试的次数, 超过后丢弃并计入 failed, None 表示一直重试
+        :param spool_fsync: spool 追加和 commit 后是否 fsync, 关闭后只能保证进程崩溃不丢数据, 不能保证机器掉电
+        """
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError('unknown overflow policy: {}'.format(overflow))
+        if overflow == 'spill' and spill_dir is None:
+            raise ValueError('spill_dir is required when overflow is spill')
+
+        self.write = write
+        self.encode = encode
+        self.size = size or len
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.spill_dir = spill_dir
+        self.name = name
+
+        self._chunks = deque()
+        self._pending = 0
+        self._spill_files = deque()
+        self._spill_seq = 0
+        if spill_dir is not None:
+            # 上次退出时未写完的 spill 文件会在启动后优先写入
+            os.makedirs(spill_dir, exist_ok=True)
+            self._spill_files.extend(sorted(glob.glob(os.path.join(spill_dir, '{}-*.spill'.format(name)))))
+            if self._spill_files:
+                self._spill_seq = int(self._spill_files[-1].rsplit('-', 1)[1].split('.')[0]) + 1
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._closed = False
+
+        self.written = 0
+        self.written_bytes = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.failed = 0
+        self.flushes = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.last_flush_seconds = 0.0
+        self._started_at = time.time()
+        self._last_stats = (self._started_at, 0)
+        REGISTRY.collector('easyctp_writer', self.counters, name=name)
+
+        self.spool = None
+        self.spooled = 0
+        self.replayed = 0
+        self.replay_batch_size = replay_batch_size or batch_size * 4
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.retryable = retryable
+        self.max_replay_attempts = max_replay_attempts
+        self._replay_thread = None
+        self._stopped = threading.Event()
+        if spool_dir is not None:
+            self.spool = WriteAheadSpool(spool_dir, name, codec=spool_codec, fsync=spool_fsync)
+            self._replay_thread = threading.Thread(target=self._replay, name='{}-replay'.format(name), daemon=True)
+            self._replay_thread.start()
+
+        self._threads = [threading.Thread(target=self._run, name='{}-{}'.format(name, i), daemon=True)
+                         for i in range(worker)]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, items):
+        count = len(items)
+        if count == 0:
+            return
+        with self._lock:
+            while self._pending + count > self.max_pending and self._chunks and not self._closed:
+                if self.overflow == 'block':
+                    self._not_full.wait()
+                elif self.overflow == 'drop_oldest':
+                    dropped = self._chunks.popleft()
+                    self._pending -= len(dropped)
+                    self.dropped += len(dropped)
+                else:
+                    self._spill(items)
+                    return
+            self._chunks.append(items)
+            self._pending += count
+            self._not_empty.notify()
+
+    def close(self, timeout=None):
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        if self.spool is not None:
+            # 未回放完的数据留在 spool 中, 下次启动后继续回放
+            self._stopped.set()
+            self.spool.wake()
+            self._replay_thread.join(timeout)
+            if not self._replay_thread.is_alive():
+                self.spool.close()
+
+    def stats(self):
+        now = time.time()
+        last_time, last_written = self._last_stats
+        self._last_stats = (now, self.written)
+        stats = self.counters()
+        stats['throughput'] = (self.written - last_written) / max(now - last_time, 1e-9)
+        return stats
+
+    def counters(self):
+        """
+        与 stats() 相同但不包含 throughput, 调用时不会重置吞吐量的统计区间
+        """
+        return {
+            'name': self.name,
+            'pending': self._pending,
+            'pending_chunks': len(self._chunks),
+            'spill_files': len(self._spill_files),
+            'written': self.written,
+            'written_bytes': self.written_bytes,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'failed': self.failed,
+            'spooled': self.spooled,
+            'replayed': self.replayed,
+            'spool_pending': self.spool.pending if self.spool is not None else 0,
+            'flushes': self.flushes,
+            'flush_latency_avg': self.flush_seconds / self.flushes if self.flushes else 0.0,
+            'flush_latency_max': self.max_flush_seconds,
+            'flush_latency_last': self.last_flush_seconds,
+        }
+
+    def _run(self):
+        # 写入线程退出后 put() 会在队列满时永久阻塞生产者, 任何异常都只记录日志
+        while True:
+            try:
+                batch, size = self._collect()
+                if batch:
+                    self._flush(batch, size)
+                elif batch is None:
+                    return
+            except Exception as e:
+                log.error('{} writer unexpected error: {}'.format(self.name, e))
+
+    def _collect(self):
+        batch = []
+        size = 0
+        deadline = None
+        while True:
+            with self._lock:
+                while not self._chunks:
+                    if self._spill_files:
+                        self._unspill()
+                        continue
+                    if self._closed:
+                        return batch or None, size
+                    timeout = None if deadline is None else deadline - time.time()
+                    if timeout is not None and timeout <= 0:
+                        return batch, size
+                    self._not_empty.wait(timeout)
+                chunk = self._chunks.popleft()
+                self._pending -= len(chunk)
+                self._not_full.notify_all()
+
+            try:
+                records = self.encode(chunk) if self.encode is not None else chunk
+            except Exception as e:
+                with self._lock:
+                    self.failed += len(chunk)
+                log.error('{} encode {} items error: {}'.format(self.name, len(chunk), e))
+                continue
+            batch.extend(records)
+            if self.batch_bytes is not None:
+                size += sum(map(self.size, records))
+            if deadline is None:
+                deadline = time.time() + self.flush_interval
+
+            if len(batch) >= self.batch_size or (self.batch_bytes is not None and size >= self.batch_bytes) \
+                    or time.time() >= deadline:
+                return batch, size
+
+    def _flush(self, batch, size):
+        if self.spool is not None and self.spool.pending:
+            # spool 中还有积压时新批次也排在后面, 保持写入顺序, 也不用在数据库恢复前反复等待超时
+            self._spool(batch)
+            return
+        start = time.time()
+        try:
+            self.write(batch)
+        except Exception as e:
+            log.error('{} write {} records error: {}'.format(self.name, len(batch), e))
+            if self.spool is not None and (self.retryable is None or self.retryable(e)):
+                self._spool(batch)
+            else:
+                with self._lock:
+                    self.failed += len(batch)
+            return
+        self._record_flush(len(batch), size, time.time() - start)
+
+    def _record_flush(self, count, size, elapsed):
+        with self._lock:
+            self.written += count
+            self.written_bytes += size
+            self.flushes += 1
+            self.flush_seconds += elapsed
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+
+    def _spool(self, batch):
+        try:
+            self.spool.append(batch)
+        except Exception as e:
+            with self._lock:
+                self.failed += len(batch)
+            log.error('{} spool {} records error: {}'.format(self.name, len(batch), e))
+            return
+        with self._lock:
+            self.spooled += len(batch)
+
+    def _replay(self):
+        spool = self.spool
+        delay = self.retry_interval
+        attempts = 0
+        while not self._stopped.is_set():
+            if not spool.wait(1.0):
+                continue
+            try:
+                records, position, count = spool.read(self.replay_batch_size)
+            except Exception as e:
+                # 损坏的帧在 read 中跳过, 这里只有读取文件本身的错误, 等待后从 checkpoint 重新读取
+                log.error('{} read spool error: {}, retry in {:.1f}s'.format(self.name, e, delay))
+                self._stopped.wait(delay)
+                delay = min(delay * 2, self.max_retry_interval)
+                continue
+            start = time.time()
+            try:
+                if records:
+                    self.write(records)
+            except Exception as e:
+                attempts += 1
+                if (self.retryable is None or self.retryable(e)) and \
+                        (self.max_replay_attempts is None or attempts < self.max_replay_attempts):
+                    log.warning('{} replay {} records error: {}, retry in {:.1f}s'.format(
+                        self.name, len(records), e, delay))
+                    self._stopped.wait(delay)
+                    delay = min(delay * 2, self.max_retry_interval)
+                    continue
+                log.error('{} replay {} records error: {}, drop them after {} attempts'.format(
+                    self.name, len(records), e, attempts))
+                with self._lock:
+                    self.failed += len(records)
+            else:
+                self._record_flush(len(records), 0, time.time() - start)
+                with self._lock:
+                    self.replayed += len(records)
+                delay = self.retry_interval
+            attempts = 0
+            try:
+                spool.commit(position, count)
+            except Exception as e:
+                # checkpoint 没有更新, 下一次从原来的位置重新回放, 与进程在 commit 之前退出相同
+                log.error('{} commit spool error: {}, retry in {:.1f}s'.format(self.name, e, delay))
+                self._stopped.wait(delay)
+                delay = min(delay * 2, self.max_retry_interval)
+
+    def _spill(self, items):
+        path = os.path.join(self.spill_dir, '{}-{:012d}.spill'.format(self.name, self._spill_seq))
+        self._spill_seq += 1
+        with open(path, 'wb') as f:
+            pickle.dump(items, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._spill_files.append(path)
+        self.spilled += len(items)
+        self._not_empty.notify()
+
+    def _unspill(self):
+        path = self._spill_files.popleft()
+        try:
+            with open(path, 'rb') as f:
+                items = pickle.load(f)
+        except Exception as e:
+            # 保留损坏的文件以便排查, 改名后重启时不会再次读取
+            log.error('{} read spill file {} error: {}'.format(self.name, path, e))
+            self.failed += 1
+            os.replace(path, path + '.bad')
+            return
+        os.remove(path)
+        self._chunks.append(items)
+        self._pending += len(items)
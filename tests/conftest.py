@@ -0,0 +1,19 @@
+import pytest
+from ctp.futures import ApiStruct
+
+DBL_MAX = 1.7976931348623157e308
+
+
+def make_tick(instrument_id=b'rb1705', update_time=b'09:00:00', millisec=0, trading_day=b'20170104',
+              action_day=b'20170104', last_price=3500.0, volume=0, **fields):
+    values = dict(InstrumentID=instrument_id, UpdateTime=update_time, UpdateMillisec=millisec,
+                  TradingDay=trading_day, ActionDay=action_day, LastPrice=last_price, Volume=volume,
+                  BidPrice1=last_price - 1, AskPrice1=last_price + 1, BidVolume1=1, AskVolume1=1,
+                  ClosePrice=DBL_MAX, SettlementPrice=DBL_MAX)
+    values.update(fields)
+    return ApiStruct.DepthMarketData(**values)
+
+
+@pytest.fixture
+def tick():
+    return make_tick
@@ -0,0 +1,146 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from ctp.futures import ApiStruct
+
+from easyctp.aio import AsyncMarketData, AsyncResultMap, AsyncTrader
+from easyctp.query import CtpError
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_market_data_from_callback_thread(tick):
+    async def main():
+        market_data = AsyncMarketData(timeout=0.2)
+        thread = threading.Thread(
+            target=lambda: [market_data.put_tick(tick(last_price=float(price))) for price in range(100)])
+        thread.start()
+        prices = [item.LastPrice async for item in market_data]
+        thread.join()
+        return prices
+
+    assert run(main()) == [float(price) for price in range(100)]
+
+
+def test_market_data_batches(tick):
+    async def main():
+        market_data = AsyncMarketData(timeout=0.05)
+        for price in range(5):
+            market_data.put(tick(last_price=float(price)))
+        batches = [len(batch) async for batch in market_data.batches(max_items=2)]
+        with pytest.raises(TimeoutError):
+            await market_data.get(timeout=0.01)
+        return batches
+
+    assert run(main()) == [2, 2, 1]
+
+
+def test_put_tick_copies(tick):
+    async def main():
+        market_data = AsyncMarketData()
+        item = tick(last_price=1.0)
+        market_data.put_tick(item)
+        item.LastPrice = 2.0
+        return (await market_data.get(timeout=1)).LastPrice
+
+    assert run(main()) == 1.0
+
+
+def test_result_map():
+    async def main():
+        results = AsyncResultMap(asyncio.get_running_loop())
+        ok, failed = results.create(1), results.create(2)
+        results.put(1, ApiStruct.Instrument(InstrumentID=b'rb1705'), ApiStruct.RspInfo(), False)
+        results.put(1, ApiStruct.Instrument(InstrumentID=b'ag1706'), ApiStruct.RspInfo(), True)
+        results.fail(2, ApiStruct.RspInfo(ErrorID=90, ErrorMsg=b'busy'))
+        # 未知的请求直接忽略
+        results.put(3, None, ApiStruct.RspInfo(), True)
+        response = await ok
+        with pytest.raises(CtpError) as error:
+            await failed
+        return [item.InstrumentID for item, _ in response], error.value.error_id, results.pending
+
+    assert run(main()) == ([b'rb1705', b'ag1706'], 90, {})
+
+
+def test_query_all_instruments():
+    trader = AsyncTrader()
+
+    def respond(request, request_id):
+        def callback():
+            for index, instrument_id in enumerate((b'rb1705', b'ag1706')):
+                trader.results_map.put(request_id, ApiStruct.Instrument(InstrumentID=instrument_id),
+                                       ApiStruct.RspInfo(), index == 1)
+
+        threading.Thread(target=callback).start()
+        return 0
+
+    trader.ReqQryInstrument = respond
+
+    async def main():
+        trader.loop = asyncio.get_running_loop()
+        trader.results_map = AsyncResultMap(trader.loop)
+        return await trader.query_all_instruments(timeout=2)
+
+    assert run(main()) == {b'rb1705', b'ag1706'}
+
+
+def test_query_error_code():
+    trader = AsyncTrader(interval=0, retries=2, retry_delay=0)
+    codes = iter([-3, -1, -2, -2, -2])
+    trader.ReqQryInstrument = lambda request, request_id: next(codes)
+
+    async def main():
+        trader.results_map = AsyncResultMap(asyncio.get_running_loop())
+        errors = []
+        for _ in range(2):
+            with pytest.raises(CtpError) as error:
+                await trader.query('ReqQryInstrument', ApiStruct.QryInstrument())
+            errors.append(error.value.error_id)
+        return errors, trader.throttled, trader.results_map.pending
+
+    # 非流控错误直接抛出, 流控重试 retries 次后抛出
+    assert run(main()) == ([-1, -2], 4, {})
+
+
+def test_concurrent_queries_are_serialized():
+    trader = AsyncTrader(interval=0.02, retry_delay=0.01)
+    outstanding = set()
+    sent = []
+
+    def respond(request, request_id):
+        if outstanding:
+            return -2
+        outstanding.add(request_id)
+        sent.append(time.monotonic())
+
+        def callback():
+            time.sleep(0.01)
+            outstanding.discard(request_id)
+            trader.results_map.put(request_id, ApiStruct.Instrument(InstrumentID=request.InstrumentID),
+                                   ApiStruct.RspInfo(), True)
+
+        threading.Thread(target=callback).start()
+        return 0
+
+    trader.ReqQryInstrument = respond
+
+    async def main():
+        trader.results_map = AsyncResultMap(asyncio.get_running_loop())
+        queries = [trader.query('ReqQryInstrument', ApiStruct.QryInstrument(InstrumentID=instrument_id))
+                   for instrument_id in (b'rb1705', b'ag1706', b'cu1705', b'IF1701')]
+        return await asyncio.gather(*queries)
+
+    responses = run(main())
+    assert [response[0][0].InstrumentID for response in responses] == [b'rb1705', b'ag1706', b'cu1705', b'IF1701']
+    assert trader.throttled == 0
+    assert all(later - earlier >= 0.019 for earlier, later in zip(sent, sent[1:]))
+
+
+def test_scheduler_is_not_available():
+    with pytest.raises(TypeError):
+        AsyncTrader().scheduler
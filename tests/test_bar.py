@@ -0,0 +1,168 @@
+import influxdb
+from influxdb.resultset import ResultSet
+
+from easyctp.bar import BarAggregator
+from easyctp.influx import LineProtocolEncoder
+from easyctp.pipeline import BuildBar, SaveInflux
+from easyctp.quotation import BufferedMarketData
+
+
+def make_aggregator(intervals=('1m',)):
+    bars = []
+    aggregator = BarAggregator(intervals=intervals, grace_ms=0, sinks=[bars.extend])
+    return aggregator, bars
+
+
+def test_bar_boundaries(tick):
+    aggregator, bars = make_aggregator()
+    aggregator.update(tick(update_time=b'09:00:10', last_price=3500.0, volume=100, Turnover=0.0))
+    aggregator.update(tick(update_time=b'09:00:20', last_price=3510.0, volume=103, Turnover=30.0))
+    aggregator.update(tick(update_time=b'09:00:50', last_price=3490.0, volume=110, Turnover=100.0))
+    assert bars == []
+    aggregator.update(tick(update_time=b'09:01:05', last_price=3495.0, volume=111, Turnover=110.0))
+    assert len(bars) == 1
+    bar = bars[0]
+    assert bar['instrument_id'] == 'rb1705' and bar['start'] == '09:00:00'
+    assert (bar['open'], bar['high'], bar['low'], bar['close']) == (3500.0, 3510.0, 3490.0, 3490.0)
+    assert (bar['volume'], bar['turnover'], bar['count']) == (10, 100.0, 3)
+
+
+def test_session_end_tick_belongs_to_previous_bar(tick):
+    aggregator, bars = make_aggregator()
+    aggregator.update(tick(update_time=b'10:14:30', volume=1))
+    aggregator.update(tick(update_time=b'10:15:00', volume=2))
+    aggregator.close()
+    assert [(bar['start'], bar['count']) for bar in bars] == [('10:14:00', 2)]
+
+
+def test_late_tick_does_not_reopen_finished_bar(tick):
+    aggregator, bars = make_aggregator()
+    aggregator.update(tick(update_time=b'09:00:10', volume=1))
+    aggregator.update(tick(update_time=b'09:01:05', volume=2))
+    aggregator.update(tick(update_time=b'09:00:59', volume=2))
+    aggregator.close()
+    assert [bar['start'] for bar in bars] == ['09:00:00', '09:01:00']
+    assert aggregator.late == 1
+
+
+def test_late_tick_of_other_instrument_after_advance(tick):
+    aggregator, bars = make_aggregator()
+    aggregator.update(tick(instrument_id=b'ag1706', update_time=b'09:00:10', volume=1))
+    aggregator.update(tick(update_time=b'09:00:10', volume=1))
+    aggregator.update(tick(update_time=b'09:01:05', volume=2))
+    assert len(bars) == 2
+    aggregator.update(tick(instrument_id=b'ag1706', update_time=b'09:00:50', volume=2))
+    aggregator.close()
+    assert [(bar['instrument_id'], bar['start']) for bar in bars].count(('ag1706', '09:00:00')) == 1
+    assert aggregator.late == 1
+
+
+def test_restart_seeds_cumulative_volume(tick):
+    aggregator, bars = make_aggregator()
+    aggregator.update(tick(update_time=b'10:30:00', millisec=500, volume=120000, Turnover=1e9))
+    aggregator.update(tick(update_time=b'10:30:01', volume=120005, Turnover=1e9 + 50.0))
+    aggregator.close()
+    assert (bars[0]['volume'], bars[0]['turnover']) == (5, 50.0)
+
+
+def test_out_of_order_volume_is_not_a_reset(tick):
+    aggregator, bars = make_aggregator()
+    aggregator.update(tick(update_time=b'09:00:01', volume=100))
+    aggregator.update(tick(update_time=b'09:00:02', volume=105))
+    aggregator.update(tick(update_time=b'09:00:02', millisec=500, volume=103))
+    aggregator.update(tick(update_time=b'09:00:03', volume=107))
+    aggregator.close()
+    assert bars[0]['volume'] == 7
+
+
+def test_bars_use_own_measurement(tick):
+    aggregator, bars = make_aggregator()
+    aggregator.update(tick(update_time=b'09:00:10', volume=1))
+    aggregator.close()
+    line = LineProtocolEncoder().encode_bars(bars)[0]
+    assert line.startswith(b'ctp_bar_1m,instrument_id=rb1705 ')
+
+
+def test_closing_tick_within_tolerance_belongs_to_previous_bar(tick):
+    aggregator, bars = make_aggregator()
+    aggregator.update(tick(update_time=b'10:14:30', volume=1))
+    aggregator.update(tick(update_time=b'10:15:00', millisec=500, volume=2))
+    aggregator.close()
+    assert [(bar['start'], bar['count']) for bar in bars] == [('10:14:00', 2)]
+
+
+def test_session_end_flushes_spanning_bars(tick):
+    aggregator, bars = make_aggregator(intervals=('30m',))
+    aggregator.update(tick(update_time=b'10:14:30', volume=1))
+    aggregator.update(tick(update_time=b'10:14:50', volume=2))
+    aggregator.advance(aggregator.market_wall + 5)
+    assert bars == []
+    aggregator.advance(aggregator.market_wall + 11)
+    assert [(bar['start'], bar['count']) for bar in bars] == [('10:00:00', 2)]
+    # 没有新的 tick 时正常完成不会重复输出
+    aggregator.advance(aggregator.market_wall + 3600)
+    assert len(bars) == 1
+
+
+def test_session_end_flush_is_completed_by_continuing_instrument(tick):
+    aggregator, bars = make_aggregator(intervals=('30m',))
+    aggregator.update(tick(instrument_id=b'IF1701', update_time=b'10:14:30', volume=1))
+    aggregator.update(tick(instrument_id=b'IF1701', update_time=b'10:15:02', volume=2))
+    assert [(bar['start'], bar['count']) for bar in bars] == [('10:00:00', 2)]
+    aggregator.update(tick(instrument_id=b'IF1701', update_time=b'10:20:00', volume=3))
+    assert aggregator.late == 0
+    aggregator.update(tick(instrument_id=b'IF1701', update_time=b'10:30:00', volume=4))
+    assert [(bar['start'], bar['count']) for bar in bars] == [('10:00:00', 2), ('10:00:00', 3)]
+
+
+def test_malformed_ticks_are_skipped(tick):
+    aggregator, bars = make_aggregator()
+    aggregator.update(tick(update_time=b'09:00:10', volume=1))
+    aggregator.update(tick(update_time=b'09:00:20', trading_day=b''))
+    aggregator.update(tick(update_time=b'1a:16:00'))
+    aggregator.update_batch([tick(update_time=b'09:00:30', volume=2), tick(update_time=b'')])
+    aggregator.close()
+    assert [(bar['start'], bar['count']) for bar in bars] == [('09:00:00', 2)]
+    assert aggregator.invalid == 3
+
+
+def test_build_bar_survives_malformed_tick(tick):
+    for batch in (False, True):
+        market_data = BufferedMarketData(capacity=8, timeout=0.01)
+        market_data.put_tick(tick(update_time=b'09:00:10', volume=1))
+        market_data.put_tick(tick(update_time=b'1a:16:00', trading_day=b''))
+        market_data.put_tick(tick(update_time=b'09:00:20', volume=2))
+        pipeline = BuildBar(market_data, intervals=('1m',), grace_ms=0)
+        items = pipeline.get_batch() if batch else [pipeline.get() for _ in range(3)]
+        assert len(items) == 3
+        assert pipeline.aggregator.invalid == 1
+
+
+class FakeInfluxClient:
+    def __init__(self, continuous_queries):
+        self.continuous_queries = continuous_queries
+        self.queries = []
+
+    def create_database(self, database):
+        pass
+
+    def switch_database(self, database):
+        pass
+
+    def query(self, query):
+        self.queries.append(query)
+        series = [{'name': 'ctp', 'columns': ['name', 'query'],
+                   'values': [[name, 'CREATE CONTINUOUS QUERY ...'] for name in self.continuous_queries]}]
+        return ResultSet({'series': series})
+
+
+def test_save_influx_keeps_continuous_queries_by_default(monkeypatch, caplog):
+    client = FakeInfluxClient(['ctp_ctp_1m', 'ctp_ctp_5m'])
+    monkeypatch.setattr(influxdb, 'InfluxDBClient', lambda **kwargs: client)
+    SaveInflux(queue=[], database='ctp')
+    assert not any(query.startswith('DROP') for query in client.queries)
+    assert "['ctp_ctp_1m', 'ctp_ctp_5m']" in caplog.text
+
+    client = FakeInfluxClient(['ctp_ctp_1m'])
+    SaveInflux(queue=[], database='ctp', drop_continuous_query=True)
+    assert sum(query.startswith('DROP') for query in client.queries) == 6
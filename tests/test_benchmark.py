@@ -0,0 +1,17 @@
+import json
+import os
+import subprocess
+import sys
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks',
+                         'bench_hot_path.py')
+
+
+def test_benchmark_smoke():
+    output = subprocess.check_output([sys.executable, BENCHMARK, '--instruments', '5', '--snapshots', '2',
+                                      '--batch_size', '4'], timeout=120)
+    results = [json.loads(line) for line in output.decode().splitlines()]
+    stages = {result['stage'] for result in results}
+    assert {'market_data.put_tick', 'filter_invalid_item.batch', 'sink.influxdb', 'sink.mongodb'} <= stages
+    assert all(result['ticks'] == 10 for result in results)
+    assert all(result.get('failed', 0) == 0 for result in results)
@@ -0,0 +1,76 @@
+from queue import Empty
+
+import pytest
+
+from ctp.futures import ApiStruct
+
+from easyctp.buffer import DEPTH_MARKET_DATA_DTYPE, TickBuffer, to_array
+from easyctp.pipeline import ConvertDict, FilterInvalidItem
+from easyctp.quotation import BufferedMarketData
+
+
+def test_dtype_matches_struct_layout(tick):
+    item = tick(volume=42)
+    records = to_array([item])
+    assert records.dtype.itemsize == DEPTH_MARKET_DATA_DTYPE.itemsize
+    assert records[0].Volume == 42
+    assert records[0].InstrumentID == b'rb1705'
+
+
+def test_put_and_get_batch(tick):
+    buffer = TickBuffer(capacity=8)
+    for i in range(3):
+        buffer.put(tick(volume=i))
+    assert len(buffer) == 3
+    assert buffer.get_batch(max_items=2).Volume.tolist() == [0, 1]
+    assert buffer.get_batch().Volume.tolist() == [2]
+    with pytest.raises(Empty):
+        buffer.get_batch(timeout=0.01)
+
+
+def test_batch_stops_at_wrap_around(tick):
+    buffer = TickBuffer(capacity=4)
+    for i in range(3):
+        buffer.put(tick(volume=i))
+    buffer.get_batch()
+    for i in range(3, 6):
+        buffer.put(tick(volume=i))
+    assert buffer.get_batch().Volume.tolist() == [3]
+    assert buffer.get_batch().Volume.tolist() == [4, 5]
+
+
+def test_overrun_skips_overwritten_ticks(tick):
+    buffer = TickBuffer(capacity=4)
+    for i in range(6):
+        buffer.put(tick(volume=i))
+    assert buffer.get_batch().Volume.tolist() == [2, 3]
+    assert buffer.get_batch().Volume.tolist() == [4, 5]
+    assert buffer.overrun == 2
+
+
+def test_buffered_market_data_copies_callback_memory(tick):
+    market_data = BufferedMarketData(capacity=4, timeout=0.01)
+    item = tick(volume=1)
+    market_data.put_tick(item)
+    item.Volume = 2
+    assert market_data.get_batch().Volume.tolist() == [1]
+    assert len(market_data.get_batch()) == 0
+
+
+def test_buffered_market_data_item_mode(tick):
+    market_data = BufferedMarketData(capacity=8, timeout=0.01)
+    for volume in range(3):
+        market_data.put_tick(tick(volume=volume))
+    item = market_data.get()
+    assert isinstance(item, ApiStruct.DepthMarketData) and item.Volume == 0
+    assert [item.Volume for item in market_data] == [1, 2]
+
+
+def test_pipelines_accept_buffered_market_data_in_both_modes(tick):
+    for batch in (False, True):
+        market_data = BufferedMarketData(capacity=8, timeout=0.01)
+        market_data.put_tick(tick(volume=1))
+        market_data.put_tick(tick(update_time=b''))
+        pipeline = ConvertDict(FilterInvalidItem(market_data))
+        items = pipeline.get_batch() if batch else [pipeline.get()]
+        assert [item['Volume'] for item in items] == [1]
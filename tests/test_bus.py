@@ -0,0 +1,75 @@
+import threading
+from queue import Empty
+
+import pytest
+
+from easyctp.quotation import MarketData, TickBus
+
+
+def test_capacity_power_of_two():
+    with pytest.raises(ValueError):
+        TickBus(capacity=1000)
+
+
+def test_subscribers_read_independently(tick):
+    bus = TickBus(capacity=16)
+    fast = bus.subscribe(name='fast')
+    bus.put_tick(tick(last_price=1.0))
+    slow = bus.subscribe(name='slow')
+    bus.put_tick(tick(last_price=2.0))
+    bus.put_tick(tick(last_price=3.0))
+
+    assert [t.LastPrice for t in fast.get_batch(max_wait=0)] == [1.0, 2.0, 3.0]
+    assert slow.lag == 2 and bus.qsize() == 2
+    assert slow.get(timeout=0).LastPrice == 2.0
+    assert [t.LastPrice for t in slow.get_batch(max_wait=0)] == [3.0]
+    assert fast.get_batch(max_wait=0) == []
+    with pytest.raises(Empty):
+        fast.get(timeout=0)
+
+
+def test_put_tick_copies(tick):
+    bus = TickBus(capacity=4)
+    subscriber = bus.subscribe()
+    item = tick(last_price=1.0)
+    bus.put_tick(item)
+    item.LastPrice = 2.0
+    assert subscriber.get(timeout=0).LastPrice == 1.0
+
+
+def test_instrument_filter(tick):
+    bus = TickBus(capacity=16)
+    subscriber = bus.subscribe(['ag1706'])
+    bus.put_tick(tick())
+    bus.put_tick(tick(instrument_id=b'ag1706'))
+    assert [t.InstrumentID for t in subscriber.get_batch(max_wait=0)] == [b'ag1706']
+    assert subscriber.stats()['filtered'] == 1
+
+
+def test_lagging_subscriber_drops_oldest(tick):
+    bus = TickBus(capacity=4)
+    subscriber = bus.subscribe()
+    for price in range(10):
+        bus.put_tick(tick(last_price=float(price)))
+    assert [t.LastPrice for t in subscriber.get_batch(max_wait=0)] == [6.0, 7.0, 8.0, 9.0]
+    assert subscriber.dropped == 6
+
+
+def test_blocking_read_wakes_on_publish(tick):
+    bus = TickBus(capacity=4)
+    subscriber = bus.subscribe()
+    timer = threading.Timer(0.05, bus.put_tick, [tick()])
+    timer.start()
+    assert len(subscriber.get_batch(max_wait=2)) == 1
+    timer.join()
+
+
+def test_bus_can_not_be_consumed_directly():
+    with pytest.raises(TypeError):
+        TickBus(capacity=4).get_batch()
+
+
+def test_market_data_instances_do_not_share_queue(tick):
+    first, second = MarketData(), MarketData()
+    first.put_tick(tick())
+    assert first.qsize() == 1 and second.qsize() == 0
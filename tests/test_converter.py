@@ -0,0 +1,43 @@
+import pytest
+from ctp.futures import ApiStruct
+
+from easyctp.buffer import to_array
+from easyctp.converter import DecodeCache, StructConverter, converter_for
+
+FIELDS = ('InstrumentID', 'UpdateTime', 'UpdateMillisec', 'LastPrice', 'Volume')
+
+
+def test_convert_decodes_strings(tick):
+    converter = StructConverter(fields=FIELDS)
+    assert converter(tick(volume=3)) == {
+        'InstrumentID': 'rb1705', 'UpdateTime': '09:00:00', 'UpdateMillisec': 0, 'LastPrice': 3500.0, 'Volume': 3}
+    assert converter.values(tick(volume=3)) == ('rb1705', '09:00:00', 0, 3500.0, 3)
+
+
+def test_struct_and_recarray_agree(tick):
+    converter = StructConverter(fields=FIELDS)
+    items = [tick(millisec=500, volume=1), tick(instrument_id=b'ag1706', update_time=b'09:00:01', volume=2)]
+    columns = converter.columns_of(to_array(items))
+    assert columns == converter.columns_of(items)
+    # recarray 中的值需要是 python 类型, 而不是 numpy 标量
+    assert all(type(value) in (int, float, str) for values in columns.values() for value in values)
+    assert converter.convert_batch(to_array(items)) == converter.convert_batch(items)
+
+
+def test_unknown_field():
+    with pytest.raises(ValueError):
+        StructConverter(fields=('InstrumentID', 'NoSuchField'))
+
+
+def test_converter_for_is_cached():
+    assert converter_for(fields=FIELDS) is converter_for(fields=list(FIELDS))
+    assert converter_for(ApiStruct.DepthMarketData) is not converter_for(fields=FIELDS)
+
+
+def test_decode_cache_interns_and_bounds():
+    cache = DecodeCache(max_size=2)
+    first = cache[b'rb1705']
+    assert first == 'rb1705' and cache[b'rb1705'] is first
+    cache[b'ag1706']
+    cache[b'cu1705']
+    assert len(cache) == 1
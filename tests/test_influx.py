@@ -0,0 +1,47 @@
+import calendar
+
+from easyctp.buffer import to_array
+from easyctp.influx import LineProtocolEncoder, UTC_OFFSET_MS
+
+
+def parse(line):
+    head, fields, timestamp = line.decode().split(' ')
+    return head, dict(field.split('=', 1) for field in fields.split(',')), int(timestamp)
+
+
+def test_encode_line(tick):
+    line = LineProtocolEncoder().encode(tick(update_time=b'09:30:01', millisec=500, volume=12, ClosePrice=3501.5))
+    head, fields, timestamp = parse(line)
+    assert head == 'ctp,instrument_id=rb1705'
+    assert fields['LastPrice'] == '3500.0'
+    assert fields['Volume'] == '12i'
+    assert fields['ClosePrice'] == '3501.5'
+    expected = calendar.timegm((2017, 1, 4, 9, 30, 1)) * 1000 + 500 - UTC_OFFSET_MS
+    assert timestamp == expected
+
+
+def test_sentinel_and_nan_fields_are_skipped(tick):
+    _, fields, _ = parse(LineProtocolEncoder().encode(tick(OpenPrice=float('nan'))))
+    assert 'OpenPrice' not in fields
+    assert 'LastPrice' in fields
+
+
+def test_static_field_cache_follows_changes(tick):
+    encoder = LineProtocolEncoder()
+    first = parse(encoder.encode(tick(ClosePrice=1.0)))[1]
+    second = parse(encoder.encode(tick(ClosePrice=2.0)))[1]
+    assert (first['ClosePrice'], second['ClosePrice']) == ('1.0', '2.0')
+
+
+def test_tag_escaping():
+    assert LineProtocolEncoder().prefix(b'a b,c=d') == r'ctp,instrument_id=a\ b\,c\=d '
+
+
+def test_recarray_and_structs_encode_identically(tick):
+    ticks = [tick(), tick(instrument_id=b'ag1706', update_time=b'21:00:00', ClosePrice=10.0)]
+    assert LineProtocolEncoder().encode_batch(ticks) == LineProtocolEncoder().encode_batch(to_array(ticks))
+
+
+def test_invalid_time_is_dropped(tick):
+    assert LineProtocolEncoder().encode_batch([tick(update_time=b'')]) == []
+
@@ -0,0 +1,56 @@
+import datetime
+import os
+
+from ctp.futures import ApiStruct
+
+from easyctp.instrument import InstrumentCache, current_trading_day
+
+
+def instruments():
+    return [
+        ApiStruct.Instrument(InstrumentID=b'rb1705', ExchangeID=b'SHFE', ProductID=b'rb', ExpireDate=b'20170515'),
+        ApiStruct.Instrument(InstrumentID=b'rb1710', ExchangeID=b'SHFE', ProductID=b'rb', ExpireDate=b'20171016'),
+        ApiStruct.Instrument(InstrumentID=b'm1705', ExchangeID=b'DCE', ProductID=b'm', ExpireDate=b'20170512'),
+    ]
+
+
+def test_current_trading_day():
+    # 2017-01-04 是周三, 2017-01-06 是周五
+    assert current_trading_day(datetime.datetime(2017, 1, 4, 9, 0)) == '20170104'
+    assert current_trading_day(datetime.datetime(2017, 1, 4, 21, 0)) == '20170105'
+    assert current_trading_day(datetime.datetime(2017, 1, 6, 21, 0)) == '20170109'
+    assert current_trading_day(datetime.datetime(2017, 1, 7, 1, 0)) == '20170109'
+
+
+def test_save_and_load(tmp_path):
+    cache = InstrumentCache(str(tmp_path))
+    assert cache.load('20170104') is None
+    cache.save('20170104', instruments())
+
+    table = cache.load('20170104')
+    assert len(table) == 3 and 'rb1705' in table and b'm1705' in table
+    assert table['rb1710'].ExpireDate == b'20171016'
+    assert table.instrument_ids() == {b'rb1705', b'rb1710', b'm1705'}
+    assert list(table.by_product('rb').InstrumentID) == [b'rb1705', b'rb1710']
+    assert list(table.by_exchange('DCE').InstrumentID) == [b'm1705']
+    assert list(table.by_expiry(end='20170515').InstrumentID) == [b'rb1705', b'm1705']
+
+
+def test_get_uses_cache_without_login(tmp_path):
+    cache = InstrumentCache(str(tmp_path))
+    cache.save('20170104', instruments())
+    assert len(cache.get('user', 'password', 'broker', 'tcp://127.0.0.1:1', trading_day='20170104')) == 3
+
+
+def test_corrupt_cache_is_ignored(tmp_path):
+    cache = InstrumentCache(str(tmp_path))
+    with open(cache.path('20170104'), 'wb') as f:
+        f.write(b'not a numpy file')
+    assert cache.load('20170104') is None
+
+
+def test_cleanup_keeps_recent_days(tmp_path):
+    cache = InstrumentCache(str(tmp_path), keep_days=2)
+    for day in ('20170103', '20170104', '20170105'):
+        cache.save(day, instruments())
+    assert sorted(os.listdir(str(tmp_path))) == ['instruments-20170104.npy', 'instruments-20170105.npy']
@@ -0,0 +1,44 @@
+from queue import Queue
+
+from easyctp.pipeline import BasePipeline, FilterInvalidItem
+from easyctp.quotation import MarketData
+
+
+def test_get_batch_drains_available_items():
+    market_data = MarketData(Queue(), timeout=0.01)
+    for i in range(5):
+        market_data.put(i)
+    assert market_data.get_batch(max_items=3) == [0, 1, 2]
+    assert market_data.get_batch() == [3, 4]
+    assert market_data.get_batch() == []
+
+
+def test_iter_batches_ends_on_timeout():
+    market_data = MarketData(Queue(), timeout=0.01)
+    for i in range(3):
+        market_data.put(i)
+    assert list(market_data.iter_batches(max_items=2)) == [[0, 1], [2]]
+
+
+def test_put_tick_copies_struct(tick):
+    market_data = MarketData(Queue())
+    item = tick(volume=1)
+    market_data.put_tick(item)
+    item.Volume = 2
+    assert market_data.get().Volume == 1
+
+
+def test_pipeline_get_batch_skips_empty_processed_batches(tick):
+    market_data = MarketData(Queue(), timeout=0.01)
+    for item in (tick(update_time=b''), tick()):
+        market_data.put(item)
+    pipeline = FilterInvalidItem(market_data)
+    assert len(pipeline.get_batch(max_items=1)) == 1
+    assert pipeline.get_batch() == []
+
+
+def test_pipeline_get_batch_from_plain_queue():
+    queue = Queue()
+    queue.put(1)
+    assert BasePipeline(queue).get_batch(max_wait=0.01) == [1]
+    assert BasePipeline(queue).get_batch(max_wait=0.01) == []
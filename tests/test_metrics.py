@@ -0,0 +1,101 @@
+import gc
+import subprocess
+import sys
+import threading
+from queue import Queue
+
+from easyctp.metrics import REGISTRY, Histogram, MetricsRegistry, StageMetrics, exchange_latency_ms
+from easyctp.pipeline import FilterInvalidItem
+
+
+def test_counter_and_histogram_from_many_threads():
+    registry = MetricsRegistry()
+    counter = registry.counter('ticks_total')
+    histogram = registry.histogram('latency', (1, 10))
+
+    def run():
+        for _ in range(10000):
+            counter.inc()
+            histogram.observe(5)
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.value == 80000
+    assert histogram.count == 80000 and histogram.counts == [0, 80000, 0]
+
+
+def test_histogram_buckets():
+    histogram = Histogram((1, 10))
+    for value in (0.5, 1, 2, 100):
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.sum == 103.5
+
+
+def test_stage_instances_have_own_series():
+    registry = MetricsRegistry()
+    first, second = StageMetrics('Stage', registry), StageMetrics('Stage', registry)
+    first.received.value += 3
+    second.received.value += 5
+    samples = {labels: value for name, labels, value in registry.samples() if name == 'easyctp_stage_received_total'}
+    assert sorted(samples.values()) == [3, 5]
+    assert first.instance != second.instance
+
+
+def test_collectors_and_render():
+    registry = MetricsRegistry()
+
+    class Writer:
+        def counters(self):
+            return {'written': 3, 'name': 'influxdb'}
+
+    writer = Writer()
+    registry.collector('easyctp_writer', writer.counters, name='influxdb')
+    registry.collector('easyctp_rejected_total', lambda: {'price': 2}, key_label='reason')
+    registry.gauge('easyctp_queue_depth', lambda: 7)
+    text = registry.render()
+    assert 'easyctp_writer_written{name="influxdb"} 3\n' in text
+    assert 'easyctp_rejected_total{reason="price"} 2\n' in text
+    assert 'easyctp_queue_depth 7\n' in text
+
+    # 对象回收后 collector 自动移除
+    del writer
+    assert 'easyctp_writer_written' not in registry.render()
+
+
+def test_filter_instances_do_not_share_collectors():
+    first, second = FilterInvalidItem(Queue()), FilterInvalidItem(Queue())
+    assert first.metrics.instance != second.metrics.instance
+    assert first.metrics.received is not second.metrics.received
+
+
+def test_exchange_latency_crosses_midnight():
+    # 北京时间 2017-01-04 00:00:00.100 收到 23:59:59.900 的 tick
+    now = 1483459200.1
+    assert exchange_latency_ms(b'23:59:59', 900, now) == 200
+    assert exchange_latency_ms(b'00:00:00', 50, now) == 50
+
+
+def test_stage_series_removed_after_collection():
+    registry = MetricsRegistry()
+    stage = StageMetrics('Stage', registry)
+    stage.received.value += 1
+    assert len(registry.metrics) == 3
+    del stage
+    gc.collect()
+    assert registry.metrics == {}
+
+    pipeline = FilterInvalidItem(Queue())
+    labels = (('id', pipeline.metrics.instance), ('stage', 'FilterInvalidItem'))
+    assert ('easyctp_stage_received_total', labels) in REGISTRY.metrics
+    del pipeline
+    gc.collect()
+    assert ('easyctp_stage_received_total', labels) not in REGISTRY.metrics
+
+
+def test_quotation_does_not_import_sinks():
+    code = 'import sys, easyctp.quotation; print([m for m in ("easyctp.influx", "requests") if m in sys.modules])'
+    assert subprocess.check_output([sys.executable, '-c', code]).strip() == b'[]'
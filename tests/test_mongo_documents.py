@@ -0,0 +1,49 @@
+import datetime
+
+import bson
+
+from easyctp.buffer import to_array
+from easyctp.facade import MarketDataExporter, MongoStrategy
+from easyctp.quotation import MarketData, MarketDataApi
+
+
+def test_documents_from_structs(tick):
+    documents = MongoStrategy.convert_to_documents([tick(update_time=b'21:00:01', millisec=500,
+                                                         action_day=b'20170103')])
+    document = documents[0]
+    assert document['time'] == datetime.datetime(2017, 1, 3, 21, 0, 1, 500000)
+    assert document['time_str'] == '20170103T21:00:01.500'
+    assert document['InstrumentID'] == 'rb1705'
+
+
+def test_invalid_action_day_is_skipped(tick):
+    documents = MongoStrategy.convert_to_documents([tick(action_day=b''), tick(action_day=b'2017xx04'), tick()])
+    assert len(documents) == 1
+
+
+def test_recarray_documents_are_bson_encodable(tick):
+    array = to_array([tick(millisec=250, volume=7), tick(action_day=b'')])
+    documents = MongoStrategy.convert_to_documents(array)
+    assert len(documents) == 1
+    assert documents[0]['time'].microsecond == 250000
+    assert type(documents[0]['Volume']) is int
+    bson.encode(documents[0])
+
+
+def test_export_to_drains_in_batches(tick, monkeypatch, capsys):
+    market_data = MarketData(timeout=0.01)
+    for volume in range(5):
+        market_data.put_tick(tick(volume=volume))
+    monkeypatch.setattr(MarketDataApi, 'prepare', lambda self, **kwargs: market_data)
+
+    class Strategy:
+        def __init__(self):
+            self.batches = []
+
+        def save_batch(self, batch):
+            self.batches.append([item.Volume for item in batch])
+
+    strategy = Strategy()
+    MarketDataExporter.export_to(strategy, 'user', 'password', 'broker', 'tcp://127.0.0.1:1', ['rb1705'])
+    assert strategy.batches == [[0, 1, 2, 3, 4]]
+    assert 'rb1705' not in capsys.readouterr().out
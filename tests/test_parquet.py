@@ -0,0 +1,70 @@
+import os
+import subprocess
+import sys
+from queue import Queue
+
+import pyarrow.parquet as pq
+
+from easyctp.buffer import to_array
+from easyctp.pipeline import SaveParquet
+
+
+def parquet(tmp_path, **kwargs):
+    return SaveParquet(Queue(), str(tmp_path), **kwargs)
+
+
+def test_parts_are_readable_before_close(tick, tmp_path):
+    sink = parquet(tmp_path, rows_per_part=2)
+    for i in range(5):
+        sink._process_item(tick(update_time='09:00:0{}'.format(i).encode(), volume=i))
+
+    day = str(tmp_path / '20170104')
+    assert sorted(os.listdir(day)) == ['part-00000.parquet', 'part-00001.parquet']
+    table = pq.read_table(day)
+    assert table.num_rows == 4
+    assert table.column('Volume').to_pylist() == [0, 1, 2, 3]
+
+    sink.close()
+    assert pq.read_table(day).num_rows == 5
+
+
+def test_batches_and_items_keep_order(tick, tmp_path):
+    sink = parquet(tmp_path)
+    sink._process_item(tick(volume=1))
+    sink._process_batch(to_array([tick(volume=2), tick(volume=3, instrument_id=b'ag1706')]))
+    sink._process_batch([tick(volume=4)])
+    sink.close()
+    table = pq.read_table(str(tmp_path / '20170104'))
+    assert table.column('Volume').to_pylist() == [1, 2, 3, 4]
+    assert table.column('InstrumentID').to_pylist() == ['rb1705', 'rb1705', 'ag1706', 'rb1705']
+    assert table.column('UpdateTime').to_pylist()[0] == '09:00:00'
+
+
+def test_trading_day_switch_inside_batch(tick, tmp_path):
+    sink = parquet(tmp_path)
+    sink._process_batch(to_array([tick(), tick(trading_day=b'20170105'), tick(trading_day=b'20170105')]))
+    sink.close()
+    assert pq.read_table(str(tmp_path / '20170104')).num_rows == 1
+    assert pq.read_table(str(tmp_path / '20170105')).num_rows == 2
+
+
+def test_flush_interval_and_restart(tick, tmp_path):
+    sink = parquet(tmp_path, flush_interval=0)
+    sink._process_item(tick())
+    assert pq.read_table(str(tmp_path / '20170104')).num_rows == 1
+
+    restarted = parquet(tmp_path)
+    restarted._process_item(tick())
+    restarted.close()
+    assert sorted(os.listdir(str(tmp_path / '20170104'))) == ['part-00000.parquet', 'part-00001.parquet']
+
+
+def test_row_groups_within_part(tick, tmp_path):
+    sink = parquet(tmp_path, rows_per_part=5, row_group_size=2)
+    sink._process_batch(to_array([tick(volume=i) for i in range(5)]))
+    assert pq.ParquetFile(str(tmp_path / '20170104' / 'part-00000.parquet')).num_row_groups == 3
+
+
+def test_pipeline_does_not_import_pyarrow():
+    code = 'import sys, easyctp.pipeline; print("pyarrow" in sys.modules)'
+    assert subprocess.check_output([sys.executable, '-c', code]).strip() == b'False'
@@ -0,0 +1,87 @@
+import itertools
+import threading
+
+import pytest
+from ctp.futures import ApiStruct
+
+from easyctp.query import CtpError, QueryScheduler
+from easyctp.trader import ResultMap
+
+
+class FakeTrader:
+    broker = b'9999'
+    user = b'000001'
+
+    def __init__(self, returns=(), error=None):
+        self.results_map = ResultMap()
+        self.request_id = itertools.count()
+        self.returns = list(returns)
+        self.error = error
+        self.requests = []
+
+    def ReqQryInstrument(self, request, request_id):
+        self.requests.append(request_id)
+        if self.returns:
+            return self.returns.pop(0)
+        threading.Thread(target=self.respond, args=(request, request_id)).start()
+        return 0
+
+    def respond(self, request, request_id):
+        if self.error is not None:
+            self.results_map.fail(request_id, ApiStruct.RspInfo(ErrorID=self.error, ErrorMsg=b'error'))
+            return
+        instruments = [b'rb1705', b'rb1710'] if request.ExchangeID == b'SHFE' else []
+        for instrument_id in instruments:
+            self.results_map.put(request_id, ApiStruct.Instrument(InstrumentID=instrument_id), ApiStruct.RspInfo(),
+                                 False)
+        self.results_map.put(request_id, None, ApiStruct.RspInfo(), True)
+
+
+def test_query_results():
+    trader = FakeTrader()
+    scheduler = QueryScheduler(trader, interval=0)
+    first = scheduler.query_instruments(b'SHFE', timeout=2)
+    empty = scheduler.query_instruments(b'DCE', timeout=2)
+    assert [item.InstrumentID for item in first.result()] == [b'rb1705', b'rb1710']
+    assert empty.result() == []
+    assert scheduler.stats()['received'] == 2
+    assert trader.results_map.map == {}
+
+
+def test_throttled_query_is_retried():
+    trader = FakeTrader(returns=[-3, -2])
+    scheduler = QueryScheduler(trader, interval=0, retry_delay=0.01)
+    assert len(scheduler.query_instruments(b'SHFE', timeout=2).result()) == 2
+    assert scheduler.throttled == 2 and len(trader.requests) == 3
+    assert trader.results_map.map == {}
+
+
+def test_error_code_and_rsp_error():
+    scheduler = QueryScheduler(FakeTrader(returns=[-1]), interval=0)
+    with pytest.raises(CtpError) as error:
+        scheduler.query_instruments(timeout=2).result()
+    assert error.value.error_id == -1
+
+    scheduler = QueryScheduler(FakeTrader(error=90), interval=0)
+    with pytest.raises(CtpError) as error:
+        scheduler.query_instruments(timeout=2).result()
+    assert error.value.error_id == 90
+    assert scheduler.stats()['failed'] == 1
+
+
+def test_result_map_ignores_unknown_requests():
+    results = ResultMap()
+    results.fail(7, ApiStruct.RspInfo(ErrorID=1))
+    results.put(8, None, ApiStruct.RspInfo(), True)
+    assert results.map == {}
+
+    results.create(1)
+    results.put(1, None, ApiStruct.RspInfo(), True)
+    assert len(results.get(1, timeout=1)) == 1
+    # 已经结束的请求再收到 OnRspError 也不会留下队列
+    results.fail(1, ApiStruct.RspInfo(ErrorID=1))
+    assert results.map == {}
+
+    with pytest.raises(TimeoutError):
+        results.get(2, timeout=0.01)
+    assert results.map == {}
@@ -0,0 +1,51 @@
+import time
+from queue import Queue
+
+from easyctp.quotation import MarketData
+from easyctp.replay import MarketDataReplayer, from_tick_store, synthetic_ticks
+from easyctp.store import TickStore
+
+
+def drain(market_data):
+    items = []
+    while True:
+        batch = market_data.get_batch(max_wait=0.05)
+        if not batch:
+            return items
+        items.extend(batch)
+
+
+def test_synthetic_ticks_are_deterministic():
+    first = [(t.InstrumentID, t.UpdateTime, t.LastPrice, t.Volume) for t in synthetic_ticks(3, 10, seed=1)]
+    second = [(t.InstrumentID, t.UpdateTime, t.LastPrice, t.Volume) for t in synthetic_ticks(3, 10, seed=1)]
+    assert first == second
+    assert len(first) == 30
+
+
+def test_replay_as_fast_as_possible():
+    replayer = MarketDataReplayer()
+    market_data = replayer.prepare(synthetic_ticks(2, 50), MarketData(Queue()))
+    assert replayer.wait(2)
+    assert len(drain(market_data)) == 100
+    assert replayer.replayed == 100
+
+
+def test_replay_speed_follows_session_time():
+    # 10 个快照间隔 500ms, 共 4.5 秒, 100 倍速约 45ms
+    replayer = MarketDataReplayer()
+    start = time.time()
+    replayer.prepare(synthetic_ticks(1, 10), MarketData(Queue()), speed=100)
+    assert replayer.wait(2)
+    assert 0.04 <= time.time() - start < 1
+
+
+def test_replay_from_tick_store(tmp_path):
+    store = TickStore(str(tmp_path))
+    for item in synthetic_ticks(['rb1705', 'ag1706'], 5):
+        store.save(item)
+    store.close()
+
+    replayed = list(from_tick_store(str(tmp_path), '20170104'))
+    assert len(replayed) == 10
+    assert [t.UpdateTime for t in replayed] == sorted(t.UpdateTime for t in replayed)
+    assert {t.InstrumentID for t in replayed} == {b'rb1705', b'ag1706'}
@@ -0,0 +1,82 @@
+import time
+
+from easyctp.session import CONNECTED, SUBSCRIBED, SessionSupervisor
+
+
+class FakeApi:
+    def __init__(self, instrument_ids):
+        self.instrument_ids = instrument_ids
+        self.logins = 0
+        self.chunks = []
+
+    def login(self):
+        self.logins += 1
+
+    def SubscribeMarketData(self, chunk):
+        self.chunks.append(chunk)
+        return 0
+
+
+def wait_until(predicate, timeout=2):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_subscribe_in_chunks():
+    api = FakeApi([b'rb1705', b'rb1710', b'ag1706', b'cu1705', b'm1705'])
+    supervisor = SessionSupervisor(api, chunk_size=2, chunk_interval=0)
+    supervisor.on_connected()
+    assert api.logins == 1
+    supervisor.on_login(0)
+    assert wait_until(lambda: supervisor.state == SUBSCRIBED)
+    assert [len(chunk) for chunk in api.chunks] == [2, 2, 1]
+
+
+def test_backoff_after_repeated_disconnects():
+    api = FakeApi([b'rb1705'])
+    supervisor = SessionSupervisor(api, chunk_interval=0, backoff=0.05)
+    supervisor.on_connected()
+    supervisor.on_login(0)
+    for _ in range(3):
+        supervisor.on_disconnected(4097)
+        supervisor.on_connected()
+    # 第一次断线后立即登录, 之后按 backoff 加倍等待, 新的断线取消尚未执行的登录
+    assert supervisor.state == CONNECTED and api.logins == 2
+    assert wait_until(lambda: api.logins == 3)
+    assert supervisor.disconnects == 3
+
+
+def test_pending_login_cancelled_by_disconnect():
+    api = FakeApi([b'rb1705'])
+    supervisor = SessionSupervisor(api, chunk_interval=0, backoff=0.05)
+    supervisor.on_connected()
+    supervisor.on_login(0)
+    supervisor.on_disconnected(4097)
+    supervisor.on_connected()
+    supervisor.on_disconnected(4097)
+    supervisor.on_connected()
+    supervisor.on_disconnected(4097)
+    time.sleep(0.2)
+    assert api.logins == 2
+
+
+def test_gap_records(tick):
+    gaps = []
+    api = FakeApi([b'rb1705', b'ag1706'])
+    supervisor = SessionSupervisor(api, chunk_interval=0, sinks=[gaps.extend])
+    supervisor.on_connected()
+    supervisor.on_login(0)
+    supervisor.on_tick(tick(update_time=b'09:30:00', millisec=500))
+    supervisor.on_disconnected(4097)
+    supervisor.on_connected()
+    supervisor.on_login(0)
+    supervisor.on_tick(tick(update_time=b'09:31:10'))
+    supervisor.on_tick(tick(update_time=b'09:31:11'))
+
+    assert len(gaps) == 1
+    gap = gaps[0]
+    assert (gap['instrument_id'], gap['trading_day']) == ('rb1705', '20170104')
+    assert (gap['last_time'], gap['first_time'], gap['reason']) == ('09:30:00.500', '09:31:10.000', 4097)
+    assert supervisor.stats()['open_gaps'] == 1
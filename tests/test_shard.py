@@ -0,0 +1,49 @@
+import time
+
+import pytest
+
+from easyctp.shard import ShardSupervisor, product_of, shard_instruments
+
+
+def test_product_of():
+    assert product_of(b'rb1705') == b'rb'
+    assert product_of(b'm1707-C-2800') == b'm'
+    assert product_of(b'1705') == b'1705'
+
+
+def test_shard_by_product_keeps_products_together():
+    instruments = ['rb1705', 'rb1710', 'rb1801', 'ag1706', 'ag1712', 'cu1705', 'm1707-C-2800']
+    shards = shard_instruments(instruments, 2)
+    assert sorted(sum(shards, [])) == sorted(x.encode() for x in instruments)
+    # 大品种先分配, 之后总是放入合约最少的分片
+    assert shards[0] == [b'rb1705', b'rb1710', b'rb1801', b'm1707-C-2800']
+    assert shards[1] == [b'ag1706', b'ag1712', b'cu1705']
+
+
+def test_shard_by_hash_is_stable():
+    instruments = ['rb1705', 'rb1710', 'ag1706', 'cu1705']
+    assert shard_instruments(instruments, 3, 'hash') == shard_instruments(reversed(instruments), 3, 'hash')
+    assert sorted(sum(shard_instruments(instruments, 3, 'hash'), [])) == sorted(x.encode() for x in instruments)
+
+
+def test_invalid_split():
+    with pytest.raises(ValueError):
+        shard_instruments(['rb1705'], 2, 'random')
+
+
+def report_and_exit(index, instrument_ids, stats_queue):
+    stats_queue.put((index, time.time(), {'received': len(instrument_ids)}))
+    raise SystemExit(1)
+
+
+def test_supervisor_restarts_and_collects_stats():
+    supervisor = ShardSupervisor(report_and_exit, ['rb1705', 'rb1710', 'ag1706'], 2, restart_delay=0.1)
+    supervisor.start()
+    try:
+        deadline = time.time() + 30
+        while time.time() < deadline and min(supervisor.restarts) < 1:
+            supervisor.supervise(0.1)
+    finally:
+        supervisor.stop()
+    assert min(supervisor.restarts) >= 1
+    assert supervisor.stats()['total']['received'] == 3
@@ -0,0 +1,66 @@
+import pytest
+
+from easyctp.shm import SharedMarketData, SharedTickPublisher
+
+
+@pytest.fixture
+def ring(tmp_path):
+    publisher = SharedTickPublisher(str(tmp_path / 'ticks'), capacity=8)
+    yield publisher
+    publisher.close()
+
+
+def test_reader_sees_published_ticks(ring, tick):
+    ring.put_tick(tick(last_price=1.0))
+    reader = SharedMarketData(ring.path, spin=0)
+    ring.put_tick(tick(last_price=2.0))
+    ring.put_tick(tick(instrument_id=b'ag1706', last_price=3.0))
+    batch = reader.get_batch(max_wait=0)
+    assert list(batch.LastPrice) == [2.0, 3.0]
+    assert list(batch.InstrumentID) == [b'rb1705', b'ag1706']
+    assert len(reader.get_batch(max_wait=0.01)) == 0
+    reader.close()
+
+
+def test_from_start_and_overrun(ring, tick):
+    for price in range(12):
+        ring.put_tick(tick(last_price=float(price)))
+    reader = SharedMarketData(ring.path, spin=0, from_start=True)
+    assert list(reader.get_batch(max_wait=0).LastPrice) == [float(price) for price in range(4, 12)]
+
+    for price in range(12, 32):
+        ring.put_tick(tick(last_price=float(price)))
+    assert list(reader.get_batch(max_wait=0).LastPrice) == [float(price) for price in range(24, 32)]
+    assert reader.dropped == 12
+    reader.close()
+
+
+def test_publisher_restart_continues_sequence(tmp_path, tick):
+    path = str(tmp_path / 'ticks')
+    publisher = SharedTickPublisher(path, capacity=8)
+    publisher.put_tick(tick(last_price=1.0))
+    reader = SharedMarketData(path, spin=0)
+    publisher.close()
+
+    publisher = SharedTickPublisher(path, capacity=8)
+    assert publisher.sequence == 1
+    publisher.put_tick(tick(last_price=2.0))
+    assert list(reader.get_batch(max_wait=0).LastPrice) == [2.0]
+    reader.close()
+    publisher.close()
+
+
+def test_reject_other_file(tmp_path):
+    path = tmp_path / 'other'
+    path.write_bytes(b'\0' * 4096)
+    with pytest.raises(ValueError):
+        SharedMarketData(str(path))
+
+
+def test_item_mode_returns_structs(ring, tick):
+    reader = SharedMarketData(ring.path, spin=0, timeout=0.01)
+    ring.put_tick(tick(last_price=1.0))
+    ring.put_tick(tick(last_price=2.0))
+    assert reader.get().LastPrice == 1.0
+    assert [item.LastPrice for item in reader] == [2.0]
+    reader.close()
@@ -0,0 +1,60 @@
+import threading
+
+from easyctp.snapshot import SnapshotTable
+
+
+def test_latest_tick_per_instrument(tick):
+    table = SnapshotTable(capacity=2)
+    table.update(tick(last_price=1.0))
+    table.update(tick(last_price=2.0))
+    table.update(tick(instrument_id=b'ag1706', last_price=3.0))
+    table.update(tick(instrument_id=b'cu1705', last_price=4.0))
+
+    assert len(table) == 3 and 'cu1705' in table and b'rb1705' in table
+    assert table.get('rb1705').LastPrice == 2.0
+    assert table.get_record('cu1705').LastPrice == 4.0
+    assert table.get('au1706') is None
+    assert list(table.snapshot().LastPrice) == [2.0, 3.0, 4.0]
+
+
+def test_get_returns_copy(tick):
+    table = SnapshotTable()
+    item = tick(last_price=1.0)
+    table.update(item)
+    copied = table.get('rb1705')
+    item.LastPrice = 9.0
+    table.update(tick(last_price=2.0))
+    assert copied.LastPrice == 1.0
+
+
+def test_subscribe_filters_and_cancel(tick):
+    table = SnapshotTable()
+    received, everything = [], []
+    subscription = table.subscribe(lambda t: received.append(t.LastPrice), ['rb1705'],
+                                   condition=lambda t: t.LastPrice > 1)
+    table.subscribe(lambda t: everything.append(t.InstrumentID))
+    table.update(tick(last_price=1.0))
+    table.update(tick(last_price=2.0))
+    table.update(tick(instrument_id=b'ag1706', last_price=3.0))
+    subscription.cancel()
+    table.update(tick(last_price=4.0))
+
+    assert received == [2.0]
+    assert everything == [b'rb1705', b'rb1705', b'ag1706', b'rb1705']
+
+
+def test_subscriber_error_does_not_stop_update(tick):
+    table = SnapshotTable()
+    table.subscribe(lambda t: 1 / 0)
+    table.update(tick(last_price=2.0))
+    assert table.get('rb1705').LastPrice == 2.0
+
+
+def test_wait_for(tick):
+    table = SnapshotTable()
+    timer = threading.Timer(0.05, table.update, [tick(last_price=5.0)])
+    timer.start()
+    result = table.wait_for('rb1705', lambda t: t.LastPrice == 5.0, timeout=2)
+    timer.join()
+    assert result.LastPrice == 5.0
+    assert table.wait_for('rb1705', lambda t: t.LastPrice == 6.0, timeout=0.05) is None
@@ -0,0 +1,248 @@
+import os
+import pickle
+import threading
+import time
+
+from pymongo.errors import AutoReconnect, DuplicateKeyError, OperationFailure, ServerSelectionTimeoutError
+
+from easyctp.facade import MongoStrategy
+from easyctp.influx import InfluxWriter
+from easyctp.spool import WriteAheadSpool
+from easyctp.writer import BatchWriter
+
+
+def wait_until(predicate, timeout=2.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.005)
+    return predicate()
+
+
+def test_read_commit_and_restart(tmp_path):
+    spool = WriteAheadSpool(str(tmp_path), 'test')
+    spool.append([1, 2])
+    spool.append([3])
+    spool.append([4, 5])
+    records, position, count = spool.read(3)
+    assert records == [1, 2, 3] and count == 3
+    spool.commit(position, count)
+    assert spool.pending == 2
+    spool.close()
+
+    spool = WriteAheadSpool(str(tmp_path), 'test')
+    assert spool.pending == 2
+    records, position, count = spool.read(100)
+    assert records == [4, 5]
+    spool.commit(position, count)
+    assert spool.stats()['pending'] == 0
+    spool.close()
+
+
+def test_uncommitted_records_are_replayed_again(tmp_path):
+    spool = WriteAheadSpool(str(tmp_path), 'test')
+    spool.append([1, 2])
+    assert spool.read(100)[0] == [1, 2]
+    spool.close()
+
+    spool = WriteAheadSpool(str(tmp_path), 'test')
+    assert spool.read(100)[0] == [1, 2]
+    spool.close()
+
+
+def test_torn_tail_is_truncated(tmp_path):
+    spool = WriteAheadSpool(str(tmp_path), 'test')
+    spool.append([1, 2])
+    spool.append([3])
+    path = spool.path(spool._write_sequence)
+    spool.close()
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+
+    spool = WriteAheadSpool(str(tmp_path), 'test')
+    assert spool.pending == 2
+    assert spool.read(100)[0] == [1, 2]
+    spool.append([4])
+    records, position, count = spool.read(100)
+    assert records == [1, 2, 4]
+    spool.close()
+
+
+def test_checksum_mismatch_drops_frame(tmp_path):
+    spool = WriteAheadSpool(str(tmp_path), 'test', codec='lines')
+    spool.append([b'a', b'b'])
+    spool.append([b'c'])
+    path = spool.path(spool._write_sequence)
+    with open(path, 'r+b') as f:
+        f.seek(20)
+        f.write(b'\xff')
+    records, position, count = spool.read(100)
+    assert records == [b'c'] and count == 3
+    assert spool.corrupted == 2
+    spool.close()
+
+
+def test_corrupted_frames_are_skipped_and_not_pending(tmp_path):
+    spool = WriteAheadSpool(str(tmp_path), 'test', fsync=False)
+    spool.append([1])
+    # 校验和正确但无法解码的帧
+    spool.dumps = lambda records: b'not a pickle'
+    spool.append([2])
+    spool.dumps = pickle.dumps
+    spool.append([3])
+    offset = spool.sizes[spool._write_sequence]
+    spool.append([4])
+    spool._rotate()
+    spool.append([5])
+    path = spool.path(spool._write_sequence - 1)
+    spool.close()
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(b'XXXX')
+
+    spool = WriteAheadSpool(str(tmp_path), 'test')
+    assert spool.pending == 4
+    records, position, count = spool.read(100)
+    assert records == [1, 3, 5] and count == 4
+    assert spool.corrupted == 1
+    spool.commit(position, count)
+    assert spool.pending == 0
+    spool.close()
+
+
+def test_bad_magic_while_running_is_subtracted_from_pending(tmp_path):
+    spool = WriteAheadSpool(str(tmp_path), 'test', fsync=False)
+    spool.append([1])
+    offset = spool.sizes[spool._write_sequence]
+    spool.append([2, 3])
+    spool.append([4])
+    with open(spool.path(spool._write_sequence), 'r+b') as f:
+        f.seek(offset)
+        f.write(b'XXXX')
+    records, position, count = spool.read(100)
+    assert records == [1] and count == 4 and spool.corrupted == 3
+    spool.commit(position, count)
+    assert spool.pending == 0
+    spool.append([5])
+    records, position, count = spool.read(100)
+    assert records == [5]
+    spool.commit(position, count)
+    assert spool.stats()['pending'] == 0
+    spool.close()
+
+
+def test_segments_rotate_and_are_removed(tmp_path):
+    spool = WriteAheadSpool(str(tmp_path), 'test', segment_bytes=1, fsync=False)
+    for i in range(3):
+        spool.append([i])
+    assert spool.stats()['segments'] == 3
+    records, position, count = spool.read(100)
+    assert records == [0, 1, 2]
+    spool.commit(position, count)
+    assert spool.stats()['segments'] == 1
+    assert len([name for name in os.listdir(str(tmp_path)) if name.endswith('.seg')]) == 1
+    spool.close()
+
+
+class FlakyDatabase:
+    def __init__(self, error=ConnectionError):
+        self.error = error
+        self.down = threading.Event()
+        self.down.set()
+        self.rows = []
+
+    def write(self, records):
+        if self.down.is_set():
+            raise self.error('database down')
+        self.rows.extend(records)
+
+
+def test_writer_spools_during_outage_and_replays_in_order(tmp_path):
+    database = FlakyDatabase()
+    writer = BatchWriter(database.write, batch_size=2, flush_interval=0.01, spool_dir=str(tmp_path),
+                         retry_interval=0.01, max_retry_interval=0.02)
+    for i in range(10):
+        writer.put([i])
+    assert wait_until(lambda: writer.spooled == 10)
+    database.down.clear()
+    writer.put([10])
+    assert wait_until(lambda: len(database.rows) == 11)
+    assert database.rows == list(range(11))
+    writer.close(1)
+    assert writer.stats()['spool_pending'] == 0 and writer.failed == 0
+
+
+def test_writer_replays_past_corrupted_spool(tmp_path):
+    spool = WriteAheadSpool(str(tmp_path), 'test', codec='lines', fsync=False)
+    spool.append([b'1'])
+    offset = spool.sizes[spool._write_sequence]
+    spool.append([b'2'])
+    spool.append([b'3'])
+    spool.close()
+    with open(spool.path(spool._write_sequence), 'r+b') as f:
+        f.seek(offset + 20)
+        f.write(b'\xff')
+
+    database = FlakyDatabase()
+    database.down.clear()
+    writer = BatchWriter(database.write, batch_size=1, flush_interval=0.01, spool_dir=str(tmp_path),
+                         spool_codec='lines', name='test', retry_interval=0.01, max_retry_interval=0.02)
+    read = writer.spool.read
+    errors = iter([OSError('disk error')])
+
+    def flaky_read(max_records):
+        for error in errors:
+            raise error
+        return read(max_records)
+
+    writer.spool.read = flaky_read
+    writer.spool.wake()
+    assert wait_until(lambda: database.rows == [b'1', b'3'])
+    assert writer.spool.corrupted == 1
+    writer.put([b'4'])
+    assert wait_until(lambda: database.rows == [b'1', b'3', b'4'])
+    writer.close(1)
+    assert writer.stats()['spool_pending'] == 0
+
+
+def test_replay_gives_up_after_max_attempts(tmp_path):
+    database = FlakyDatabase()
+    writer = BatchWriter(database.write, batch_size=1, flush_interval=0.01, spool_dir=str(tmp_path),
+                         retry_interval=0.01, max_replay_attempts=3)
+    writer.put([1])
+    assert wait_until(lambda: writer.failed == 1)
+    database.down.clear()
+    writer.put([2])
+    assert wait_until(lambda: database.rows == [2])
+    writer.close(1)
+
+
+def test_non_retryable_error_is_not_spooled(tmp_path):
+    database = FlakyDatabase(ValueError)
+    writer = BatchWriter(database.write, batch_size=1, flush_interval=0.01, spool_dir=str(tmp_path),
+                         retryable=lambda e: not isinstance(e, ValueError))
+    writer.put([1])
+    assert wait_until(lambda: writer.failed == 1)
+    assert writer.spooled == 0
+    writer.close(1)
+
+
+class HttpError(Exception):
+    def __init__(self, status_code):
+        super().__init__(status_code)
+        self.response = type('Response', (), {'status_code': status_code})()
+
+
+def test_influx_retryable():
+    assert not InfluxWriter.retryable(HttpError(400))
+    assert InfluxWriter.retryable(HttpError(503))
+    assert InfluxWriter.retryable(ConnectionError())
+
+
+def test_mongo_retryable():
+    assert MongoStrategy.retryable(AutoReconnect())
+    assert MongoStrategy.retryable(ServerSelectionTimeoutError())
+    assert not MongoStrategy.retryable(DuplicateKeyError('duplicate'))
+    assert not MongoStrategy.retryable(OperationFailure('invalid document'))
+    assert not MongoStrategy.retryable(ValueError())
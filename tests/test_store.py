@@ -0,0 +1,76 @@
+import ctypes
+import json
+import os
+
+from ctp.futures import ApiStruct
+
+from easyctp.buffer import to_array
+from easyctp.store import TickStore, TickStoreReader
+
+
+def ticks_for(tick, instrument_ids, times):
+    return [tick(instrument_id=instrument_id, update_time=update_time, last_price=float(i))
+            for i, update_time in enumerate(times) for instrument_id in instrument_ids]
+
+
+def test_save_and_load_range(tick, tmp_path):
+    store = TickStore(str(tmp_path))
+    for item in ticks_for(tick, [b'rb1705'], [b'21:00:00', b'23:00:00', b'09:00:00', b'14:00:00']):
+        store.save(item)
+    store.close()
+
+    reader = TickStoreReader(str(tmp_path))
+    assert reader.trading_days() == ['20170104']
+    assert len(reader.load('20170104', 'rb1705')) == 4
+    # 夜盘早于日盘
+    records = reader.load('20170104', 'rb1705', start='23:00:00', end='14:00:00')
+    assert records.UpdateTime.tolist() == [b'23:00:00', b'09:00:00']
+
+
+def test_save_batch_and_replay_order(tick, tmp_path):
+    store = TickStore(str(tmp_path))
+    store.save_batch(to_array(ticks_for(tick, [b'rb1705', b'ag1706'], [b'09:00:00', b'09:00:01', b'09:00:02'])))
+    store.close()
+
+    reader = TickStoreReader(str(tmp_path))
+    assert reader.instruments('20170104') == ['ag1706', 'rb1705']
+    records = reader.replay('20170104')
+    assert len(records) == 6
+    assert records.UpdateTime.tolist() == sorted(records.UpdateTime.tolist())
+    assert records.dtype == reader.dtype
+    # 合并后仍保留对齐填充, 可以直接按原始内存还原为结构体
+    assert records.itemsize == ctypes.sizeof(ApiStruct.DepthMarketData)
+    assert ApiStruct.DepthMarketData.from_buffer_copy(records[:1]).InstrumentID == records[0].InstrumentID
+
+
+def test_open_files_are_bounded(tick, tmp_path):
+    store = TickStore(str(tmp_path), buffer_size=1, max_open_files=2)
+    instrument_ids = [b'ins%d' % i for i in range(5)]
+    for item in ticks_for(tick, instrument_ids, [b'09:00:00', b'09:00:01']):
+        store.save(item)
+        assert len(store._files) <= 2
+    store.close()
+
+    reader = TickStoreReader(str(tmp_path))
+    assert all(len(reader.load('20170104', i.decode())) == 2 for i in instrument_ids)
+
+
+def test_interval_flush_writes_data_and_index(tick, tmp_path):
+    store = TickStore(str(tmp_path), flush_interval=0)
+    store.save(tick(instrument_id=b'illiquid'))
+
+    # 未切换交易日也已经落盘
+    day = os.path.join(str(tmp_path), '20170104')
+    assert os.path.getsize(os.path.join(day, 'illiquid.ticks')) == store.itemsize
+    with open(os.path.join(day, 'index.json')) as f:
+        assert json.load(f)['instruments']['illiquid']['count'] == 1
+
+
+def test_restart_appends_to_existing_day(tick, tmp_path):
+    for update_time in (b'09:00:00', b'09:00:01'):
+        store = TickStore(str(tmp_path))
+        store.save(tick(update_time=update_time))
+        store.close()
+    reader = TickStoreReader(str(tmp_path))
+    assert reader.index('20170104')['instruments']['rb1705']['count'] == 2
+    assert len(reader.load('20170104', 'rb1705')) == 2
@@ -0,0 +1,89 @@
+import math
+
+import numpy as np
+
+from easyctp.buffer import to_array
+from easyctp.validator import DBL_MAX, TickValidator, session_time_key
+
+
+def test_rejects_invalid_fields(tick):
+    validator = TickValidator()
+    batch = [
+        tick(),
+        tick(update_time=b'9:00'),
+        tick(action_day=b''),
+        tick(instrument_id=b'rb'),
+        tick(last_price=DBL_MAX),
+        tick(BidPrice1=3502.0),
+    ]
+    assert validator.validate(batch).tolist() == [True, False, False, False, False, False]
+    assert validator.rejected == {'invalid_update_time': 1, 'invalid_action_day': 1, 'invalid_instrument_id': 1,
+                                  'invalid_last_price': 1, 'crossed_book': 1}
+
+
+def test_item_and_batch_rules_agree(tick):
+    batch = [tick(), tick(update_time=b'9:00'), tick(last_price=float('nan')), tick(instrument_id=b'x')]
+    items = TickValidator()
+    assert [items.validate_item(item) for item in batch] == TickValidator().validate(batch).tolist()
+
+
+def test_monotonic_per_instrument_across_batches(tick):
+    validator = TickValidator()
+    first = [tick(update_time=b'09:00:01'), tick(instrument_id=b'ag1706', update_time=b'09:00:05')]
+    assert validator.validate(first).tolist() == [True, True]
+    second = [tick(update_time=b'09:00:00'), tick(instrument_id=b'ag1706', update_time=b'09:00:05', millisec=500)]
+    assert validator.validate(second).tolist() == [False, True]
+    assert validator.rejected['non_monotonic_time'] == 1
+
+
+def test_monotonic_state_only_advances_on_accepted_ticks(tick):
+    stream = [
+        tick(update_time=b'09:00:01'),
+        # 其他规则拒绝的 tick 不推进时间
+        tick(update_time=b'09:00:09', BidPrice1=3502.0),
+        tick(update_time=b'09:00:08', last_price=DBL_MAX),
+        tick(update_time=b'09:00:02'),
+        tick(update_time=b'0a:00:05'),
+        tick(update_time=b'09:00:03', trading_day=b''),
+        tick(update_time=b'09:00:01', millisec=500),
+        tick(update_time=b'09:00:04'),
+        tick(instrument_id=b'ag1706', update_time=b'09:00:00'),
+        tick(update_time=b'09:00:03'),
+    ]
+    expected = [True, False, False, True, True, True, False, True, True, False]
+    items = TickValidator()
+    assert [items.validate_item(item) for item in stream] == expected
+    for size in (1, 3, len(stream)):
+        validator = TickValidator()
+        mask = np.concatenate([validator.validate(stream[i:i + size]) for i in range(0, len(stream), size)])
+        assert mask.tolist() == expected
+        assert validator.rejected == items.rejected
+        assert validator.last_time == items.last_time
+
+
+def test_night_session_sorts_before_day_session():
+    night = session_time_key(b'20170104', b'21:00:00')
+    after_midnight = session_time_key(b'20170104', b'01:00:00')
+    day = session_time_key(b'20170104', b'09:00:00')
+    assert night < after_midnight < day
+
+
+def test_filter_does_not_mutate_shared_structs(tick):
+    shared = tick()
+    result = TickValidator().filter([shared])
+    assert shared.ClosePrice == DBL_MAX
+    assert math.isnan(result[0].ClosePrice)
+    assert result[0] is not shared
+
+
+def test_filter_does_not_mutate_ring_buffer_view(tick):
+    array = to_array([tick(), tick(update_time=b'09:00:01')])
+    view = array[:]
+    result = TickValidator().filter(view)
+    assert (array['ClosePrice'] == DBL_MAX).all()
+    assert np.isnan(result['ClosePrice']).all()
+
+
+def test_sanitize_item_returns_original_without_sentinel(tick):
+    item = tick(ClosePrice=3500.0, SettlementPrice=3500.0)
+    assert TickValidator().sanitize_item(item) is item
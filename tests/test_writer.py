@@ -0,0 +1,136 @@
+import glob
+import threading
+import time
+
+import pytest
+
+from easyctp.writer import BatchWriter
+
+
+def wait_until(predicate, timeout=2.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.005)
+    return predicate()
+
+
+def test_flush_by_batch_size():
+    batches = []
+    writer = BatchWriter(batches.append, batch_size=3, flush_interval=60)
+    writer.put([1, 2])
+    writer.put([3, 4])
+    assert wait_until(lambda: batches)
+    assert batches[0] == [1, 2, 3, 4]
+    writer.close(1)
+
+
+def test_flush_by_interval_and_close_drains():
+    batches = []
+    writer = BatchWriter(batches.append, batch_size=100, flush_interval=0.05)
+    writer.put([1])
+    assert wait_until(lambda: batches == [[1]])
+    writer.put([2])
+    writer.close(1)
+    assert batches == [[1], [2]]
+    assert writer.stats()['written'] == 2
+
+
+def test_unknown_overflow_policy():
+    with pytest.raises(ValueError):
+        BatchWriter(list, overflow='ignore')
+    with pytest.raises(ValueError):
+        BatchWriter(list, overflow='spill')
+
+
+def blocked_writer(**kwargs):
+    release = threading.Event()
+    batches = []
+
+    def write(batch):
+        release.wait()
+        batches.append(batch)
+
+    writer = BatchWriter(write, batch_size=1, flush_interval=0.01, max_pending=2, **kwargs)
+    writer.put([0])
+    # 等待第一批被写入线程取走并阻塞在 write 中
+    assert wait_until(lambda: writer.stats()['pending'] == 0)
+    return writer, release, batches
+
+
+def test_overflow_drop_oldest():
+    writer, release, batches = blocked_writer(overflow='drop_oldest')
+    for i in range(1, 5):
+        writer.put([i])
+    assert writer.dropped == 2
+    release.set()
+    writer.close(1)
+    assert batches == [[0], [3], [4]]
+
+
+def test_overflow_block():
+    writer, release, batches = blocked_writer(overflow='block')
+    writer.put([1])
+    writer.put([2])
+    producer = threading.Thread(target=writer.put, args=([3],))
+    producer.start()
+    producer.join(0.1)
+    assert producer.is_alive()
+    release.set()
+    producer.join(1)
+    writer.close(1)
+    assert batches == [[0], [1], [2], [3]]
+
+
+def test_overflow_spill_survives_restart(tmp_path):
+    writer, release, batches = blocked_writer(overflow='spill', spill_dir=str(tmp_path), name='t')
+    for i in range(1, 5):
+        writer.put([i])
+    assert writer.spilled == 2
+    assert len(glob.glob(str(tmp_path / 't-*.spill'))) == 2
+
+    # 模拟进程退出: 新的写入器读取上次留下的 spill 文件
+    restarted = []
+    writer2 = BatchWriter(restarted.append, batch_size=10, flush_interval=0.01, spill_dir=str(tmp_path), name='t')
+    assert wait_until(lambda: sum(map(len, restarted)) == 2)
+    assert sorted(x for batch in restarted for x in batch) == [3, 4]
+    writer2.close(1)
+    release.set()
+    writer.close(1)
+
+
+def test_encode_error_keeps_worker_alive():
+    batches = []
+
+    def encode(chunk):
+        if chunk == ['bad']:
+            raise ValueError('bad chunk')
+        return chunk
+
+    writer = BatchWriter(batches.append, encode=encode, batch_size=1, flush_interval=0.01, max_pending=1)
+    writer.put(['bad'])
+    writer.put(['good'])
+    assert wait_until(lambda: batches == [['good']])
+    assert writer.failed == 1
+    writer.close(1)
+
+
+def test_corrupt_spill_file_is_skipped(tmp_path):
+    (tmp_path / 't-000000000000.spill').write_bytes(b'not a pickle')
+    batches = []
+    writer = BatchWriter(batches.append, batch_size=1, flush_interval=0.01, spill_dir=str(tmp_path), name='t')
+    writer.put([1])
+    assert wait_until(lambda: batches == [[1]])
+    assert (tmp_path / 't-000000000000.spill.bad').exists()
+    writer.close(1)
+
+
+def test_write_error_is_counted():
+    def write(batch):
+        raise IOError('down')
+
+    writer = BatchWriter(write, batch_size=1, flush_interval=0.01)
+    writer.put([1, 2])
+    writer.close(1)
+    assert writer.failed == 2